@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+# Keyframe animations, compiled once into one LED segment per render tick.
+#
+# An animation is a sequence of keyframes. Each keyframe lasts `duration`
+# seconds and goes from the color of the keyframe before it to its own color
+# along an easing curve ("step" switches at once). compile() samples the
+# sequence at the render rate into (start, end, colors) segments, so playing
+# it is a lookup and a slice copy per tick. Compiled animations are kept in an
+# AnimationCache keyed by everything they were built from (LED range, fps and
+# whatever the effect adds, e.g. how many LEDs the state of charge lights).
+
+from collections import OrderedDict
+
+EASINGS = {
+    "step": lambda x: 1.0,
+    "linear": lambda x: x,
+    "ease_in": lambda x: x * x,
+    "ease_out": lambda x: 1.0 - (1.0 - x) * (1.0 - x),
+    "ease_in_out": lambda x: x * x * (3.0 - 2.0 * x),
+}
+
+
+def mix(first, second, amount):
+    # Blends two packed WRGB colors channel by channel.
+    color = 0
+    for shift in (24, 16, 8, 0):
+        a = (first >> shift) & 0xFF
+        b = (second >> shift) & 0xFF
+        color |= int(round(a + (b - a) * amount)) << shift
+    return color
+
+
+class Keyframe:
+    # color None is transparent: the layers below stay visible. start/end limit
+    # the keyframe to part of the LED range the animation is compiled for.
+    __slots__ = ("duration", "color", "start", "end", "easing")
+
+    def __init__(self, duration, color, start=None, end=None, easing="step"):
+        if easing not in EASINGS:
+            raise ValueError("Unknown easing %s" % easing)
+        self.duration = duration
+        self.color = color
+        self.start = start
+        self.end = end
+        self.easing = easing
+
+
+def ramp(color_function, first, last, steps, step_time):
+    # `steps` stepped keyframes going from color_function(first) to color_function(last).
+    keyframes = []
+    for step in range(steps):
+        level = first + (last - first) * step // max(steps - 1, 1)
+        keyframes.append(Keyframe(step_time, color_function(level)))
+    return keyframes
+
+
+class CompiledAnimation:
+    __slots__ = ("segments", "fps", "loop", "runs")
+
+    def __init__(self, segments, fps, loop):
+        self.segments = segments
+        self.fps = fps
+        self.loop = loop
+        # Per tick, the number of ticks until the segment changes (None: never).
+        self.runs = self._runs()
+
+    def _runs(self):
+        segments = self.segments
+        count = len(segments)
+        runs = [None] * count
+        if not self.loop:
+            runs[-1] = 1
+            for tick in range(count - 2, -1, -1):
+                runs[tick] = 1 if segments[tick + 1] is not segments[tick] else runs[tick + 1] + 1
+            return runs
+        # Looping: go around twice so the distances wrap past the end.
+        for position in range(2 * count - 1, -1, -1):
+            tick = position % count
+            following = (tick + 1) % count
+            if segments[following] is not segments[tick]:
+                runs[tick] = 1
+            elif runs[following] is not None:
+                runs[tick] = runs[following] + 1
+        return runs
+
+    def next_change(self, elapsed):
+        # Seconds after the start at which the shown segment changes next, None if it never does.
+        tick = int(elapsed * self.fps)
+        if tick >= len(self.segments) and not self.loop:
+            return None
+        run = self.runs[tick % len(self.segments)]
+        if run is None:
+            return None
+        return (tick + run) / float(self.fps)
+
+    def segment(self, elapsed):
+        # (start, end, colors) to show `elapsed` seconds in, or None for nothing.
+        tick = int(elapsed * self.fps)
+        if tick >= len(self.segments):
+            if not self.loop:
+                return None
+            tick %= len(self.segments)
+        return self.segments[tick]
+
+    def finished(self, elapsed):
+        return not self.loop and int(elapsed * self.fps) >= len(self.segments)
+
+
+class Animation:
+    def __init__(self, keyframes, loop=True):
+        self.keyframes = list(keyframes)
+        self.loop = loop
+        self.duration = sum(keyframe.duration for keyframe in self.keyframes)
+
+    def sample(self, t, start, end):
+        # Segment at `t` seconds for the LED range [start, end).
+        previous = None
+        elapsed = 0.0
+        for keyframe in self.keyframes:
+            # Tolerance so sampling exactly on a keyframe boundary lands in the next one.
+            if t < elapsed + keyframe.duration - 1e-9 or keyframe is self.keyframes[-1]:
+                color = keyframe.color
+                if color is None:
+                    return None
+                if previous is not None and keyframe.easing != "step" and keyframe.duration > 0:
+                    amount = min(max((t - elapsed) / keyframe.duration, 0.0), 1.0)
+                    color = mix(previous, color, EASINGS[keyframe.easing](amount))
+                first = start if keyframe.start is None else max(start, keyframe.start)
+                last = end if keyframe.end is None else min(end, keyframe.end)
+                return first, max(first, last), color
+            elapsed += keyframe.duration
+            previous = keyframe.color
+        return None
+
+    def compile(self, fps, start, end):
+        ticks = max(1, int(round(self.duration * fps)))
+        segments = []
+        # Identical ticks share one segment (and one color list).
+        shared = {}
+        for tick in range(ticks):
+            sample = self.sample(tick / float(fps), start, end)
+            if sample is not None:
+                segment = shared.get(sample)
+                if segment is None:
+                    first, last, color = sample
+                    segment = shared[sample] = (first, last, [color] * (last - first))
+                sample = segment
+            segments.append(sample)
+        return CompiledAnimation(segments, fps, self.loop)
+
+
+class AnimationCache:
+    # Least recently used cache of compiled animations. The key has to contain
+    # every input the compiled segments depend on; a new key compiles again.
+    def __init__(self, size=64):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, animation, fps, start, end, *key):
+        key = (animation, fps, start, end) + key
+        compiled = self.entries.get(key)
+        if compiled is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return compiled
+        self.misses += 1
+        compiled = self.entries[key] = animation.compile(fps, start, end)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
@@ -0,0 +1,370 @@
+#!/usr/bin/python3
+
+# End-to-end benchmarks for GlowSense without a Raspberry Pi. Runs the real
+# decoding, dispatch and render code from glowsense.py against a recording
+# strip and writes the results as JSON, so numbers from different releases can
+# be compared:
+#
+#   decode      frames/s per frame ID for the compiled decoder, the full
+#               process_datagram() path and (with numpy) decode_batch()
+#   effects     CPU time per rendered frame for each effect on its own
+#   throughput  show() calls per second and CPU share under real time traffic
+#   latency     datagram arrival -> show() of a frame displaying the change,
+#               idle and while the same thread decodes filler traffic, in one
+#               process and with --split's separate render process
+#   cold_start  glowsense.py --cold-start in a fresh interpreter: time per
+#               startup phase and to the first frame on the LEDs, with the
+#               DBC parsed and read from the signal cache
+#
+# Traffic is synthetic (the simulator's drive scenario) or a capture file.
+#
+#   python bench.py --output bench.json --label v1.2
+#   python bench.py --capture drive.cap
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import capture
+import dbc
+import glowsense
+import panda
+import render
+import simulator
+import strips
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def synthetic_frames(db, duration, rates=simulator.DEFAULT_RATES):
+    # [(time, frame ID, payload)] of the simulator scenario, sorted by time.
+    frames = []
+    for frame_id, rate in rates.items():
+        message = db.message(frame_id)
+        for number in range(int(duration * rate)):
+            t = number / rate
+            frames.append((t, frame_id, message.encode(simulator.scenario(t)[frame_id])))
+    frames.sort(key=lambda frame: frame[0])
+    return frames
+
+
+def synthetic_datagrams(db, duration, tick=0.01):
+    # Groups the synthetic frames due in the same `tick` into one datagram: [(time, bytes)].
+    datagrams = []
+    current = None
+    data = []
+    for t, frame_id, payload in synthetic_frames(db, duration):
+        slot = int(t / tick)
+        if slot != current and data:
+            datagrams.append((current * tick, b"".join(data)))
+            data = []
+        current = slot
+        data.append(panda.pack_frame(0, frame_id, payload))
+    if data:
+        datagrams.append((current * tick, b"".join(data)))
+    return datagrams
+
+
+def capture_payloads(reader, frame_ids):
+    payloads = {frame_id: [] for frame_id in frame_ids}
+    for timestamp, bus, frame_id, length, payload in reader.records(frame_ids):
+        payloads[frame_id].append(payload)
+    return payloads
+
+
+def timed_rate(function, count, minimum_time):
+    # Calls function() (which handles `count` frames) until minimum_time passed; frames/s.
+    rounds = 0
+    began = time.perf_counter()
+    while True:
+        function()
+        rounds += 1
+        elapsed = time.perf_counter() - began
+        if elapsed >= minimum_time:
+            return rounds * count / elapsed
+
+
+def reset_state():
+    glowsense.payloadCache.reset()
+    glowsense.vehicle.reset()
+    glowsense.renderer.clear()
+
+
+def bench_decode(payloads, minimum_time):
+    report = {}
+    for frame_id, decoder in sorted(glowsense.decoders.items()):
+        values = payloads.get(frame_id)
+        if not values:
+            continue
+        decode = decoder.decode
+        def decode_all():
+            for value in values:
+                decode(value)
+        datagrams = [panda.pack_frame(0, frame_id, value) for value in values]
+        def process_all():
+            glowsense.payloadCache.reset()
+            for data in datagrams:
+                glowsense.process_datagram(data)
+        entry = {
+            "frames": len(values),
+            "decode_frames_per_s": timed_rate(decode_all, len(values), minimum_time),
+            "pipeline_frames_per_s": timed_rate(process_all, len(values), minimum_time),
+        }
+        if dbc.np is not None:
+            array = dbc.np.array(values, dtype=dbc.np.uint64)
+            entry["batch_frames_per_s"] = timed_rate(lambda: decoder.decode_batch(array), len(values), minimum_time)
+        report["0x%03X" % frame_id] = entry
+    reset_state()
+    return report
+
+
+def bench_effects(frames):
+    renderer = glowsense.renderer
+    glowsense.vehicle.set("SoC", 80)
+    report = {}
+    for name in [None] + sorted(renderer.effects, key=lambda effect: renderer.effects[effect].priority):
+        renderer.clear()
+        if name is not None:
+            renderer.activate(name)
+            # BlindSpot blinks only while the turn signal is on, bench the busier case.
+            turnSignal = getattr(renderer.effects[name], "turn_signal", None)
+            if turnSignal is not None:
+                renderer.activate(turnSignal)
+        now = time.monotonic()
+        began = time.process_time()
+        for number in range(frames):
+            renderer.render_frame(now + number * renderer.interval)
+        report[name or "base"] = {"cpu_us_per_frame": (time.process_time() - began) / frames * 1e6}
+    reset_state()
+    return report
+
+
+def feed(datagrams, duration):
+    # Plays [(time, bytes)] through process_datagram() in real time, looping,
+    # for `duration` seconds. Returns the number of datagrams fed.
+    length = datagrams[-1][0] + 0.01
+    began = time.monotonic()
+    count = 0
+    passes = 0
+    while True:
+        for t, data in datagrams:
+            due = passes * length + t
+            if due >= duration:
+                return count
+            delay = began + due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            glowsense.process_datagram(data)
+            count += 1
+        passes += 1
+
+
+def bench_throughput(datagrams, duration):
+    renderer = glowsense.renderer
+    strip = glowsense.strip
+    shows = strip.shows
+    stats = renderer.framebuffer.stats()
+    renderer.start()
+    began = time.monotonic()
+    cpu = time.process_time()
+    count = feed(datagrams, duration)
+    elapsed = time.monotonic() - began
+    cpu = time.process_time() - cpu
+    renderer.stop()
+    after = renderer.framebuffer.stats()
+    reset_state()
+    return {
+        "seconds": elapsed,
+        "datagrams": count,
+        "shows_per_s": (strip.shows - shows) / elapsed,
+        "skipped_shows_per_s": (after["skipped_shows"] - stats["skipped_shows"]) / elapsed,
+        "cpu_share": cpu / elapsed,
+    }
+
+
+def filler_datagrams(db, frames=8):
+    # Gear changes that pass the payload cache and run the full decode path
+    # without switching any effect.
+    message = db.message(0x118)
+    gears = itertools.cycle(["DI_GEAR_D", "DI_GEAR_R", "DI_GEAR_N"])
+    datagrams = []
+    for number in range(3):
+        datagrams.append(b"".join(panda.pack_frame(0, 0x118, message.encode({"DI_gear": next(gears)}))
+                                  for frame in range(frames)))
+    return itertools.cycle(datagrams)
+
+
+def feed_latency_states(db, samples, spacing, load):
+    # Toggles the autopilot layer (whole strip blue) every `spacing` seconds;
+    # with `load` the time in between is spent decoding filler traffic.
+    message = db.message(0x399)
+    states = [
+        (panda.pack_frame(0, 0x399, message.encode({"DAS_autopilotState": "ACTIVE_NOMINAL"})), glowsense.COLOR_BLUE),
+        (panda.pack_frame(0, 0x399, message.encode({"DAS_autopilotState": "AVAILABLE"})), glowsense.COLOR_DEFAULT),
+    ]
+    filler = filler_datagrams(db) if load else None
+    sent = []
+    for number in range(samples):
+        due = time.monotonic() + spacing
+        if filler is None:
+            time.sleep(spacing)
+        else:
+            while time.monotonic() < due:
+                glowsense.process_datagram(next(filler))
+        data, color = states[number % 2]
+        sent.append((time.monotonic(), color))
+        glowsense.process_datagram(data)
+    time.sleep(spacing)
+    return sent
+
+
+def latency_report(sent, shows, correct):
+    # sent: [(arrival, color)], shows: [(time, probe pixel)]; the latency of a
+    # change is the time to the first show() whose probe pixel displays it.
+    latencies = []
+    position = 0
+    for arrived, color in sent:
+        while position < len(shows) and shows[position][0] < arrived:
+            position += 1
+        for shown, pixel in shows[position:]:
+            if pixel == correct(color):
+                latencies.append((shown - arrived) * 1000)
+                break
+    return {
+        "samples": len(latencies),
+        "min_ms": min(latencies) if latencies else None,
+        "median_ms": percentile(latencies, 0.5),
+        "p95_ms": percentile(latencies, 0.95),
+        "max_ms": max(latencies) if latencies else None,
+    }
+
+
+def bench_latency(db, samples, spacing, load=False):
+    # Datagram handed to process_datagram() -> first show() displaying the new state.
+    renderer = glowsense.renderer
+    strip = glowsense.strip
+    probe = glowsense.LED_COUNT // 2
+    strip.frames.clear()
+    renderer.start()
+    sent = feed_latency_states(db, samples, spacing, load)
+    renderer.stop()
+    shows = [(shown, pixels[probe]) for shown, brightness, pixels in strip.frames]
+    reset_state()
+    return latency_report(sent, shows, renderer.framebuffer.correct)
+
+
+def bench_latency_split(db, samples, spacing, load=False):
+    # Same with glowsense.py --split: the render process logs every show() to
+    # the shared memory link.
+    renderer = glowsense.setup_split("recording")
+    time.sleep(1.0)
+    since = renderer.link.stats()["shows"]
+    sent = feed_latency_states(db, samples, spacing, load)
+    shows = [(shown / 1e9, pixel) for shown, pixel in renderer.link.shows(since)]
+    reset_state()
+    renderer.stop()
+    expected = render.FrameBuffer(strips.NullStrip(1), glowsense.LED_GAMMA)
+    expected.set_brightness(glowsense.LED_BRIGHTNESS)
+    return latency_report(sent, shows, expected.correct)
+
+
+def bench_cold_start():
+    # First run with an empty cache parses the DBC and writes the cache, the second reads it.
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        cachePath = os.path.join(directory, "signals.cache")
+        for name in ("parsed", "cached"):
+            output = subprocess.run([sys.executable, glowsense.__file__, "--cold-start", "--strip", "null",
+                                     "--local-port", "0", "--signal-cache", cachePath, "--flight-dir", directory],
+                                    check=True, capture_output=True, text=True).stdout
+            results[name] = json.loads(output.strip().splitlines()[-1])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GlowSense benchmarks")
+    parser.add_argument("--capture", metavar="FILE", help="use a capture file instead of synthetic traffic")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of real time traffic for the throughput run")
+    parser.add_argument("--decode-time", type=float, default=0.5, help="minimum seconds per decode measurement")
+    parser.add_argument("--effect-frames", type=int, default=2000, help="frames rendered per effect")
+    parser.add_argument("--latency-samples", type=int, default=100, help="state changes for the latency run")
+    parser.add_argument("--skip", action="append", default=[], choices=["decode", "effects", "throughput", "latency", "split", "cold_start"],
+                        help="leave out a benchmark")
+    parser.add_argument("--label", default="", help="free text stored with the results, e.g. the release")
+    parser.add_argument("--output", metavar="FILE", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    dbc.load_numpy()
+    db = dbc.load_dbc(glowsense.DBC_FILE)
+    glowsense.load_zones()
+    glowsense.setup(strips.RecordingStrip(glowsense.LED_COUNT, keep=10000), start=False)
+    # The synthetic traffic sets off the flight recorder triggers; those dumps are not kept.
+    flightDir = tempfile.TemporaryDirectory()
+    glowsense.flightRecorder.directory = flightDir.name
+
+    if args.capture:
+        reader = capture.CaptureReader(args.capture)
+        payloads = capture_payloads(reader, glowsense.decoders)
+        datagrams = []
+        first = None
+        for timestamp, data in reader.datagrams(glowsense.decoders):
+            first = timestamp if first is None else first
+            datagrams.append(((timestamp - first) / 1e9, data))
+        reader.close()
+    else:
+        datagrams = synthetic_datagrams(db, simulator.SCENARIO_LENGTH)
+        payloads = {}
+        for t, frame_id, payload in synthetic_frames(db, simulator.SCENARIO_LENGTH):
+            payloads.setdefault(frame_id, []).append(payload)
+
+    results = {
+        "format": 1,
+        "label": args.label,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "numpy": dbc.np is not None,
+        "traffic": args.capture or "synthetic",
+        "led_count": glowsense.LED_COUNT,
+        "render_fps": glowsense.RENDER_FPS,
+    }
+    if "decode" not in args.skip:
+        results["decode"] = bench_decode(payloads, args.decode_time)
+    if "effects" not in args.skip:
+        results["effects"] = bench_effects(args.effect_frames)
+    if "throughput" not in args.skip and datagrams:
+        results["throughput"] = bench_throughput(datagrams, args.duration)
+    if "latency" not in args.skip:
+        spacing = 2.5 / glowsense.RENDER_FPS
+        results["latency"] = bench_latency(db, args.latency_samples, spacing)
+        results["latency_loaded"] = bench_latency(db, args.latency_samples, spacing, load=True)
+        if "split" not in args.skip:
+            results["latency_split"] = bench_latency_split(db, args.latency_samples, spacing)
+            results["latency_split_loaded"] = bench_latency_split(db, args.latency_samples, spacing, load=True)
+
+    if "cold_start" not in args.skip:
+        results["cold_start"] = bench_cold_start()
+    glowsense.flightRecorder.close()
+    flightDir.cleanup()
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+# Binary capture files of raw Panda frames.
+#
+# Layout (all little endian):
+#   header   "<8sII"   magic b"GLOWCAP\0", version, record size
+#   records  "<QIIQ"   receive time in ns since the epoch, then the raw 16 byte
+#                      Panda frame (header word, info word, payload)
+#   index    written on close: "<III" (frame ID, count, first position) per
+#            frame ID followed by the uint32 record numbers of every ID
+#   footer   "<8sQQQ"  magic b"GLOWIDX\0", index offset, record count, frame ID count
+#
+# Records are fixed size and in time order, so time lookups are a bisect over
+# the memory-mapped records. A capture that was not closed cleanly has no
+# index; the reader then rebuilds it by scanning the records.
+
+import mmap
+import queue
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+import panda
+
+CAPTURE_MAGIC = b"GLOWCAP\0"
+INDEX_MAGIC = b"GLOWIDX\0"
+CAPTURE_VERSION = 1
+FILE_HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<QIIQ")
+RECORD_TIME = struct.Struct("<Q")
+INDEX_ENTRY = struct.Struct("<III")
+FOOTER = struct.Struct("<8sQQQ")
+
+
+class CaptureRecorder:
+    # record() only copies the datagram and queues it; packing and writing
+    # happen on the recorder thread.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, RECORD.size))
+        self.queue = queue.SimpleQueue()
+        self.index = {}
+        self.records = 0
+        self.thread = threading.Thread(target=self.run, name="recorder", daemon=True)
+        self.thread.start()
+
+    def record(self, data, timestamp=None):
+        self.queue.put((time.time_ns() if timestamp is None else timestamp, bytes(data)))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, data = item
+            self.write_datagram(timestamp, data)
+
+    def write_datagram(self, timestamp, data):
+        stamp = RECORD_TIME.pack(timestamp)
+        out = bytearray()
+        usable = len(data) - len(data) % panda.PANDA_FRAME_SIZE
+        for offset in range(0, usable, panda.PANDA_FRAME_SIZE):
+            frame_id = panda.PANDA_HEADER.unpack_from(data, offset)[0] >> 21
+            positions = self.index.get(frame_id)
+            if positions is None:
+                positions = self.index[frame_id] = array("I")
+            positions.append(self.records)
+            self.records += 1
+            out += stamp
+            out += data[offset:offset + panda.PANDA_FRAME_SIZE]
+        self.file.write(out)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        write_index(self.file, self.index, self.records)
+        self.file.close()
+
+
+def write_index(captureFile, index, records):
+    indexOffset = captureFile.tell()
+    position = 0
+    for frame_id in sorted(index):
+        captureFile.write(INDEX_ENTRY.pack(frame_id, len(index[frame_id]), position))
+        position += len(index[frame_id])
+    for frame_id in sorted(index):
+        positions = index[frame_id]
+        if sys.byteorder != "little":
+            positions = array("I", positions)
+            positions.byteswap()
+        captureFile.write(positions.tobytes())
+    captureFile.write(FOOTER.pack(INDEX_MAGIC, indexOffset, records, len(index)))
+
+
+class CaptureReader:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, recordSize = FILE_HEADER.unpack_from(self.map, 0)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION or recordSize != RECORD.size:
+            raise ValueError("%s is not a GlowSense capture file" % path)
+        self.index = None
+        self.count = None
+        size = len(self.map)
+        if size >= FILE_HEADER.size + FOOTER.size:
+            magic, indexOffset, records, ids = FOOTER.unpack_from(self.map, size - FOOTER.size)
+            if magic == INDEX_MAGIC:
+                self.count = records
+                self.index = self._read_index(indexOffset, ids)
+        if self.count is None:
+            self.count = (size - FILE_HEADER.size) // RECORD.size
+
+    def _read_index(self, offset, ids):
+        positionsStart = offset + ids * INDEX_ENTRY.size
+        index = {}
+        for number in range(ids):
+            frame_id, count, position = INDEX_ENTRY.unpack_from(self.map, offset + number * INDEX_ENTRY.size)
+            start = positionsStart + position * 4
+            positions = memoryview(self.map)[start:start + count * 4].cast("I")
+            if sys.byteorder != "little":
+                positions = array("I", positions)
+                positions.byteswap()
+            index[frame_id] = positions
+        return index
+
+    def build_index(self):
+        index = {}
+        for number in range(self.count):
+            frame_id = panda.PANDA_HEADER.unpack_from(self.map, self.offset(number) + 8)[0] >> 21
+            positions = index.get(frame_id)
+            if positions is None:
+                positions = index[frame_id] = array("I")
+            positions.append(number)
+        self.index = index
+        return index
+
+    def offset(self, number):
+        return FILE_HEADER.size + number * RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def frame_ids(self):
+        if self.index is None:
+            self.build_index()
+        return sorted(self.index)
+
+    def timestamp(self, number):
+        return RECORD_TIME.unpack_from(self.map, self.offset(number))[0]
+
+    def record(self, number):
+        # (timestamp ns, bus, frame ID, length, payload)
+        timestamp, header, info, payload = RECORD.unpack_from(self.map, self.offset(number))
+        return timestamp, info >> 4, header >> 21, info & 0x0F, payload
+
+    def find_time(self, timestamp):
+        # Number of the first record at or after `timestamp` (ns).
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def record_numbers(self, frame_ids=None, start=None, end=None):
+        first = 0 if start is None else self.find_time(start)
+        last = self.count if end is None else self.find_time(end)
+        if frame_ids is None:
+            return range(first, last)
+        if self.index is None:
+            self.build_index()
+        selected = []
+        for frame_id in frame_ids:
+            positions = self.index.get(frame_id, ())
+            selected.extend(positions[bisect_left(positions, first):bisect_left(positions, last)])
+        selected.sort()
+        return selected
+
+    def records(self, frame_ids=None, start=None, end=None):
+        for number in self.record_numbers(frame_ids, start, end):
+            yield self.record(number)
+
+    def datagrams(self, frame_ids=None, start=None, end=None):
+        # Regroups frames that arrived together into datagrams: (timestamp ns, bytes).
+        current = None
+        frames = []
+        for number in self.record_numbers(frame_ids, start, end):
+            offset = self.offset(number)
+            timestamp = RECORD_TIME.unpack_from(self.map, offset)[0]
+            if timestamp != current and frames:
+                yield current, b"".join(frames)
+                frames = []
+            current = timestamp
+            frames.append(self.map[offset + 8:offset + RECORD.size])
+        if frames:
+            yield current, b"".join(frames)
+
+    def close(self):
+        self.index = None
+        self.map.close()
+        self.file.close()
+
+
+def replay(reader, on_datagram, speed=1.0, frame_ids=None, start=None, end=None, stop_event=None):
+    # Feeds the capture into on_datagram at `speed` times real time (0 = as fast as
+    # possible). Returns (datagrams, seconds).
+    began = time.monotonic()
+    first = None
+    count = 0
+    for timestamp, data in reader.datagrams(frame_ids, start, end):
+        if stop_event is not None and stop_event.is_set():
+            break
+        if speed > 0:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / 1e9 / speed - (time.monotonic() - began)
+            if delay > 0:
+                time.sleep(delay)
+        on_datagram(data)
+        count += 1
+    return count, time.monotonic() - began
@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+
+# Minimal DBC reader for the signals GlowSense cares about.
+#
+# The file is parsed once (BO_ / SG_ / VAL_ lines only) and every frame ID we
+# listen to gets a generated decoder function with shifts, masks, factors,
+# offsets and value tables baked in as constants. The decoders take the
+# payload as the little endian 64 bit integer produced by struct.unpack("<Q").
+# load_dbc_cached() keeps the parsed messages GlowSense needs in a pickle next
+# to the script, so the file is only parsed again after it changed.
+
+import hashlib
+import os
+import pickle
+import re
+
+# numpy takes seconds to import on a Pi Zero and only the batch paths need it
+# (here and in panda.py), so it is imported by load_numpy() on first use.
+np = None
+
+
+def load_numpy():
+    # Returns numpy, None when it is not installed.
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
+
+SG_PATTERN = re.compile(
+    r'^\s*SG_\s+(\w+)\s*(M|m\d+)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*'
+    r'\(([^,]+),([^)]+)\)\s*\[([^|]*)\|([^\]]*)\]\s*"([^"]*)"'
+)
+BO_PATTERN = re.compile(r'^BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)\s+(\w+)')
+VAL_PATTERN = re.compile(r'^VAL_\s+(\d+)\s+(\w+)\s+(.*);')
+VAL_ENTRY_PATTERN = re.compile(r'(-?\d+)\s+"([^"]*)"')
+
+
+def parse_number(text):
+    value = float(text)
+    if value.is_integer():
+        return int(value)
+    return value
+
+
+class Signal:
+    __slots__ = ("name", "start_bit", "length", "little_endian", "signed", "factor", "offset",
+                 "minimum", "maximum", "unit", "values", "multiplexer", "multiplexer_id")
+
+    def __init__(self, name, start_bit, length, little_endian, signed, factor=1, offset=0,
+                 minimum=0, maximum=0, unit="", multiplexer=False, multiplexer_id=None):
+        self.name = name
+        self.start_bit = start_bit
+        self.length = length
+        self.little_endian = little_endian
+        self.signed = signed
+        self.factor = factor
+        self.offset = offset
+        self.minimum = minimum
+        self.maximum = maximum
+        self.unit = unit
+        self.values = {}
+        self.multiplexer = multiplexer
+        self.multiplexer_id = multiplexer_id
+
+    def shift(self):
+        # Position of the least significant bit, in the integer the signal is read from
+        # (the payload itself for Intel signals, the byte swapped payload for Motorola).
+        if self.little_endian:
+            return self.start_bit
+        msb = (7 - self.start_bit // 8) * 8 + self.start_bit % 8
+        return msb - self.length + 1
+
+    def raw_value(self, value):
+        # Physical value or value table name -> raw integer.
+        if isinstance(value, str):
+            for raw, name in self.values.items():
+                if name == value:
+                    return raw
+            raise KeyError("%s has no value named %s" % (self.name, value))
+        return int(round((value - self.offset) / self.factor))
+
+    def encode(self, value):
+        # Payload bits (little endian payload integer) carrying `value`.
+        bits = (self.raw_value(value) & ((1 << self.length) - 1)) << self.shift()
+        if self.little_endian:
+            return bits
+        return int.from_bytes(bits.to_bytes(8, "big"), "little")
+
+    def payload_mask(self):
+        # Bits of the little endian payload integer this signal is read from.
+        mask = ((1 << self.length) - 1) << self.shift()
+        if self.little_endian:
+            return mask
+        return int.from_bytes(mask.to_bytes(8, "big"), "little")
+
+    def __repr__(self):
+        return "Signal(%s %d|%d@%d%s)" % (self.name, self.start_bit, self.length,
+                                          1 if self.little_endian else 0, "-" if self.signed else "+")
+
+
+class Message:
+    __slots__ = ("frame_id", "name", "length", "sender", "signals")
+
+    def __init__(self, frame_id, name, length, sender):
+        self.frame_id = frame_id
+        self.name = name
+        self.length = length
+        self.sender = sender
+        self.signals = {}
+
+    def encode(self, values):
+        # {signal name: value} -> payload integer; signals not given are zero.
+        payload = 0
+        for name, value in values.items():
+            payload |= self.signals[name].encode(value)
+        return payload
+
+    def multiplexer(self):
+        for signal in self.signals.values():
+            if signal.multiplexer:
+                return signal
+        return None
+
+    def __repr__(self):
+        return "Message(0x%03X %s, %d signals)" % (self.frame_id, self.name, len(self.signals))
+
+
+class Database:
+    def __init__(self):
+        self.messages = {}
+
+    def message(self, frame_id):
+        return self.messages[frame_id]
+
+    def signal(self, frame_id, name):
+        return self.messages[frame_id].signals[name]
+
+
+def load_dbc(path):
+    db = Database()
+    message = None
+    with open(path, "r", encoding="latin-1") as dbcFile:
+        for line in dbcFile:
+            if line.startswith("BO_ "):
+                match = BO_PATTERN.match(line)
+                if match is None:
+                    message = None
+                    continue
+                frame_id = int(match.group(1)) & 0x1FFFFFFF
+                message = Message(frame_id, match.group(2), int(match.group(3)), match.group(4))
+                db.messages[frame_id] = message
+            elif line.startswith(" SG_") and message is not None:
+                match = SG_PATTERN.match(line)
+                if match is None:
+                    continue
+                name, mux, start, length, order, sign, factor, offset, minimum, maximum, unit = match.groups()
+                signal = Signal(name, int(start), int(length), order == "1", sign == "-",
+                                parse_number(factor), parse_number(offset),
+                                parse_number(minimum), parse_number(maximum), unit,
+                                multiplexer=(mux == "M"),
+                                multiplexer_id=int(mux[1:]) if mux and mux != "M" else None)
+                message.signals[name] = signal
+            elif line.startswith("VAL_ "):
+                match = VAL_PATTERN.match(line)
+                if match is None:
+                    continue
+                frame_id = int(match.group(1)) & 0x1FFFFFFF
+                target = db.messages.get(frame_id)
+                if target is None or match.group(2) not in target.signals:
+                    continue
+                values = target.signals[match.group(2)].values
+                for raw, valueName in VAL_ENTRY_PATTERN.findall(match.group(3)):
+                    values[int(raw)] = valueName
+            elif not line.strip():
+                message = None
+    return db
+
+
+#region Cache
+# Bumped when Signal or Message change, so old pickles are not used.
+CACHE_VERSION = 1
+
+
+def load_dbc_cached(path, frame_ids, cache_path):
+    # Database with only the messages `frame_ids`, read from `cache_path` when
+    # it was written for the same DBC contents (SHA-256) and frames, otherwise
+    # parsed and written there. Returns (database, whether the cache was used).
+    with open(path, "rb") as dbcFile:
+        digest = hashlib.sha256(dbcFile.read()).hexdigest()
+    key = (CACHE_VERSION, digest, tuple(sorted(frame_ids)))
+    try:
+        with open(cache_path, "rb") as cacheFile:
+            cached = pickle.load(cacheFile)
+        if cached["key"] == key:
+            db = Database()
+            db.messages = cached["messages"]
+            return db, True
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, KeyError, TypeError, ValueError):
+        pass
+    full = load_dbc(path)
+    db = Database()
+    db.messages = {frame_id: full.messages[frame_id] for frame_id in key[2] if frame_id in full.messages}
+    temporary = cache_path + ".tmp"
+    try:
+        with open(temporary, "wb") as cacheFile:
+            pickle.dump({"key": key, "messages": db.messages}, cacheFile, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, cache_path)
+    except OSError as error:
+        print("Could not write the DBC cache: " + str(error))
+    return db, False
+#endregion
+
+
+#region Decoder compilation
+class CompiledDecoder:
+    __slots__ = ("frame_id", "names", "signals", "multiplexer", "mask", "decode", "decode_raw", "source")
+
+    def __init__(self, frame_id, names, signals, multiplexer, decode, source, decode_raw=None):
+        self.frame_id = frame_id
+        self.names = names
+        self.signals = signals
+        self.multiplexer = multiplexer
+        self.decode = decode
+        # Same signals as decode() but raw integers, without factor, offset or value table.
+        self.decode_raw = decode_raw
+        self.source = source
+        # Union of the payload bits the decoder reads, for change detection.
+        self.mask = 0
+        for signal in signals + ((multiplexer,) if multiplexer is not None else ()):
+            self.mask |= signal.payload_mask()
+
+    def decode_batch(self, payloads):
+        # Vectorized counterpart of decode() for a uint64 array of payloads. Returns one
+        # int64 array of raw values per signal; value tables are not applied here.
+        # Multiplexed signals come back as masked arrays, masked where the mux differs.
+        swapped = payloads.byteswap() if any(not signal.little_endian for signal in self.signals) else None
+        mux = None
+        if self.multiplexer is not None:
+            mux = self._extract(self.multiplexer, payloads, swapped)
+        columns = []
+        for signal in self.signals:
+            raw = self._extract(signal, payloads, swapped)
+            if signal.multiplexer_id is not None:
+                raw = np.ma.masked_array(raw, mask=(mux != signal.multiplexer_id))
+            columns.append(raw)
+        return tuple(columns)
+
+    @staticmethod
+    def changed_rows(columns):
+        # Indices of the rows whose decoded values differ from the previous row (row 0 included).
+        changed = np.zeros(len(columns[0]), dtype=bool)
+        changed[0] = True
+        for column in columns:
+            data = np.ma.getdata(column)
+            changed[1:] |= data[1:] != data[:-1]
+            if np.ma.isMaskedArray(column):
+                mask = np.ma.getmaskarray(column)
+                changed[1:] |= mask[1:] != mask[:-1]
+        return np.flatnonzero(changed)
+
+    @staticmethod
+    def _extract(signal, payloads, swapped):
+        source = payloads if signal.little_endian else swapped
+        raw = ((source >> np.uint64(signal.shift())) & np.uint64((1 << signal.length) - 1)).astype(np.int64)
+        if signal.signed:
+            raw = np.where(raw >= (1 << (signal.length - 1)), raw - (1 << signal.length), raw)
+        return raw
+
+    def raw_row(self, columns, index):
+        # One row of decode_batch() output as the tuple decode_raw() returns.
+        return tuple(None if column[index] is np.ma.masked else int(column[index]) for column in columns)
+
+    def row(self, columns, index):
+        # Turns one row of decode_batch() output into the same tuple decode() returns.
+        values = []
+        for signal, column in zip(self.signals, columns):
+            if column[index] is np.ma.masked:
+                values.append(None)
+                continue
+            raw = int(column[index])
+            value = raw
+            if signal.factor != 1:
+                value = value * signal.factor
+            if signal.offset != 0:
+                value = value + signal.offset
+            values.append(signal.values.get(raw, value))
+        return tuple(values)
+
+    def __repr__(self):
+        return "CompiledDecoder(0x%03X, %s)" % (self.frame_id, ", ".join(self.names))
+
+
+def signal_expression(signal, var, namespace):
+    # Returns the statements assigning the raw value to `var` and the expression
+    # turning it into the physical value (or value table name).
+    source = "swapped" if not signal.little_endian else "data"
+    mask = (1 << signal.length) - 1
+    shift = signal.shift()
+    if shift:
+        raw = "(%s >> %d) & 0x%X" % (source, shift, mask)
+    else:
+        raw = "%s & 0x%X" % (source, mask)
+    lines = ["    %s = %s" % (var, raw)]
+    if signal.signed:
+        lines.append("    if %s >= 0x%X: %s -= 0x%X" % (var, 1 << (signal.length - 1), var, 1 << signal.length))
+
+    value = var
+    if signal.factor != 1:
+        value = "%s * %r" % (value, signal.factor)
+    if signal.offset != 0:
+        value = "%s + %r" % (value, signal.offset)
+    if signal.values:
+        namespace["T_" + var] = signal.values
+        value = "T_%s.get(%s, %s)" % (var, var, value)
+    return lines, value
+
+
+def compile_decoder(message, wanted):
+    # wanted: list of (output name, signal name) pairs, all belonging to `message`.
+    namespace = {}
+    names = []
+    signals = []
+    body = []
+    values = []
+    raws = []
+    multiplexer = message.multiplexer()
+    if not any(message.signals[signalName].multiplexer_id is not None for _, signalName in wanted):
+        multiplexer = None
+    if any(not message.signals[signalName].little_endian for _, signalName in wanted):
+        body.append("    swapped = int.from_bytes(data.to_bytes(8, 'little'), 'big')")
+    if multiplexer is not None:
+        lines, _ = signal_expression(multiplexer, "mux", namespace)
+        body.extend(lines)
+
+    for index, (outputName, signalName) in enumerate(wanted):
+        signal = message.signals[signalName]
+        lines, value = signal_expression(signal, "v%d" % index, namespace)
+        body.extend(lines)
+        raw = "v%d" % index
+        if signal.multiplexer_id is not None:
+            value = "(%s) if mux == %d else None" % (value, signal.multiplexer_id)
+            raw = "%s if mux == %d else None" % (raw, signal.multiplexer_id)
+        names.append(outputName)
+        signals.append(signal)
+        values.append(value)
+        raws.append(raw)
+
+    body = "\n".join(body)
+    source = "def decode_%d(data):\n%s\n    return (%s,)\n" % (message.frame_id, body, ", ".join(values))
+    source += "\ndef decode_raw_%d(data):\n%s\n    return (%s,)\n" % (message.frame_id, body, ", ".join(raws))
+    exec(source, namespace)
+    return CompiledDecoder(message.frame_id, tuple(names), tuple(signals), multiplexer, namespace["decode_%d" % message.frame_id],
+                           source, namespace["decode_raw_%d" % message.frame_id])
+
+
+def compile_decoders(db, wanted):
+    # wanted: {output name: (frame id, signal name)}. Returns {frame id: CompiledDecoder}.
+    byFrame = {}
+    for outputName, (frame_id, signalName) in wanted.items():
+        if frame_id not in db.messages:
+            raise KeyError("Frame 0x%03X is not defined in the DBC" % frame_id)
+        if signalName not in db.messages[frame_id].signals:
+            raise KeyError("Signal %s is not part of frame 0x%03X" % (signalName, frame_id))
+        byFrame.setdefault(frame_id, []).append((outputName, signalName))
+
+    return {frame_id: compile_decoder(db.messages[frame_id], entries) for frame_id, entries in byFrame.items()}
+
+
+class PayloadCache:
+    # Remembers the last relevant payload bits per frame ID so frames that would
+    # decode to the same values can be dropped with a single compare.
+    def __init__(self, decoders):
+        self.masks = {frame_id: decoder.mask for frame_id, decoder in decoders.items()}
+        self.last = {}
+        self.hits = 0
+        self.misses = 0
+
+    def changed(self, frame_id, data):
+        relevant = data & self.masks[frame_id]
+        if self.last.get(frame_id) == relevant:
+            self.hits += 1
+            return False
+        self.last[frame_id] = relevant
+        self.misses += 1
+        return True
+
+    def reset(self):
+        self.last.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+#endregion
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+
+# Decodes recorded drives into columnar files for analysis (blind spot
+# warnings per hour, hands-on escalations, SoC curves, ...).
+#
+# Input is a capture file (glowsense.py --record) or a text dump of the
+# doPrint output. Every signal the DBC defines for the selected frames is
+# decoded with the same compiled decoders as the live path (glowsense.py's
+# DBC and value names), in NumPy batches of --chunk frames, so the memory
+# used does not grow with the length of the drive.
+#
+# One file per frame ID is written to the output directory, with a "time"
+# column (ns since the epoch) and one column per signal:
+#   parquet  needs pyarrow; multiplexed signals are null when not selected
+#   npz      numeric values (value tables as codes); multiplexed signals get
+#            a "<signal>_valid" column
+#   csv      value names and physical values, also works without numpy
+#
+#   python export.py drive.cap drive/
+#   python export.py --frames 0x399,0x33A --format csv glowsense.log drive/
+
+import argparse
+import csv
+import os
+import re
+import tempfile
+import time
+import zipfile
+
+import capture
+import dbc
+import glowsense
+
+np = dbc.load_numpy()
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CHUNK_FRAMES = 1 << 18
+# print_frame() output: "<ms> can<bus> <ID>#<8 bytes in binary, first byte first>"
+TEXT_FRAME = re.compile(r"^(\d+) can(\d+) ([0-9A-Fa-f]+)#((?:[01]{8} ?){1,8})")
+
+if np is not None:
+    CAPTURE_RECORD = np.dtype([("time", "<u8"), ("header", "<u4"), ("info", "<u4"), ("payload", "<u8")])
+
+
+#region Input
+def is_capture(path):
+    with open(path, "rb") as inputFile:
+        return inputFile.read(len(capture.CAPTURE_MAGIC)) == capture.CAPTURE_MAGIC
+
+
+def text_frames(path, frame_ids, bus=None):
+    # (time ns, frame ID, payload) of the frame lines in a doPrint dump; other lines are skipped.
+    with open(path, "r", errors="replace") as textFile:
+        for line in textFile:
+            match = TEXT_FRAME.match(line)
+            if match is None:
+                continue
+            frame_id = int(match.group(3), 16)
+            if frame_id not in frame_ids or (bus is not None and int(match.group(2)) != bus):
+                continue
+            payload = int.from_bytes(bytes(int(bits, 2) for bits in match.group(4).split()), "little")
+            yield int(match.group(1)) * 1000000, frame_id, payload
+
+
+def capture_frames(path, frame_ids, bus=None):
+    reader = capture.CaptureReader(path)
+    try:
+        for timestamp, frameBus, frame_id, length, payload in reader.records(frame_ids):
+            if bus is None or frameBus == bus:
+                yield timestamp, frame_id, payload
+    finally:
+        reader.close()
+
+
+def frames(path, frame_ids, bus=None):
+    if is_capture(path):
+        return capture_frames(path, frame_ids, bus)
+    return text_frames(path, frame_ids, bus)
+
+
+def capture_chunks(path, frame_ids, bus=None, size=CHUNK_FRAMES):
+    # (times, frame IDs, payloads) arrays of up to `size` records, read straight
+    # from the memory-mapped capture without building its index.
+    reader = capture.CaptureReader(path)
+    selected = np.array(sorted(frame_ids), dtype=np.uint32)
+    try:
+        for first in range(0, len(reader), size):
+            yield capture_chunk(reader, first, min(size, len(reader) - first), selected, bus)
+    finally:
+        reader.close()
+
+
+def capture_chunk(reader, first, count, selected, bus):
+    # Fancy indexing copies, so nothing points into the map once this returns.
+    records = np.frombuffer(reader.map, CAPTURE_RECORD, count, reader.offset(first))
+    ids = records["header"] >> 21
+    selectedRows = np.isin(ids, selected)
+    if bus is not None:
+        selectedRows &= (records["info"] >> 4) == bus
+    rows = np.flatnonzero(selectedRows)
+    return records["time"][rows], ids[rows], records["payload"][rows]
+
+
+def text_chunks(path, frame_ids, bus=None, size=CHUNK_FRAMES):
+    chunk = []
+    for frame in text_frames(path, frame_ids, bus):
+        chunk.append(frame)
+        if len(chunk) == size:
+            yield chunk_arrays(chunk)
+            chunk = []
+    if chunk:
+        yield chunk_arrays(chunk)
+
+
+def chunk_arrays(chunk):
+    times, ids, payloads = zip(*chunk)
+    return np.array(times, dtype=np.uint64), np.array(ids, dtype=np.uint32), np.array(payloads, dtype=np.uint64)
+
+
+def chunks(path, frame_ids, bus=None, size=CHUNK_FRAMES):
+    if is_capture(path):
+        return capture_chunks(path, frame_ids, bus, size)
+    return text_chunks(path, frame_ids, bus, size)
+#endregion
+
+
+#region Output
+def physical(signal, column):
+    # decode_batch() raw column -> physical values; value table codes stay codes.
+    if signal.factor != 1:
+        column = column * signal.factor
+    if signal.offset != 0:
+        column = column + signal.offset
+    return column
+
+
+def column_dtype(signal):
+    if isinstance(signal.factor, float) or isinstance(signal.offset, float):
+        return np.dtype("<f8")
+    return np.dtype("<i8")
+
+
+class CsvWriter:
+    extension = "csv"
+
+    def __init__(self, path, decoder):
+        self.decoder = decoder
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(("time",) + decoder.names)
+
+    def write(self, times, columns):
+        for row in range(len(times)):
+            self.write_row(int(times[row]), self.decoder.row(columns, row))
+
+    def write_row(self, timestamp, values):
+        self.writer.writerow([timestamp] + ["" if value is None else value for value in values])
+
+    def close(self):
+        self.file.close()
+
+
+class NpzWriter:
+    # np.savez needs whole arrays, so the columns are streamed to temporary
+    # files and copied into the .npz entries once their length is known.
+    extension = "npz"
+
+    def __init__(self, path, decoder):
+        self.path = path
+        self.decoder = decoder
+        self.rows = 0
+        self.columns = [("time", np.dtype("<i8"))]
+        for name, signal in zip(decoder.names, decoder.signals):
+            self.columns.append((name, column_dtype(signal)))
+            if signal.multiplexer_id is not None:
+                self.columns.append((name + "_valid", np.dtype("?")))
+        self.files = [tempfile.TemporaryFile() for column in self.columns]
+
+    def write(self, times, columns):
+        arrays = [times.astype(np.int64)]
+        for signal, column in zip(self.decoder.signals, columns):
+            arrays.append(np.ma.getdata(physical(signal, column)))
+            if signal.multiplexer_id is not None:
+                arrays.append(~np.ma.getmaskarray(column))
+        for columnFile, (name, dtype), array in zip(self.files, self.columns, arrays):
+            columnFile.write(array.astype(dtype, copy=False).tobytes())
+        self.rows += len(times)
+
+    def close(self):
+        with zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for columnFile, (name, dtype) in zip(self.files, self.columns):
+                columnFile.seek(0)
+                with archive.open(name + ".npy", "w", force_zip64=True) as entry:
+                    np.lib.format.write_array_header_1_0(entry, {
+                        "descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (self.rows,)})
+                    while True:
+                        block = columnFile.read(1 << 20)
+                        if not block:
+                            break
+                        entry.write(block)
+                columnFile.close()
+
+
+class ParquetWriter:
+    extension = "parquet"
+
+    def __init__(self, path, decoder):
+        self.decoder = decoder
+        fields = [pyarrow.field("time", pyarrow.int64())]
+        for name, signal in zip(decoder.names, decoder.signals):
+            fields.append(pyarrow.field(name, pyarrow.from_numpy_dtype(column_dtype(signal))))
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, times, columns):
+        arrays = [pyarrow.array(times.astype(np.int64))]
+        for signal, column in zip(self.decoder.signals, columns):
+            values = np.ma.getdata(physical(signal, column)).astype(column_dtype(signal), copy=False)
+            mask = np.ma.getmaskarray(column) if signal.multiplexer_id is not None else None
+            arrays.append(pyarrow.array(values, mask=mask))
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {"csv": CsvWriter, "npz": NpzWriter, "parquet": ParquetWriter}
+#endregion
+
+
+def all_signal_decoders(db, frame_ids):
+    # Decoders for every signal of the given frames, named as in the DBC.
+    return {frame_id: dbc.compile_decoder(db.message(frame_id), [(name, name) for name in db.message(frame_id).signals])
+            for frame_id in frame_ids}
+
+
+class Export:
+    # Opens one writer per frame ID the first time the frame shows up.
+    def __init__(self, directory, decoders, writer):
+        self.directory = directory
+        self.decoders = decoders
+        self.writer = writer
+        self.writers = {}
+        self.counts = {}
+
+    def output(self, frame_id):
+        output = self.writers.get(frame_id)
+        if output is None:
+            name = "0x%03X_%s.%s" % (frame_id, glowsense.db.message(frame_id).name, self.writer.extension)
+            output = self.writers[frame_id] = self.writer(os.path.join(self.directory, name), self.decoders[frame_id])
+            self.counts[frame_id] = 0
+        return output
+
+    def decode_chunk(self, times, ids, payloads):
+        for frame_id in np.unique(ids):
+            rows = np.flatnonzero(ids == frame_id)
+            frame_id = int(frame_id)
+            self.output(frame_id).write(times[rows], self.decoders[frame_id].decode_batch(payloads[rows]))
+            self.counts[frame_id] += len(rows)
+
+    def decode_frame(self, timestamp, frame_id, payload):
+        # Without numpy (CSV only).
+        self.output(frame_id).write_row(timestamp, self.decoders[frame_id].decode(payload))
+        self.counts[frame_id] += 1
+
+    def close(self):
+        for output in self.writers.values():
+            output.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode GlowSense captures or frame dumps to columnar files")
+    parser.add_argument("input", help="capture file (--record) or text dump of the doPrint output")
+    parser.add_argument("output", help="directory for the files, one per frame ID")
+    parser.add_argument("--frames", help="comma separated frame IDs (default: the frames glowsense.py decodes)")
+    parser.add_argument("--signals", choices=["all", "live"], default="all",
+                        help="every DBC signal of the frames, or only the ones glowsense.py decodes (default %(default)s)")
+    parser.add_argument("--bus", type=int, help="only frames from this bus")
+    parser.add_argument("--format", choices=["auto"] + sorted(WRITERS), default="auto",
+                        help="output format; auto is parquet with pyarrow, npz with numpy, csv otherwise")
+    parser.add_argument("--chunk", type=int, default=CHUNK_FRAMES, help="frames decoded per batch (default %(default)s)")
+    args = parser.parse_args()
+
+    outputFormat = args.format
+    if outputFormat == "auto":
+        outputFormat = "parquet" if pyarrow is not None and np is not None else "npz" if np is not None else "csv"
+    if outputFormat != "csv" and np is None:
+        parser.error("%s output needs numpy" % outputFormat)
+    if outputFormat == "parquet" and pyarrow is None:
+        parser.error("parquet output needs pyarrow")
+
+    # The whole DBC, --signals all can ask for any frame in it.
+    glowsense.load_signals("")
+    if args.frames:
+        frame_ids = [int(frame_id, 0) for frame_id in args.frames.split(",")]
+    else:
+        frame_ids = sorted(glowsense.decoders)
+    for frame_id in frame_ids:
+        if frame_id not in glowsense.db.messages:
+            parser.error("frame 0x%03X is not defined in the DBC" % frame_id)
+    if args.signals == "live":
+        missing = [frame_id for frame_id in frame_ids if frame_id not in glowsense.decoders]
+        if missing:
+            parser.error("glowsense.py does not decode " + ", ".join("0x%03X" % frame_id for frame_id in missing))
+        decoders = {frame_id: glowsense.decoders[frame_id] for frame_id in frame_ids}
+    else:
+        decoders = all_signal_decoders(glowsense.db, frame_ids)
+
+    os.makedirs(args.output, exist_ok=True)
+    export = Export(args.output, decoders, WRITERS[outputFormat])
+    began = time.perf_counter()
+    try:
+        if np is not None:
+            for times, ids, payloads in chunks(args.input, decoders, args.bus, args.chunk):
+                export.decode_chunk(times, ids, payloads)
+        else:
+            for timestamp, frame_id, payload in frames(args.input, decoders, args.bus):
+                export.decode_frame(timestamp, frame_id, payload)
+    finally:
+        export.close()
+    seconds = time.perf_counter() - began
+
+    total = sum(export.counts.values())
+    for frame_id, count in sorted(export.counts.items()):
+        print("0x%03X %s: %d frames" % (frame_id, glowsense.db.message(frame_id).name, count))
+    print("Decoded %d frames to %s (%s) in %.2fs, %.0f frames/s" % (total, args.output, outputFormat, seconds,
+                                                                    total / seconds if seconds else 0))
+
+if __name__ == "__main__":
+    main()
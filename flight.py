@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+# Flight recorder: the last seconds of raw frames and state changes, kept in
+# memory and written out only when something went wrong.
+#
+# Frames go into a preallocated ring of raw 16 byte Panda frames (one slice
+# copy per datagram) with a parallel ring of receive times; state changes go
+# into parallel arrays of time, field index and raw value. Nothing is
+# allocated per frame and nothing touches the SD card until dump() is called,
+# which takes slice copies of the rings and leaves picking the last seconds
+# out of them and writing them to a background thread as
+#   <time>-<reason>.cap          capture file, replayable with --replay
+#   <time>-<reason>.states.csv   time, field, value of every state change
+
+import csv
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+import capture
+import panda
+
+
+def unroll(ring, count, capacity, size=1):
+    # Copy of a ring of `capacity` entries of `size` items after `count`
+    # writes, oldest entry first.
+    if count < capacity:
+        return ring[:count * size]
+    slot = count % capacity
+    return ring[slot * size:] + ring[:slot * size]
+
+
+class FlightRecorder:
+    # Keeps up to `capacity` frames and `changes` state changes; a dump holds
+    # the ones from the last `seconds` seconds. trigger() dumps `after` seconds
+    # later, so the dump also shows what happened next.
+    def __init__(self, directory, seconds=30.0, capacity=1 << 15, changes=1 << 13, state=None):
+        self.directory = directory
+        self.seconds = seconds
+        self.capacity = capacity
+        self.frames = bytearray(capacity * panda.PANDA_FRAME_SIZE)
+        self.times = array("Q", [0]) * capacity
+        self.count = 0
+        self.state = state
+        self.changeCapacity = changes
+        self.changeTimes = array("Q", [0]) * changes
+        self.changeFields = array("I", [0]) * changes
+        self.changeValues = array("q", [0]) * changes
+        self.changeKnown = array("B", [0]) * changes
+        self.changeCount = 0
+        # Between the receive thread and dump() (pending trigger, SIGUSR1).
+        self.lock = threading.Lock()
+        # threading.Timer of a trigger that is not dumped yet.
+        self.pending = None
+        self.writer = None
+        self.dumps = 0
+
+    #region Recording (receive thread)
+    def record(self, data, timestamp=None):
+        timestamp = time.time_ns() if timestamp is None else timestamp
+        size = panda.PANDA_FRAME_SIZE
+        view = memoryview(data)
+        frameCount = len(view) // size
+        if frameCount > self.capacity:
+            view = view[(frameCount - self.capacity) * size:]
+            frameCount = self.capacity
+        with self.lock:
+            slot = self.count % self.capacity
+            first = min(frameCount, self.capacity - slot)
+            self.frames[slot * size:(slot + first) * size] = view[:first * size]
+            self.times[slot:slot + first] = array("Q", [timestamp]) * first
+            if first < frameCount:
+                self.frames[:(frameCount - first) * size] = view[first * size:frameCount * size]
+                self.times[:frameCount - first] = array("Q", [timestamp]) * (frameCount - first)
+            self.count += frameCount
+
+    def record_changes(self, fields):
+        # state.VehicleState.on_change() listener.
+        timestamp = time.time_ns()
+        with self.lock:
+            for field, value in fields:
+                slot = self.changeCount % self.changeCapacity
+                self.changeTimes[slot] = timestamp
+                self.changeFields[slot] = field
+                self.changeKnown[slot] = value is not None
+                self.changeValues[slot] = 0 if value is None else value
+                self.changeCount += 1
+    #endregion
+
+    def trigger(self, reason, after=0.0):
+        # Dumps `after` seconds from now (on a timer thread, also when no more
+        # frames come in); a trigger while one is pending is ignored.
+        if self.pending is not None:
+            return
+        if after <= 0:
+            self.dump(reason)
+            return
+        self.pending = threading.Timer(after, self._dump_pending, args=(reason,))
+        self.pending.daemon = True
+        self.pending.start()
+
+    def close(self):
+        # Drops a pending trigger and waits for the last dump to be written.
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        if self.writer is not None:
+            self.writer.join()
+
+    def _dump_pending(self, reason):
+        self.pending = None
+        self.dump(reason)
+
+    def dump(self, reason):
+        # Copies the rings and writes the last seconds of them on a thread; returns the capture path.
+        with self.lock:
+            frames = (self.count, array("Q", self.times), bytes(self.frames))
+            changes = (self.changeCount, array("Q", self.changeTimes), array("I", self.changeFields),
+                       array("q", self.changeValues), array("B", self.changeKnown))
+        self.dumps += 1
+        name = "%s-%d-%s" % (time.strftime("%Y%m%d-%H%M%S"), self.dumps, re.sub(r"\W+", "_", reason).strip("_") or "dump")
+        path = os.path.join(self.directory, name + ".cap")
+        print("Flight recorder: dumping the last %g s (%s) to %s" % (self.seconds, reason, path))
+        writer = threading.Thread(target=self._write, args=(path, frames, changes), name="flight", daemon=True)
+        writer.start()
+        self.writer = writer
+        return path
+
+    def _frames(self, copy):
+        # (times, frame bytes) in receive order, oldest first.
+        count, times, data = copy
+        size = panda.PANDA_FRAME_SIZE
+        return unroll(times, count, self.capacity), unroll(data, count, self.capacity, size)
+
+    def _changes(self, copy):
+        # [(time, field, raw value or None)] in order, oldest first.
+        count = copy[0]
+        times, fields, values, known = [unroll(ring, count, self.changeCapacity) for ring in copy[1:]]
+        return [(timestamp, field, value if isKnown else None)
+                for timestamp, field, value, isKnown in zip(times, fields, values, known)]
+
+    def _write(self, path, frames, changes):
+        # Writer thread: keeps what was recorded in the last `seconds` before the newest frame.
+        times, data = self._frames(frames)
+        changes = self._changes(changes)
+        newest = times[-1] if times else time.time_ns()
+        cutoff = newest - int(self.seconds * 1e9)
+        # Receive order is time order.
+        first = bisect_left(times, cutoff)
+        size = panda.PANDA_FRAME_SIZE
+        times, data = times[first:], data[first * size:]
+        changes = changes[bisect_left([change[0] for change in changes], cutoff):]
+        os.makedirs(self.directory, exist_ok=True)
+        index = {}
+        with open(path, "wb") as captureFile:
+            captureFile.write(capture.FILE_HEADER.pack(capture.CAPTURE_MAGIC, capture.CAPTURE_VERSION, capture.RECORD.size))
+            for number, timestamp in enumerate(times):
+                frame = data[number * size:(number + 1) * size]
+                frame_id = panda.PANDA_HEADER.unpack_from(frame)[0] >> 21
+                index.setdefault(frame_id, array("I")).append(number)
+                captureFile.write(capture.RECORD_TIME.pack(timestamp))
+                captureFile.write(frame)
+            capture.write_index(captureFile, index, len(times))
+        if self.state is None:
+            return
+        with open(path[:-len(".cap")] + ".states.csv", "w", newline="") as statesFile:
+            writer = csv.writer(statesFile)
+            writer.writerow(("time", "field", "value"))
+            for timestamp, field, value in changes:
+                writer.writerow((timestamp, self.state.names[field], self.state.physical(field, value)))
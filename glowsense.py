@@ -1,32 +1,50 @@
 #!/usr/bin/python3
 
-import socket
-import struct
+import argparse
+import asyncio
 import time
-import threading
 import json
-from rpi_ws281x import PixelStrip, Color
+import multiprocessing
+import os
+import signal
+import capture
+import dbc
+import flight
+import ipc
+import metrics
+import panda
+import render
+import rules
+import state
+import strips
+import zones
+from strips import Color
 
 #region CAN Decoding
 targetIP = '192.168.4.1'
 targetPort = 1338
 
-framesToFilter = [
-    [0, 0x3f5],
-    [0, 0x399],
-    [0, 0x33A],
-    [0, 0x204],
-    [0, 0x273],
-    [0, 0x118],
-]
-
-LED_COUNT = 159
-LED_PIN = 18
+# Bus the decoded frames are requested from. Which frames is worked out from
+# the loaded rules (see required_filters()).
+CAN_BUS = 0
+
+# Decode whole datagrams with NumPy instead of frame by frame (needs numpy).
+BATCH_DECODE = False
+# Drain all queued datagrams per wakeup (recvmmsg on Linux) into reused buffers.
+BULK_RECEIVE = True
+# Kernel receive buffer (SO_RCVBUF) so bursts are not dropped while we are busy.
+RECV_BUFFER_SIZE = 1 << 20
+
 LED_FREQ_HZ = 800000
 LED_DMA = 10
 LED_BRIGHTNESS = 180
+# Gamma of the LEDs; the COLOR_* values below are corrected with it on output.
+LED_GAMMA = 2.2
+# Ignore display brightness changes smaller than this (0-255), fade larger ones.
+BRIGHTNESS_HYSTERESIS = 3
+BRIGHTNESS_FADE_TIME = 0.5
 LED_INVERT = False
-LED_CHANNEL = 0
+RENDER_FPS = 50
 
 COLOR_DEFAULT = Color(255, 40, 0)
 COLOR_BLUE = Color(0, 0, 255)
@@ -35,598 +53,629 @@ COLOR_YELLOW = Color(255, 150, 0)
 COLOR_GREEN = Color(0, 255, 0)
 COLOR_NONE = Color(0, 0, 0)
 
-CURRENT_BASE = COLOR_DEFAULT
+# Names the effects in rules.json can use for colors.
+COLORS = {
+    "DEFAULT": COLOR_DEFAULT,
+    "BLUE": COLOR_BLUE,
+    "RED": COLOR_RED,
+    "YELLOW": COLOR_YELLOW,
+    "GREEN": COLOR_GREEN,
+    "NONE": COLOR_NONE,
+}
 
-LED_TURNSIGNAL_LENGTH = 12
-LED_BLINDSPOT_LENGTH = 7
+DBC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Model3CAN.dbc")
+# Parsed messages of DBC_FILE for the frames below, rebuilt when the DBC changes.
+SIGNAL_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "signals.cache")
+# Seconds from process start to the first frame on the LEDs that startup should stay under.
+COLD_START_BUDGET = 2.0
+# Channels (pins, LED counts) and the named LED zones on them.
+ZONES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zones.json")
+# LED regions, effects and the signal conditions turning them on.
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")
+# Flight recorder dumps (on errors, SIGUSR1 and the "flight_recorder" triggers in rules.json).
+FLIGHT_RECORDER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flight")
+FLIGHT_RECORDER_SECONDS = 30
+FLIGHT_RECORDER_FRAMES = 1 << 15
+
+# State field name -> (frame ID, DBC signal name). Adding a signal is a line here.
+signalsToDecode = {
+    "Left Turn Signal Status": (0x3F5, "VCFRONT_indicatorLeftRequest"),
+    "Right Turn Signal Status": (0x3F5, "VCFRONT_indicatorRightRequest"),
+    "Autopilot Hands-On Status": (0x399, "DAS_autopilotHandsOnState"),
+    "Autopilot State": (0x399, "DAS_autopilotState"),
+    "Blindspot Rear Left Status": (0x399, "DAS_blindSpotRearLeft"),
+    "Blindspot Rear Right Status": (0x399, "DAS_blindSpotRearRight"),
+    "Forward Collision Warning": (0x399, "DAS_forwardCollisionWarning"),
+    "SoC": (0x33A, "UI_SOC"),
+    "Charge Status": (0x204, "PCS_chgPwmEnableLine"),
+    "Display Brightness": (0x273, "UI_displayBrightnessLevel"),
+    "Lock Status": (0x273, "UI_globalUnlockOn"),
+    "Gear Status": (0x118, "DI_gear"),
+}
 
-def extractValue(data_, valuedef):
-    data = data_
-    if valuedef['byteorder'] == 'little':
-        pass
-    elif valuedef['byteorder'] == 'big':
-        tmpdata = struct.pack("<Q", data_)
-        data = struct.unpack(">Q", tmpdata)[0]
+# Value names the DBC does not know about.
+valueNameOverrides = {
+    (0x399, "DAS_autopilotState"): {6: "FSD?"},
+}
 
-    calculatedValue = ((1 << valuedef['bitlength']) - 1) & (data >> valuedef['bitstart'])
-    if (valuedef['signed']):
-        if (calculatedValue > pow(2, valuedef['bitlength']-1)):
-            calculatedValue = 0 - (pow(2, valuedef['bitlength']) - calculatedValue)
-        calculatedValue = float(calculatedValue) * valuedef['factor'] + valuedef['offset']
+def load_database(path, cache_path=None):
+    # With a cache path only the frames in signalsToDecode are loaded (see dbc.load_dbc_cached()).
+    # Returns (database, whether the cache was used).
+    if cache_path:
+        db, cached = dbc.load_dbc_cached(path, {frame_id for frame_id, signalName in signalsToDecode.values()}, cache_path)
     else:
-        calculatedValue = float(calculatedValue) * valuedef['factor'] + valuedef['offset']
-    return calculatedValue
-
-def get_bit_data(frame, start_bit, length, factor=1, offset=0):
-    signal = extractValue(frame, {'byteorder': 'little', 'bitlength': length, 'bitstart': start_bit, 'signed': False, 'factor': factor, 'offset': offset})
-    return signal
-
-def process_signal(raw_signal, value_map):
-    result = value_map.get(raw_signal, "UNKNOWN")
-    return result
-
-def parse_turn_signals(turn_signal_frame):
-    left_turn_signal_start_bit = 0
-    left_turn_signal_length = 2
-    right_turn_signal_start_bit = 2
-    right_turn_signal_length = 2
-
-    turn_signal_value_map = {
-        2: "TURN_SIGNAL_ACTIVE_HIGH",
-        1: "TURN_SIGNAL_ACTIVE_LOW",
-        0: "TURN_SIGNAL_OFF"
-    }
-
-    raw_left_turn_signal = get_bit_data(turn_signal_frame, left_turn_signal_start_bit, left_turn_signal_length)
-    raw_right_turn_signal = get_bit_data(turn_signal_frame, right_turn_signal_start_bit, right_turn_signal_length)
-    left_turn_signal_status = process_signal(raw_left_turn_signal, turn_signal_value_map)
-    right_turn_signal_status = process_signal(raw_right_turn_signal, turn_signal_value_map)
-
-    return left_turn_signal_status, right_turn_signal_status
-
-def parse_soc(soc_frame):
-    soc_start_bit = 27 #maybe 27|7
-    soc_signal_length = 7
-
-    soc = get_bit_data(soc_frame, soc_start_bit, soc_signal_length)
-
-    return soc
-
-def parse_gear(drive_system_status_frame):
-    gear_start_bit = 21
-    gear_signal_length = 3
-
-    gear_value_map = {
-        7: "DI_GEAR_SNA",
-        6: "",
-        5: "",
-        4: "DI_GEAR_D",
-        3: "DI_GEAR_N",
-        2: "DI_GEAR_R",
-        1: "DI_GEAR_P",
-        0: "DI_GEAR_INVALID"
-    }
-
-    raw_gear = get_bit_data(drive_system_status_frame, gear_start_bit, gear_signal_length)
-    gear_status = process_signal(raw_gear, gear_value_map)
-
-    return gear_status
-
-def parse_lock(ui_frame):
-    lock_start_bit = 15
-    lock_signal_length = 1
-
-    lock_status = get_bit_data(ui_frame, lock_start_bit, lock_signal_length)
-
-    return lock_status
-
-def parse_brightness(ui_frame):
-    brightness_start_bit = 32
-    brightness_signal_length = 8
-    brightness_factor = 0.5
-    brightness_offset = 0
-
-    brightness = get_bit_data(ui_frame, brightness_start_bit, brightness_signal_length, brightness_factor, brightness_offset)
-
-    return brightness
-
-def parse_charge_status(charge_status_frame):
-    charge_status_start_bit = 56
-    charge_status_signal_length = 1
-
-    charge_status = get_bit_data(charge_status_frame, charge_status_start_bit, charge_status_signal_length)
-
-    return charge_status
-
-def parse_autopilot_and_blindspot_signals(autopilot_blindspot_frame):
-    autopilot_hands_on_start_bit = 42
-    autopilot_hands_on_length = 4
-    autopilot_state_start_bit = 0
-    autopilot_state_length = 4
-    blindspot_rear_left_start_bit = 4
-    blindspot_rear_left_length = 2
-    blindspot_rear_right_start_bit = 6
-    blindspot_rear_right_length = 2
-    forward_collision_warning_start_bit = 22
-    forward_collision_warning_length = 2
-
-    autopilot_hands_on_value_map = {
-            0: "LC_HANDS_ON_NOT_REQD",
-            1: "LC_HANDS_ON_REQD_DETECTED",
-            2: "LC_HANDS_ON_REQD_NOT_DETECTED",
-            3: "LC_HANDS_ON_REQD_VISUAL",
-            4: "LC_HANDS_ON_REQD_CHIME_1",
-            5: "LC_HANDS_ON_REQD_CHIME_2",
-            6: "LC_HANDS_ON_REQD_SLOWING",
-            7: "LC_HANDS_ON_REQD_STRUCK_OUT",
-            8: "LC_HANDS_ON_SUSPENDED",
-            9: "LC_HANDS_ON_REQD_ESCALATED_CHIME_1",
-            10: "LC_HANDS_ON_REQD_ESCALATED_CHIME_2",
-            15: "LC_HANDS_ON_SNA"
-    }
-
-    autopilot_state_value_map = {
-            0: "DISABLED",
-            1: "UNAVAILABLE",
-            2: "AVAILABLE",
-            3: "ACTIVE_NOMINAL",
-            4: "ACTIVE_RESTRICTED",
-            5: "ACTIVE_NAV",
-            6: "FSD?",
-            8: "ABORTING",
-            9: "ABORTED",
-            14: "FAULT",
-            15: "SNA"
-    }
-
-    blindspot_value_map = {
-            0: "NO_WARNING",
-            1: "WARNING_LEVEL_1",
-            2: "WARNING_LEVEL_2",
-            3: "SNA"
-    }
-
-    forward_collision_warning_value_map = {
-            0: "NONE",
-            1: "FORWARD_COLLISION_WARNING",
-            3: "SNA"
-    }
-
-    raw_autopilot_hands_on = get_bit_data(autopilot_blindspot_frame, autopilot_hands_on_start_bit, autopilot_hands_on_length)
-    raw_autopilot_state = get_bit_data(autopilot_blindspot_frame, autopilot_state_start_bit, autopilot_state_length)
-    raw_blindspot_rear_left = get_bit_data(autopilot_blindspot_frame, blindspot_rear_left_start_bit, blindspot_rear_left_length)
-    raw_blindspot_rear_right = get_bit_data(autopilot_blindspot_frame, blindspot_rear_right_start_bit, blindspot_rear_right_length)
-    raw_forward_collision_warning = get_bit_data(autopilot_blindspot_frame, forward_collision_warning_start_bit, forward_collision_warning_length)
-
-    autopilot_hands_on_status = process_signal(raw_autopilot_hands_on, autopilot_hands_on_value_map)
-    autopilot_state_status = process_signal(raw_autopilot_state, autopilot_state_value_map)
-    blindspot_rear_left_status = process_signal(raw_blindspot_rear_left, blindspot_value_map)
-    blindspot_rear_right_status = process_signal(raw_blindspot_rear_right, blindspot_value_map)
-    forward_collision_warning_status = process_signal(raw_forward_collision_warning, forward_collision_warning_value_map)
-
-    return autopilot_hands_on_status, autopilot_state_status, blindspot_rear_left_status, blindspot_rear_right_status, forward_collision_warning_status
+        db, cached = dbc.load_dbc(path), False
+    for (frame_id, signalName), names in valueNameOverrides.items():
+        db.signal(frame_id, signalName).values.update(names)
+    return db, cached
+
+# Nothing is loaded on import; load_signals() and load_zones() (or setup())
+# fill these in.
+db = None
+decoders = {}
+vehicle = None
+flightRecorder = None
+payloadCache = None
+frameParser = panda.PandaFrameParser()
+zoneMap = None
+LED_COUNT = 0
+
+def load_signals(cache_path=SIGNAL_CACHE_FILE):
+    # DBC -> compiled decoders, vehicle state and its listeners. An empty
+    # cache path parses the whole DBC (e.g. for export.py). Returns whether
+    # the cache was used.
+    global db, decoders, vehicle, flightRecorder, payloadCache
+    db, cached = load_database(DBC_FILE, cache_path)
+    decoders = dbc.compile_decoders(db, signalsToDecode)
+    vehicle = state.VehicleState(decoders)
+    flightRecorder = flight.FlightRecorder(FLIGHT_RECORDER_DIR, FLIGHT_RECORDER_SECONDS, FLIGHT_RECORDER_FRAMES, state=vehicle)
+    payloadCache = dbc.PayloadCache(decoders)
+    vehicle.on_change(flightRecorder.record_changes)
+    vehicle.on_change(share_values)
+    vehicle.on_reset(share_values)
+    vehicle.subscribe("Display Brightness", on_display_brightness)
+    vehicle.on_change(on_vehicle_change)
+    return cached
+
+zonesFile = None
+
+def load_zones(path=ZONES_FILE):
+    global zoneMap, LED_COUNT, zonesFile
+    zoneMap = zones.load_zones(path)
+    zonesFile = path
+    LED_COUNT = zoneMap.count
 #endregion
 
-#region Panda Connection
-doshutdown = False
-def heartbeatFunction():
-    while True:
-        time.sleep(3)
-        print("heartbeat")
-        sock.sendto(b"ehllo", (targetIP, targetPort))
-        if doshutdown:
-            break
-
-def parsePandaPacket(data):
-    packetStart = 0
-    headerbytes = data[packetStart:packetStart + 8]
-
-    packetStart = packetStart + 8
-
-    unpackedHeader = struct.unpack('<II', headerbytes)
-    frameID = unpackedHeader[0] >> 21
-
-    frameLength = unpackedHeader[1] & 0x0F
-    frameBusId = unpackedHeader[1] >> 4
-    frameData = data[packetStart:packetStart+8]
+#region Metrics
+# Off until an endpoint is opened with --metrics-port / --metrics-socket, then
+# switchable at runtime with GET /enable and /disable (see metrics.py).
+metricsRegistry = metrics.Registry(enabled=False)
+STAGE_HELP = "Time spent per pipeline stage"
+parseTime = metricsRegistry.histogram("stage_seconds", STAGE_HELP, stage="parse")
+decodeTime = metricsRegistry.histogram("stage_seconds", STAGE_HELP, stage="decode")
+# VehicleState.update() with its listeners; the rules are timed by RuleTable.tick().
+stateTime = metricsRegistry.histogram("stage_seconds", STAGE_HELP, stage="state")
+batchTime = metricsRegistry.histogram("stage_seconds", STAGE_HELP, stage="decode_batch")
+frameCounters = {}
+unknownCounters = {}
+
+def count_frame(frameID, count=1):
+    counter = frameCounters.get(frameID)
+    if counter is None:
+        counter = frameCounters[frameID] = metricsRegistry.counter("frames_total", "Frames received per frame ID", id="0x%03X" % frameID)
+    counter.inc(count)
+
+def count_unknown(frameID, count=1):
+    # Frames without a decoder (e.g. left over from before a filter change); always counted.
+    counter = unknownCounters.get(frameID)
+    if counter is None:
+        counter = unknownCounters[frameID] = metricsRegistry.counter("unknown_frames_total", "Frames without a decoder per frame ID", id="0x%03X" % frameID)
+    counter.inc(count)
+
+def collect_metrics():
+    # Read when the metrics are scraped, so these cost nothing on the hot paths.
+    if app is not None:
+        for name, seconds in app.phases:
+            yield "startup_seconds", "gauge", "Time per startup phase", {"phase": name}, seconds
+        if app.firstLight is not None:
+            yield "first_light_seconds", "gauge", "Time from process start to the first frame on the LEDs", {}, app.firstLight
+    if vehicle is not None:
+        cache = payloadCache.stats()
+        yield "payload_cache_hits_total", "counter", "Frames dropped because the relevant bits did not change", {}, cache["hits"]
+        yield "payload_cache_misses_total", "counter", "Frames that were decoded", {}, cache["misses"]
+        yield "state_sequence", "counter", "Vehicle state updates", {}, vehicle.sequence()
+    if renderer is not None:
+        frames = renderer.framebuffer.stats()
+        yield "shows_total", "counter", "show() calls", {}, frames["shows"]
+        yield "skipped_shows_total", "counter", "Render ticks without a change", {}, frames["skipped_shows"]
+        yield "lut_builds_total", "counter", "Color table rebuilds", {}, frames["lut_builds"]
+        for name, count in sorted(renderer.activations.items()):
+            yield "effect_activations_total", "counter", "Times an effect was switched on", {"effect": name}, count
+    if client is not None:
+        yield "connection_state", "gauge", "Current connection state", {"state": str(client.state)}, 1
+        if client.receiver is not None:
+            received = client.receiver.stats()
+            yield "datagrams_total", "counter", "Datagrams received", {}, received["datagrams"]
+            yield "receive_wakeups_total", "counter", "Socket wakeups", {}, received["wakeups"]
+            yield "dropped_datagrams_total", "counter", "Datagrams the kernel dropped", {}, received["dropped"]
+            yield "truncated_datagrams_total", "counter", "Datagrams larger than a receive slot", {}, received["truncated"]
+
+metricsRegistry.collector(collect_metrics)
+#endregion
 
-    return (frameBusId, frameID, frameLength, frameData)
+#region Panda Connection
+client = None
+
+def print_stats():
+    print("heartbeat, payload cache hits %(hits)d misses %(misses)d" % payloadCache.stats(), end='')
+    print(", shows %(shows)d skipped %(skipped_shows)d" % renderer.framebuffer.stats(), end='')
+    if client is not None and client.receiver is not None:
+        print(", datagrams %(datagrams)d dropped %(dropped)d truncated %(truncated)d" % client.receiver.stats(), end='')
+    unknown = sum(counter.value for counter in unknownCounters.values())
+    if unknown:
+        print(", unknown frames %d" % unknown, end='')
+    print("")
+
+def on_connection_state(state):
+    print("Connection " + state)
+    if state == "connected":
+        renderer.flash(COLOR_GREEN, *statusRegion)
+        payloadCache.reset()
+        # The idle filters do not bring back what the idle condition reads
+        # from other frames (e.g. the gear), so that is kept like in set_idle_mode().
+        vehicle.reset(keep=idleCondition.fields if idleMode else ())
+    elif state in ("refused", "invalid", "error"):
+        if state == "error":
+            flightRecorder.dump("error")
+        renderer.clear()
+        renderer.flash(COLOR_RED, 0, LED_COUNT)
+    elif state == "lost":
+        renderer.clear()
+        renderer.flash(COLOR_RED, *statusRegion)
 #endregion
 
 #region LED configuration
-
-signal_threads = {
-    "left_turn": {"event": threading.Event(), "thread": None},
-    "right_turn": {"event": threading.Event(), "thread": None},
-    "left_blindspot": {"event": threading.Event(), "thread": None},
-    "right_blindspot": {"event": threading.Event(), "thread": None},
-    "charging": {"event": threading.Event(), "thread": None},
-    "hands_on": {"event": threading.Event(), "thread": None},
-    "forward_collision": {"event": threading.Event(), "thread": None},
-    "autopilot": {"event": threading.Event(), "thread": None},
-}
-
-strip = PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
-strip.begin()
-
-def set_strip_color(color, start=0, end=LED_COUNT):
-    for i in range(start, end):
-        strip.setPixelColor(i, color)
-    strip.show()
-
-def turn_off_strip():
-    for i in range(strip.numPixels()):
-        strip.setPixelColor(i, Color(0, 0, 0))
-    strip.show()
-
-def clear_strip(start=0, end=LED_COUNT):
-    set_strip_color(CURRENT_BASE, start, end)
-
-def default_base_strip():
-    global CURRENT_BASE
-    CURRENT_BASE = COLOR_DEFAULT
-    set_strip_color(COLOR_DEFAULT)
-
-def autopilot_base_strip():
-    global CURRENT_BASE
-    CURRENT_BASE = COLOR_BLUE
-    set_strip_color(COLOR_BLUE)
-
-default_base_strip()
-
+strip = None
+renderer = None
+ruleTable = None
+# LEDs flashing the connection state ("status" region in rules.json).
+statusRegion = None
+
+def setup(ledStrip, start=True):
+    # Creates the renderer and the effects and rules from rules.json on `ledStrip`
+    # (see strips.py), loading the zones and signals first if that did not happen yet.
+    global strip, renderer
+    load_defaults()
+    strip = ledStrip
+    strip.begin()
+    config = rules.load_rules(RULES_FILE)
+    renderer = render.Renderer(strip, COLOR_DEFAULT, RENDER_FPS, LED_GAMMA, BRIGHTNESS_FADE_TIME, BRIGHTNESS_HYSTERESIS,
+                               metricsRegistry)
+    renderer.set_brightness(LED_BRIGHTNESS, fade=False)
+    apply_rules(config)
+    if start:
+        renderer.start()
+    return renderer
+
+def load_defaults():
+    if zoneMap is None:
+        load_zones()
+    if vehicle is None:
+        load_signals()
+
+def apply_rules(config):
+    # Builds the effects, the rule table, the idle condition and the flight
+    # recorder triggers of a rules.json config.
+    global ruleTable, idleCondition, idleFrames, dumpTriggers, dumpDelay, statusRegion
+    condition = None
+    frames = []
+    if "idle" in config:
+        condition = rules.Condition(config["idle"]["when"], db, signalsToDecode, vehicle)
+        frames = [int(frame_id, 0) for frame_id in config["idle"]["frames"]]
+    triggers = []
+    recorderConfig = config.get("flight_recorder", {})
+    for when in recorderConfig.get("dump_on", []):
+        triggers.append([" ".join(when), rules.Condition(when, db, signalsToDecode, vehicle), False])
+    status = (LED_COUNT - 5, LED_COUNT)
+    if "status" in config["regions"]:
+        status = rules.region(config, "status", zoneMap)
+    table = rules.RuleTable(config, db, signalsToDecode, vehicle, renderer, zoneMap, COLORS, metricsRegistry)
+    if ruleTable is not None:
+        ruleTable.close()
+    # One assignment, so the render thread sees either the old or the new effects.
+    renderer.effects = table.effects
+    table.start()
+    ruleTable, idleCondition, idleFrames, statusRegion = table, condition, frames, status
+    dumpTriggers, dumpDelay = triggers, recorderConfig.get("after", 0.0)
+
+def reload_rules():
+    # SIGHUP: reads rules.json again and updates the effects and CAN filters.
+    # A broken file keeps the rules that were loaded.
+    print("Reloading " + RULES_FILE)
+    try:
+        apply_rules(rules.load_rules(RULES_FILE))
+    except (OSError, ValueError, KeyError) as error:
+        print("Keeping the old rules: " + str(error))
+        return
+    if isinstance(renderer, ipc.RemoteRenderer):
+        renderer.reload()
+    renderer.clear()
+    ruleTable.refresh()
+    idle = idleCondition is not None and idleCondition.evaluate(vehicle.current[1])
+    if idle != idleMode:
+        set_idle_mode(idle)
+    elif client is not None:
+        client.set_filters(required_filters(idleMode))
+    print("Filtering " + " ".join("0x%03X" % frame_id for bus, frame_id in required_filters(idleMode)))
+
+def required_filters(idle=False):
+    # [bus, frame ID] for the frames carrying a signal the rules, the effects,
+    # the idle condition or a subscriber reads; in idle mode only the idle frames.
+    if idle:
+        return [[CAN_BUS, frame_id] for frame_id in sorted(idleFrames)]
+    fields = set(ruleTable.fields)
+    fields.update(vehicle.subscribed())
+    if idleCondition is not None:
+        fields.update(idleCondition.fields)
+    for reason, condition, active in dumpTriggers:
+        fields.update(condition.fields)
+    return [[CAN_BUS, frame_id] for frame_id in vehicle.frames(fields)]
 #endregion
 
-results = {
-            "Left Turn Signal Status": "UNKNOWN",
-            "Right Turn Signal Status": "UNKNOWN",
-            "Autopilot Hands-On Status": "UNKNOWN",
-            "Autopilot State": "UNKNOWN",
-            "Blindspot Rear Left Status": "UNKNOWN",
-            "Blindspot Rear Right Status": "UNKNOWN",
-            "SoC": "UNKNOWN",
-            "Charge Status": "UNKNOWN",
-            "Gear Status": "UNKNOWN",
-            "Lock Status": "UNKNOWN"
-        }
-
-#region LED functions
-def leftTurnSignal(stop_event, blindspot_event):
-    color = COLOR_GREEN
-    start_led = LED_COUNT - LED_TURNSIGNAL_LENGTH
-    end_led = LED_COUNT
-    running = False
-    while not stop_event.is_set():
-        is_left_blindspot_active = (
-            signal_threads["left_blindspot"]["thread"] is not None and
-            signal_threads["left_blindspot"]["thread"].is_alive()
-        )
-        if is_left_blindspot_active:
-            end_led = (LED_COUNT-LED_BLINDSPOT_LENGTH)
-        else:
-            end_led = LED_COUNT
-
-        running = True
-        set_strip_color(color, start_led, end_led)
-        time.sleep(0.45)
-        clear_strip(start_led, end_led)
-        time.sleep(0.45)
-
-    if running == True:
-        clear_strip(start_led, end_led)
-        running = False
-
-def rightTurnSignal(stop_event, blindspot_event):
-    color = COLOR_GREEN
-    start_led = 0
-    end_led = LED_TURNSIGNAL_LENGTH
-    running = False
-    while not stop_event.is_set():
-        is_right_blindspot_active = (
-            signal_threads["right_blindspot"]["thread"] is not None and
-            signal_threads["right_blindspot"]["thread"].is_alive()
-        )
-        if is_right_blindspot_active:
-            start_led = LED_BLINDSPOT_LENGTH
-        else:
-            start_led = 0
-
-        running = True
-        set_strip_color(color, start_led, end_led)
-        time.sleep(0.45)
-        clear_strip(start_led, end_led)
-        time.sleep(0.45)
-
-    if running == True:
-        clear_strip(start_led, end_led)
-        running = False
-
-def leftBlindSpot(stop_event):
-    running = False
-    while not stop_event.is_set():
-        is_left_signal_active = (
-            signal_threads["left_turn"]["thread"] is not None and
-            signal_threads["left_turn"]["thread"].is_alive()
-        )
-
-        running = True
-        if is_left_signal_active:
-            set_strip_color(COLOR_RED, start=(LED_COUNT-LED_BLINDSPOT_LENGTH), end=LED_COUNT)
-            time.sleep(0.15)
-            set_strip_color(COLOR_NONE, start=(LED_COUNT-LED_BLINDSPOT_LENGTH), end=LED_COUNT)
-            time.sleep(0.15)
-        else:
-            set_strip_color(COLOR_RED, start=(LED_COUNT-LED_BLINDSPOT_LENGTH), end=LED_COUNT)
-
-    if running == True:
-        set_strip_color(CURRENT_BASE, start=(LED_COUNT-LED_BLINDSPOT_LENGTH), end=LED_COUNT)
-        running = False
-
-
-def rightBlindSpot(stop_event):
-    running = False
-    while not stop_event.is_set():
-        is_right_signal_active = (
-            signal_threads["right_turn"]["thread"] is not None and
-            signal_threads["right_turn"]["thread"].is_alive()
-        )
-
-        running = True
-        if is_right_signal_active:
-            set_strip_color(COLOR_RED, start=0, end=LED_BLINDSPOT_LENGTH)
-            time.sleep(0.15)
-            set_strip_color(COLOR_NONE, start=0, end=LED_BLINDSPOT_LENGTH)
-            time.sleep(0.15)
-        else:
-            set_strip_color(COLOR_RED, start=0, end=LED_BLINDSPOT_LENGTH)
-
-    if running == True:
-        set_strip_color(CURRENT_BASE, start=0, end=LED_BLINDSPOT_LENGTH)
-        running = False
-
-def autopilot(stop_event):
-    running = False
-    while not stop_event.is_set():
-        if running == False:
-            running = True
-            autopilot_base_strip()
-
-    if running == True:
-        default_base_strip()
-        running = False
-
-def handsOnAlert(stop_event):
-    running = False
-    while not stop_event.is_set():
-        running = True
-        set_strip_color(COLOR_BLUE)
-        time.sleep(0.5)
-        set_strip_color(COLOR_NONE)
-        time.sleep(0.5)
-
-    if running == True:
-        clear_strip()
-        running = False
-
-
-def forwardCollisionAlert(stop_event):
-    running = False
-    while not stop_event.is_set():
-        running = True
-        set_strip_color(COLOR_RED)
-        time.sleep(0.15)
-        set_strip_color(COLOR_NONE)
-        time.sleep(0.15)
-
-    if running == True:
-        clear_strip()
-        running = False
-
-def charging(stop_event):
-    running = False
-    while not stop_event.is_set():
-        running = True
-        soc = results["SoC"]
-        soc = min(int(soc), 100)
-
-        num_lit_leds = int((soc / 100.0) * LED_COUNT)
-        for brightness in range(130, 25, -5):
-            for i in range(LED_COUNT - num_lit_leds, LED_COUNT):
-                strip.setPixelColor(i, Color(0, brightness, 0))
-            strip.show()
-            time.sleep(0.05)
-
-        time.sleep(1)
-
-        for brightness in range(25, 130, 5):
-            for i in range(LED_COUNT - num_lit_leds, LED_COUNT):
-                strip.setPixelColor(i, Color(0, brightness, 0))
-            strip.show()
-            time.sleep(0.05)
-
-        time.sleep(0.2)
-
-    if running == True:
-        default_base_strip()
-        running = False
-
+#region Split mode
+# --split: receiving, decoding and the rules stay in this process, the
+# compositor and the strip run in a render process fed through an ipc.Link, so
+# neither waits for the other's share of the GIL.
+sharedLink = None
+
+def share_values(fields=()):
+    if sharedLink is not None:
+        sharedLink.write_values(vehicle.current[1])
+
+def setup_split(backend, start=True):
+    global renderer, sharedLink
+    load_defaults()
+    link = ipc.Link(len(vehicle.names))
+    # Pixel logged with every show() for the latency benchmark.
+    link.words[ipc.PROBE] = LED_COUNT // 2
+    receiver, doorbell = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=render_process, args=(link.spec(), backend, receiver, zonesFile, RULES_FILE),
+                                      name="render", daemon=True)
+    renderer = ipc.RemoteRenderer(link, doorbell, process, RENDER_FPS)
+    renderer.set_brightness(LED_BRIGHTNESS, fade=False)
+    apply_rules(rules.load_rules(RULES_FILE))
+    sharedLink = link
+    link.write_values(vehicle.current[1])
+    if start:
+        renderer.start()
+    return renderer
+
+def render_process(spec, backend, doorbell, zones_path, rules_path):
+    # Runs in the render process: builds the effects from rules.json and
+    # applies the commands of the ingest process until it stops. Started with
+    # spawn or forkserver nothing is loaded yet, so the zones and signals are
+    # loaded here first.
+    global strip, renderer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if zoneMap is None:
+        load_zones(zones_path)
+    if vehicle is None:
+        load_signals()
+    link = ipc.Link(*spec)
+    strip = ipc.LoggedStrip(strips.open_channels(backend, zoneMap.channels, LED_FREQ_HZ, LED_DMA, LED_INVERT, 255), link)
+    strip.begin()
+    renderer = render.Renderer(strip, COLOR_DEFAULT, RENDER_FPS, LED_GAMMA, BRIGHTNESS_FADE_TIME, BRIGHTNESS_HYSTERESIS)
+    renderer.set_brightness(LED_BRIGHTNESS, fade=False)
+
+    def value(name):
+        field = vehicle.index[name]
+        return vehicle.physical(field, link.read_value(field))
+
+    def load_effects():
+        try:
+            effects = rules.build_effects(rules.load_rules(rules_path), zoneMap, COLORS, value)
+        except (OSError, ValueError, KeyError) as error:
+            print("Render process keeps the old effects: " + str(error))
+            return
+        renderer.clear()
+        renderer.effects = {effect.name: effect for effect in effects}
+
+    load_effects()
+    renderer.start()
+    try:
+        ipc.serve(link, renderer, doorbell, load_effects)
+    finally:
+        renderer.stop()
+        link.close()
+#endregion
 
+def on_display_brightness(raw):
+    global LED_BRIGHTNESS
+    brightness = vehicle.value("Display Brightness")
+    if brightness not in (None, "SNA"):
+        brightness = 5 if brightness < 10 else brightness
+        LED_BRIGHTNESS = int(min(brightness, 100) / 100 * 255)
+        renderer.set_brightness(LED_BRIGHTNESS)
+
+#region Idle mode
+# Parked and locked (see "idle" in rules.json): only the frames needed to
+# notice the car waking up are requested and the renderer sleeps until
+# something changes. Leaving idle mode adds the filters back at once.
+idleMode = False
+idleCondition = None
+idleFrames = []
+
+def set_idle_mode(idle):
+    global idleMode
+    idleMode = idle
+    print("Idle mode " + ("on" if idle else "off"))
+    payloadCache.reset()
+    if idle:
+        for frame_id in decoders:
+            if frame_id not in idleFrames:
+                vehicle.forget(frame_id, keep=idleCondition.fields)
+    if client is not None:
+        client.set_filters(required_filters(idle))
+    renderer.max_sleep = None if idle else 1.0
+
+def on_vehicle_change(fields):
+    check_dump_triggers(fields)
+    if idleCondition is None:
+        return
+    for field, value in fields:
+        if field in idleCondition.fields:
+            idle = idleCondition.evaluate(vehicle.current[1])
+            if idle != idleMode:
+                set_idle_mode(idle)
+            return
 #endregion
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-random_port_offset = 0
-used_port = targetPort+random_port_offset
-print("Using port " + str(used_port))
-print("Socket timeout " + str(5))
-sock.settimeout(5)
-sock.bind(("0.0.0.0", used_port))
+#region Flight recorder
+# [reason, rules.Condition, holding] per "dump_on" entry; a dump is triggered
+# when the condition starts to hold and written dumpDelay seconds later.
+dumpTriggers = []
+dumpDelay = 0.0
+
+def check_dump_triggers(fields):
+    for trigger in dumpTriggers:
+        reason, condition, active = trigger
+        if not any(field in condition.fields for field, value in fields):
+            continue
+        trigger[2] = condition.evaluate(vehicle.current[1])
+        if trigger[2] and not active:
+            flightRecorder.trigger(reason, dumpDelay)
+#endregion
 
-while True:
+def process_datagram_batch(data):
+    buses, frameIDs, lengths, payloads = frameParser.columns(data)
+    if (doPrint):
+        for frameBusId, frameID, unpackedData in zip(buses.tolist(), frameIDs.tolist(), payloads.tolist()):
+            print_frame(frameBusId, frameID, unpackedData)
+    counted = metricsRegistry.enabled
+    for frameID, rows in frameParser.frames_by_id(frameIDs):
+        if counted:
+            count_frame(frameID, int(rows.sum()))
+        decoder = decoders.get(frameID)
+        if decoder is None:
+            count_unknown(frameID, int(rows.sum()))
+            continue
+        framePayloads = payloads[rows]
+        columns = decoder.decode_batch(framePayloads)
+        for row in decoder.changed_rows(columns):
+            if not payloadCache.changed(frameID, int(framePayloads[row])):
+                continue
+            vehicle.update(frameID, decoder.raw_row(columns, row))
+
+if BATCH_DECODE and dbc.load_numpy() is None:
+    print("numpy is not installed, falling back to per-frame decoding")
+    BATCH_DECODE = False
+
+doPrint = False
+
+def print_frame(frameBusId, frameID, payload):
+    print (int(time.time() * 1000), end='')
+    print(" ", end='')
+    print("can%d " % (frameBusId), end='')
+    print("{0:03X}#".format(frameID), end='')
+
+    for payloadByte in payload.to_bytes(8, "little"):
+        print("{0:08b}".format(payloadByte), end=' ')
+    print("")
+
+def process_datagram_timed(data):
+    # process_datagram() with every stage timed, used while metrics are enabled.
+    if BATCH_DECODE:
+        began = time.perf_counter()
+        process_datagram_batch(data)
+        batchTime.observe(time.perf_counter() - began)
+        return
+
+    began = time.perf_counter()
+    frames = list(frameParser.iter_frames(data))
+    parseTime.observe(time.perf_counter() - began)
+    for frameBusId, frameID, frameLength, unpackedData in frames:
+        if (doPrint):
+            print_frame(frameBusId, frameID, unpackedData)
+
+        count_frame(frameID)
+        decoder = decoders.get(frameID)
+        if decoder is None:
+            count_unknown(frameID)
+            continue
+        if not payloadCache.changed(frameID, unpackedData):
+            continue
+        began = time.perf_counter()
+        raws = decoder.decode_raw(unpackedData)
+        decoded = time.perf_counter()
+        vehicle.update(frameID, raws)
+        decodeTime.observe(decoded - began)
+        stateTime.observe(time.perf_counter() - decoded)
+
+def process_datagram(data):
+    if metricsRegistry.enabled:
+        process_datagram_timed(data)
+        return
+
+    if BATCH_DECODE:
+        process_datagram_batch(data)
+        return
+
+    for frameBusId, frameID, frameLength, unpackedData in frameParser.iter_frames(data):
+        if (doPrint):
+            print_frame(frameBusId, frameID, unpackedData)
+
+        decoder = decoders.get(frameID)
+        if decoder is None:
+            count_unknown(frameID)
+            continue
+        if not payloadCache.changed(frameID, unpackedData):
+            continue
+        vehicle.update(frameID, decoder.decode_raw(unpackedData))
+
+async def run_client():
+    # SIGHUP reloads rules.json without reconnecting, SIGUSR1 dumps the flight recorder.
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_rules)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, flightRecorder.dump, "SIGUSR1")
+    await client.run()
+
+#region Startup
+# Startup in phases, each timed; together they are the cold start from the
+# process starting to the first frame on the LEDs ("first light"), which is
+# what people see when the car wakes up:
+#   imports   interpreter start and module imports, until main()
+#   zones     zones.json
+#   signals   DBC -> decoders and vehicle state (from SIGNAL_CACHE_FILE when the DBC did not change)
+#   lights    strip (opened only now), renderer and rules, until the first show()
+#   connect   filters and the Panda client, after the first light
+app = None
+
+def process_uptime():
+    # Seconds since this process started (Linux), None where unknown.
     try:
-        print("sending cancel")
-        sock.sendto(str.encode("bye"), (targetIP, targetPort))
-        print("sending ehllo")
-        sock.sendto(str.encode("ehllo"), (targetIP, targetPort))
-        data, addr = sock.recvfrom(1024)
-        parsedData = parsePandaPacket(data)
-
-        if parsedData[0] == 15 and parsedData[1] == 6:
-            for i in range(LED_COUNT-5, LED_COUNT):
-                strip.setPixelColor(i, COLOR_GREEN)
-            strip.show()
-            time.sleep(0.3)
-            clear_strip()
-            x = threading.Thread(target=heartbeatFunction)
-            x.start()
-            for filterEntry in framesToFilter:
-                filterData = struct.pack("!BBH", 0x0F, filterEntry[0], filterEntry[1] )
-                print("Filter: " + str(filterData))
-                sock.sendto(filterData, (targetIP, targetPort))
-
-            doPrint = False
-
-            while True:
-                try:
-                    #print(json.dumps(results))
-                    data, addr = sock.recvfrom(1024)
-                    dataLength = len(data)
-                    packetStart = 0
-
-                    while packetStart < dataLength:
-                        headerbytes = data[packetStart:packetStart + 8]
-
-                        packetStart = packetStart + 8
-
-                        unpackedHeader = struct.unpack('<II', headerbytes)
-                        frameID = unpackedHeader[0] >> 21
-
-                        frameLength = unpackedHeader[1] & 0x0F
-                        frameBusId = unpackedHeader[1] >> 4
-                        frameData = data[packetStart:packetStart+8]
-
-                        if (doPrint):
-                            print (int(time.time() * 1000), end='')
-                            print(" ", end='')
-                            print("can%d " % (frameBusId), end='')
-                            print("{0:03X}#".format(frameID), end='')
-
-                            for payloadByte in frameData:
-                                print("{0:08b}".format(payloadByte), end=' ')
-                            print("")
-
-                        unpackedData = struct.unpack("<Q", frameData)[0]
-
-                        if(frameID == 1013):
-                            results["Left Turn Signal Status"], results["Right Turn Signal Status"] = parse_turn_signals(unpackedData)
-                            if results["Left Turn Signal Status"] in ["TURN_SIGNAL_ACTIVE_HIGH","TURN_SIGNAL_ACTIVE_LOW"]:
-                                if signal_threads["left_turn"]["thread"] is None or not signal_threads["left_turn"]["thread"].is_alive():
-                                    signal_threads["left_turn"]["event"].clear()
-                                    signal_threads["left_turn"]["thread"] = threading.Thread(target=leftTurnSignal, args=(signal_threads["left_turn"]["event"], signal_threads["left_blindspot"]["event"]))
-                                    signal_threads["left_turn"]["thread"].start()
-                            else:
-                                signal_threads["left_turn"]["event"].set()
-
-                            if results["Right Turn Signal Status"] in ["TURN_SIGNAL_ACTIVE_HIGH","TURN_SIGNAL_ACTIVE_LOW"]:
-                                if signal_threads["right_turn"]["thread"] is None or not signal_threads["right_turn"]["thread"].is_alive():
-                                    signal_threads["right_turn"]["event"].clear()
-                                    signal_threads["right_turn"]["thread"] = threading.Thread(target=rightTurnSignal, args=(signal_threads["right_turn"]["event"], signal_threads["right_blindspot"]["event"]))
-                                    signal_threads["right_turn"]["thread"].start()
-                            else:
-                                signal_threads["right_turn"]["event"].set()
-                        elif(frameID == 921):
-                            autopilot_hands_on_status, autopilot_state_status, blindspot_rear_left_status, blindspot_rear_right_status, forward_collision_warning_status = parse_autopilot_and_blindspot_signals(unpackedData)
-                            results["Autopilot Hands-On Status"] = autopilot_hands_on_status
-                            results["Autopilot State"] = autopilot_state_status
-                            results["Blindspot Rear Left Status"] = blindspot_rear_left_status
-                            results["Blindspot Rear Right Status"] = blindspot_rear_right_status
-                            results["Forward Collision Warning"]= forward_collision_warning_status
-
-                            if results["Autopilot State"] in ["ACTIVE_NOMINAL","ACTIVE_RESTRICTED","ACTIVE_NAV","FSD?"]:
-                                if signal_threads["autopilot"]["thread"] is None or not signal_threads["autopilot"]["thread"].is_alive():
-                                    signal_threads["autopilot"]["event"].clear()
-                                    signal_threads["autopilot"]["thread"] = threading.Thread(target=autopilot, args=(signal_threads["autopilot"]["event"],))
-                                    signal_threads["autopilot"]["thread"].start()
-                            else:
-                                signal_threads["autopilot"]["event"].set()
-
-                            if results["Blindspot Rear Left Status"] in ["WARNING_LEVEL_1","WARNING_LEVEL_2"]:
-                                if signal_threads["left_blindspot"]["thread"] is None or not signal_threads["left_blindspot"]["thread"].is_alive():
-                                    signal_threads["left_blindspot"]["event"].clear()
-                                    signal_threads["left_blindspot"]["thread"] = threading.Thread(target=leftBlindSpot, args=(signal_threads["left_blindspot"]["event"],))
-                                    signal_threads["left_blindspot"]["thread"].start()
-                            else:
-                                signal_threads["left_blindspot"]["event"].set()
-
-                            if results["Blindspot Rear Right Status"] in ["WARNING_LEVEL_1","WARNING_LEVEL_2"]:
-                                if signal_threads["right_blindspot"]["thread"] is None or not signal_threads["right_blindspot"]["thread"].is_alive():
-                                    signal_threads["right_blindspot"]["event"].clear()
-                                    signal_threads["right_blindspot"]["thread"] = threading.Thread(target=rightBlindSpot, args=(signal_threads["right_blindspot"]["event"],))
-                                    signal_threads["right_blindspot"]["thread"].start()
-                            else:
-                                signal_threads["right_blindspot"]["event"].set()
-
-                            if results["Autopilot Hands-On Status"] in [
-"LC_HANDS_ON_REQD_VISUAL","LC_HANDS_ON_REQD_CHIME_1","LC_HANDS_ON_REQD_CHIME_2","LC_HANDS_ON_REQD_ESCALATED_CHIME_1","LC_HANDS_ON_REQD_ESCALATED_CHIME_2"]:
-                                if signal_threads["hands_on"]["thread"] is None or not signal_threads["hands_on"]["thread"].is_alive():
-                                    signal_threads["hands_on"]["event"].clear()
-                                    signal_threads["hands_on"]["thread"] = threading.Thread(target=handsOnAlert, args=(signal_threads["hands_on"]["event"],))
-                                    signal_threads["hands_on"]["thread"].start()
-                            else:
-                                signal_threads["hands_on"]["event"].set()
-
-                            if results["Forward Collision Warning"] in ["FORWARD_COLLISION_WARNING"]:
-                                if signal_threads["forward_collision"]["thread"] is None or not signal_threads["forward_collision"]["thread"].is_alive():
-                                    signal_threads["forward_collision"]["event"].clear()
-                                    signal_threads["forward_collision"]["thread"] = threading.Thread(target=forwardCollisionAlert, args=(signal_threads["forward_collision"]["event"],))
-                                    signal_threads["forward_collision"]["thread"].start()
-                            else:
-                                signal_threads["forward_collision"]["event"].set()
-
-                        elif(frameID == 826):
-                            results["SoC"] = parse_soc(unpackedData)
-                        elif(frameID == 516):
-                            results["Charge Status"] = parse_charge_status(unpackedData)
-                            if results["Charge Status"] == 1:
-                                if signal_threads["charging"]["thread"] is None or not signal_threads["charging"]["thread"].is_alive():
-                                    signal_threads["charging"]["event"].clear()
-                                    signal_threads["charging"]["thread"] = threading.Thread(target=charging, args=(signal_threads["charging"]["event"],))
-                                    signal_threads["charging"]["thread"].start()
-                            else:
-                                signal_threads["charging"]["event"].set()
-                        elif(frameID == 627):
-                            brightness = parse_brightness(unpackedData)
-                            brightness = 5 if brightness < 10 else brightness
-                            LED_BRIGHTNESS = int(min(brightness, 100) / 100 * 255)
-                            strip.setBrightness(LED_BRIGHTNESS)
-                            strip.show()
-                        elif(frameID == 280):
-                            results["Gear Status"] = parse_gear(unpackedData)
-                        else:
-                            print("Not sure what this means, but it's okay.")
-                        packetStart = packetStart + 8
-                except Exception as e:
-                    print(e)
-                    set_strip_color(COLOR_RED)
-                    time.sleep(0.3)
-                    default_base_strip()
-                    break
-        elif parsedData[0] == 15 and parsedData[1] == 7:
-            set_strip_color(COLOR_RED)
-            time.sleep(0.3)
-            clear_strip()
-            time.sleep(0.3)
-            print("Connection refused, retrying...")
+        with open("/proc/self/stat", "r") as statFile:
+            fields = statFile.read().rsplit(")", 1)[1].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def wait_first_light(timeout=2.0):
+    # Until the renderer (or the render process) called show() once.
+    end = time.monotonic() + timeout
+    while renderer.framebuffer.stats()["shows"] == 0 and time.monotonic() < end:
+        time.sleep(0.001)
+
+class App:
+    def __init__(self, args):
+        self.args = args
+        self.began = time.monotonic()
+        # [(phase, seconds)]
+        self.phases = [("imports", process_uptime() or 0.0)]
+        self.signalsCached = False
+        self.firstLight = None
+        self.recorder = None
+
+    def timed(self, name, function, *arguments):
+        began = time.monotonic()
+        result = function(*arguments)
+        self.phases.append((name, time.monotonic() - began))
+        return result
+
+    def elapsed(self):
+        return self.phases[0][1] + time.monotonic() - self.began
+
+    def start(self):
+        self.timed("zones", load_zones)
+        self.signalsCached = self.timed("signals", load_signals, self.args.signal_cache)
+        self.timed("lights", self.start_lights)
+        self.firstLight = self.elapsed()
+        self.timed("connect", self.connect)
+        self.report()
+
+    def start_lights(self):
+        # Brightness is applied by the renderer's color tables, the strip runs at full scale.
+        if self.args.split:
+            setup_split(self.args.strip)
         else:
-            set_strip_color(COLOR_RED)
-            time.sleep(0.3)
-            clear_strip()
-            time.sleep(0.3)
-            print("Failed to get a valid response, retrying...")
-    except:
-        for i in range(LED_COUNT-5, LED_COUNT):
-            strip.setPixelColor(i, COLOR_RED)
-        strip.show()
-        time.sleep(0.3)
-        clear_strip()
-        print("Error, retrying...")
-        time.sleep(5)
-    time.sleep(1)
\ No newline at end of file
+            setup(strips.open_channels(self.args.strip, zoneMap.channels, LED_FREQ_HZ, LED_DMA, LED_INVERT, 255))
+        wait_first_light()
+
+    def connect(self):
+        global client
+        args = self.args
+        flightRecorder.directory = args.flight_dir
+        if args.record:
+            self.recorder = capture.CaptureRecorder(args.record)
+        filters = required_filters()
+        print("Filtering " + " ".join("0x%03X" % frame_id for bus, frame_id in filters))
+        client = panda.PandaClient(args.host, args.port, filters, self.on_datagram,
+                                   on_state=on_connection_state, on_heartbeat=print_stats, local_port=args.local_port,
+                                   bulk_receive=BULK_RECEIVE, rcvbuf=RECV_BUFFER_SIZE, metrics=metricsRegistry)
+
+    def on_datagram(self, data):
+        flightRecorder.record(data)
+        if self.recorder is not None:
+            self.recorder.record(data)
+        process_datagram(data)
+
+    def report(self):
+        phases = ", ".join("%s %.3fs" % (name, seconds) for name, seconds in self.phases)
+        print("Startup: %s (DBC %s); first light after %.3fs" % (phases, "cached" if self.signalsCached else "parsed", self.firstLight))
+        if self.firstLight > COLD_START_BUDGET:
+            print("Cold start took longer than the budget of %.1fs" % COLD_START_BUDGET)
+
+    def startup(self):
+        return {"phases": dict(self.phases), "first_light": self.firstLight, "budget": COLD_START_BUDGET,
+                "signals_cached": self.signalsCached}
+
+    def run(self):
+        args = self.args
+        try:
+            if args.replay:
+                reader = capture.CaptureReader(args.replay)
+                count, seconds = capture.replay(reader, self.on_datagram, args.speed)
+                print("Replayed %d datagrams (%d frames) in %.2fs" % (count, frameParser.frames, seconds))
+                reader.close()
+            elif not args.cold_start:
+                print("Using port " + str(args.local_port))
+                asyncio.run(run_client())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+            renderer.stop()
+#endregion
+
+def main():
+    global app
+    parser = argparse.ArgumentParser(description="GlowSense ambient lighting")
+    parser.add_argument("--host", default=targetIP, help="address of the Commander (default %(default)s)")
+    parser.add_argument("--port", type=int, default=targetPort, help="UDP port of the Commander (default %(default)s)")
+    parser.add_argument("--local-port", type=int, default=targetPort, help="local UDP port to bind, 0 for any")
+    parser.add_argument("--record", metavar="FILE", help="capture the received CAN traffic to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="play a capture file instead of connecting to the Commander")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 replays as fast as possible")
+    parser.add_argument("--strip", choices=strips.BACKENDS, default="ws281x", help="LED strip backend (default %(default)s)")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on localhost:PORT")
+    parser.add_argument("--metrics-socket", metavar="PATH", help="serve Prometheus metrics on a UNIX socket")
+    parser.add_argument("--split", action="store_true", help="render in a separate process (see ipc.py)")
+    parser.add_argument("--flight-dir", default=FLIGHT_RECORDER_DIR, help="directory for flight recorder dumps (default %(default)s)")
+    parser.add_argument("--signal-cache", metavar="FILE", default=SIGNAL_CACHE_FILE,
+                        help="cache of the parsed DBC, empty to always parse it (default %(default)s)")
+    parser.add_argument("--cold-start", action="store_true", help="start up, print the startup times as JSON and exit")
+    args = parser.parse_args()
+
+    if args.metrics_port is not None or args.metrics_socket:
+        metrics.serve(metricsRegistry, args.metrics_port, args.metrics_socket)
+        metricsRegistry.enabled = True
+
+    app = App(args)
+    app.start()
+    if args.cold_start:
+        print(json.dumps(app.startup()))
+    app.run()
+
+if __name__ == "__main__":
+    main()
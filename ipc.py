@@ -0,0 +1,380 @@
+#!/usr/bin/python3
+
+# Link between the ingest and the render process (glowsense.py --split).
+#
+# The ingest process (socket, parsing, decoding, rules) and the render process
+# (compositor and LED strip) share one multiprocessing.shared_memory block:
+#   commands  single producer / single consumer ring, ingest -> render:
+#             effect switches, flashes, brightness, idle sleep, rule reloads
+#   values    the vehicle state fields, written under a sequence lock so the
+#             render process (e.g. the charging effect reading the SoC) always
+#             gets the fields of one update together
+#   stats     show() counters of the render process and a log of recent shows
+#             (time, probe pixel) for latency measurements
+# Only the producer writes the ring's head and only the consumer its tail, each
+# with one aligned 64 bit store, so neither side takes a lock. A pipe is used
+# as doorbell when the ring goes from empty to non-empty, so the render process
+# sleeps while nothing happens.
+
+import struct
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+# op, start, end, color, value, effect name
+COMMAND = struct.Struct("<B3xiiId32s")
+ACTIVATE, DEACTIVATE, CLEAR, FLASH, BRIGHTNESS, MAX_SLEEP, RELOAD, STOP = range(1, 9)
+
+HEADER_WORDS = 16
+# Word offsets in the header; head and tail on separate cache lines.
+HEAD = 0
+TAIL = 8
+SEQUENCE = 9
+SHOWS = 10
+SKIPPED_SHOWS = 11
+LUT_BUILDS = 12
+PROBE = 13
+
+
+class Link:
+    # Layout: header words, command slots, values (sequence locked), value
+    # known flags, show log (time ns, probe pixel).
+    def __init__(self, fields, slots=1024, log_size=4096, name=None):
+        self.fields = fields
+        self.slots = slots
+        self.logSize = log_size
+        commandsOffset = HEADER_WORDS * 8
+        valuesOffset = commandsOffset + slots * COMMAND.size
+        knownOffset = valuesOffset + fields * 8
+        logOffset = knownOffset + fields + (-fields % 8)
+        size = logOffset + log_size * 16
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.memory = attach_memory(name)
+            self.owner = False
+        buffer = self.memory.buf
+        self.words = buffer[:commandsOffset].cast("Q")
+        self.commands = buffer[commandsOffset:valuesOffset]
+        self.values = buffer[valuesOffset:knownOffset].cast("q")
+        self.known = buffer[knownOffset:knownOffset + fields]
+        self.log = buffer[logOffset:size].cast("Q")
+        self.closed = False
+
+    def spec(self):
+        # Arguments for Link() in the other process.
+        return self.fields, self.slots, self.logSize, self.memory.name
+
+    #region Command ring
+    def push(self, op, name="", start=0, end=0, color=0, value=0.0):
+        # Producer side. Returns whether the consumer may be waiting for the
+        # doorbell, None when the ring is full and the command was dropped.
+        head = self.words[HEAD]
+        if head - self.words[TAIL] >= self.slots:
+            return None
+        COMMAND.pack_into(self.commands, (head % self.slots) * COMMAND.size, op, start, end, color, value,
+                          name.encode()[:32])
+        self.words[HEAD] = head + 1
+        return self.words[TAIL] == head
+
+    def pop_all(self):
+        # Consumer side: every queued command as (op, name, start, end, color, value).
+        commands = []
+        tail = self.words[TAIL]
+        while True:
+            head = self.words[HEAD]
+            if tail == head:
+                return commands
+            while tail < head:
+                op, start, end, color, value, name = COMMAND.unpack_from(self.commands, (tail % self.slots) * COMMAND.size)
+                commands.append((op, name.rstrip(b"\0").decode(), start, end, color, value))
+                tail += 1
+            self.words[TAIL] = tail
+    #endregion
+
+    #region Values
+    def write_values(self, values):
+        if self.closed:
+            return
+        sequence = self.words[SEQUENCE] + 1
+        self.words[SEQUENCE] = sequence
+        for field, value in enumerate(values):
+            if value is None:
+                self.known[field] = 0
+            else:
+                self.values[field] = value
+                self.known[field] = 1
+        self.words[SEQUENCE] = sequence + 1
+
+    def read_value(self, field):
+        while True:
+            sequence = self.words[SEQUENCE]
+            if sequence & 1:
+                continue
+            value = self.values[field] if self.known[field] else None
+            if self.words[SEQUENCE] == sequence:
+                return value
+    #endregion
+
+    #region Stats
+    def log_show(self, timestamp, pixel):
+        count = self.words[SHOWS]
+        slot = (count % self.logSize) * 2
+        self.log[slot] = timestamp
+        self.log[slot + 1] = pixel
+        self.words[SHOWS] = count + 1
+
+    def shows(self, since=0):
+        # [(time ns, probe pixel)] logged after the first `since` shows (still in the log).
+        count = self.words[SHOWS]
+        first = max(since, count - self.logSize)
+        return [(self.log[(number % self.logSize) * 2], self.log[(number % self.logSize) * 2 + 1])
+                for number in range(first, count)]
+
+    def write_stats(self, stats):
+        self.words[SKIPPED_SHOWS] = stats["skipped_shows"]
+        self.words[LUT_BUILDS] = stats["lut_builds"]
+
+    def stats(self):
+        return {"shows": self.words[SHOWS], "skipped_shows": self.words[SKIPPED_SHOWS],
+                "lut_builds": self.words[LUT_BUILDS]}
+    #endregion
+
+    def close(self):
+        # Views have to go before the block can be closed.
+        self.closed = True
+        for view in (self.words, self.commands, self.values, self.known, self.log):
+            view.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def attach_memory(name):
+    # Only the creating process unlinks the block. Before 3.13 attaching
+    # registers it again with the resource tracker, which multiprocessing
+    # children share with their parent, so that registration is a duplicate.
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+#region Ingest side
+class RemoteFrameBuffer:
+    def __init__(self, link):
+        self.link = link
+
+    def stats(self):
+        return self.link.stats()
+
+
+class RemoteRenderer:
+    # Stands in for render.Renderer in the ingest process: the calls glowsense.py
+    # and rules.RuleTable make become commands for the render process. The
+    # tickers run at most once per frame interval, see request_tick().
+    def __init__(self, link, doorbell, process=None, fps=50):
+        self.link = link
+        self.doorbell = doorbell
+        self.process = process
+        self.framebuffer = RemoteFrameBuffer(link)
+        self.effects = {}
+        self.active = set()
+        self.activations = {}
+        self.dropped = 0
+        self.maxSleep = 1.0
+        self.clock = time.monotonic
+        self.interval = 1.0 / fps
+        self.tickers = []
+        self.lastTick = -self.interval
+        self.tickLock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = None
+        # The ring has a single producer, the receive and the ticker thread take turns.
+        self.sendLock = threading.Lock()
+        self.exited = False
+
+    def send(self, op, name="", start=0, end=0, color=0, value=0.0):
+        if self.exited or (self.process is not None and self.process.exitcode is not None):
+            # Nobody empties the ring any more.
+            if not self.exited:
+                self.exited = True
+                print("Render process exited with %s, dropping the render commands" % self.process.exitcode)
+            self.dropped += 1
+            return
+        with self.sendLock:
+            waiting = self.link.push(op, name, start, end, color, value)
+        if waiting is None:
+            self.dropped += 1
+            print("Render command ring full, dropped a command")
+        elif waiting:
+            self.doorbell.send_bytes(b"\0")
+
+    def add(self, effect):
+        # The render process builds its own effects from rules.json.
+        self.effects[effect.name] = effect
+
+    def add_ticker(self, ticker):
+        self.tickers.append(ticker)
+
+    def remove_ticker(self, ticker):
+        self.tickers.remove(ticker)
+
+    def request_tick(self):
+        # Ticks right away on the calling (receive) thread when the last tick
+        # is an interval ago, so no thread switch is in the way; otherwise the
+        # ticker thread ticks once the interval is over.
+        now = self.clock()
+        if now >= self.lastTick + self.interval and self.tickLock.acquire(False):
+            try:
+                self.tick(now)
+            finally:
+                self.tickLock.release()
+            if self.next_due(now) is None:
+                return
+        self.wake.set()
+
+    def tick(self, now):
+        self.lastTick = now
+        for ticker in list(self.tickers):
+            ticker.tick(now)
+
+    def next_due(self, now):
+        due = None
+        for ticker in self.tickers:
+            change = ticker.next_due(now)
+            if change is not None and (due is None or change < due):
+                due = change
+        return due
+
+    def run_tickers(self):
+        while not self.stopped:
+            now = self.clock()
+            due = self.next_due(now)
+            self.wake.wait(None if due is None else max(due - now, 0))
+            self.wake.clear()
+            if self.stopped:
+                return
+            delay = self.lastTick + self.interval - self.clock()
+            if delay > 0:
+                time.sleep(delay)
+            with self.tickLock:
+                self.tick(self.clock())
+
+    def is_active(self, name):
+        return name in self.active
+
+    def set_active(self, name, state):
+        if state:
+            self.activate(name)
+        else:
+            self.deactivate(name)
+
+    def activate(self, name):
+        if name in self.active:
+            return
+        self.active.add(name)
+        self.activations[name] = self.activations.get(name, 0) + 1
+        self.send(ACTIVATE, name)
+
+    def deactivate(self, name):
+        if name in self.active:
+            self.active.discard(name)
+            self.send(DEACTIVATE, name)
+
+    def clear(self):
+        self.active.clear()
+        self.send(CLEAR)
+
+    def flash(self, color, start, end, duration=0.3):
+        self.activations["flash"] = self.activations.get("flash", 0) + 1
+        self.send(FLASH, "", start, end, color, duration)
+
+    def set_brightness(self, brightness, fade=True):
+        self.send(BRIGHTNESS, "", brightness, int(fade))
+
+    @property
+    def max_sleep(self):
+        return self.maxSleep
+
+    @max_sleep.setter
+    def max_sleep(self, seconds):
+        self.maxSleep = seconds
+        self.send(MAX_SLEEP, "", value=-1.0 if seconds is None else seconds)
+
+    def reload(self):
+        # The render process reads rules.json again.
+        self.send(RELOAD)
+
+    def start(self):
+        if self.process is not None and self.process.exitcode is not None:
+            raise RuntimeError("Render process exited with %s" % self.process.exitcode)
+        if self.process is not None and not self.process.is_alive():
+            self.process.start()
+        if self.thread is None:
+            self.stopped = False
+            self.thread = threading.Thread(target=self.run_tickers, name="tickers", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped = True
+            self.wake.set()
+            self.thread.join()
+            self.thread = None
+        self.send(STOP)
+        if self.process is not None and self.process.is_alive():
+            self.process.join(2.0)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.link.close()
+#endregion
+
+
+#region Render side
+class LoggedStrip:
+    # Wraps the render process' strip so every show() is logged to the link.
+    def __init__(self, strip, link):
+        self.strip = strip
+        self.link = link
+        self.begin = strip.begin
+        self.numPixels = strip.numPixels
+        self.setPixelColor = strip.setPixelColor
+        self.getPixelColor = strip.getPixelColor
+
+    def show(self):
+        self.strip.show()
+        self.link.log_show(time.monotonic_ns(), self.strip.getPixelColor(self.link.words[PROBE]))
+
+
+def serve(link, renderer, doorbell, reload_effects):
+    # Applies the commands until STOP or until the ingest process went away.
+    while True:
+        for op, name, start, end, color, value in link.pop_all():
+            if op == ACTIVATE:
+                if name in renderer.effects:
+                    renderer.activate(name)
+            elif op == DEACTIVATE:
+                renderer.deactivate(name)
+            elif op == CLEAR:
+                renderer.clear()
+            elif op == FLASH:
+                renderer.flash(color, start, end, value)
+            elif op == BRIGHTNESS:
+                renderer.set_brightness(start, fade=bool(end))
+            elif op == MAX_SLEEP:
+                renderer.max_sleep = None if value < 0 else value
+                renderer.wake.set()
+            elif op == RELOAD:
+                reload_effects()
+            elif op == STOP:
+                return
+        link.write_stats(renderer.framebuffer.stats())
+        try:
+            if doorbell.poll(1.0):
+                doorbell.recv_bytes()
+        except (EOFError, OSError):
+            return
+#endregion
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+# In-process metrics in the Prometheus text format.
+#
+# Histograms and counters are plain objects the hot paths update directly;
+# everything is guarded by Registry.enabled, so with instrumentation off a
+# datagram or render tick pays for one attribute check. Values that already
+# exist elsewhere (receiver drop counters, payload cache hits, effect
+# activations) are read by collectors only when the metrics are scraped.
+#
+# serve() exposes them over HTTP on localhost and/or a UNIX socket:
+#   GET /metrics    the metrics
+#   GET /enable     turn instrumentation on
+#   GET /disable    turn it off
+#
+#   curl -s localhost:9108/metrics
+#   curl -s --unix-socket /run/glowsense.sock http://localhost/metrics
+
+import os
+import socketserver
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; the hot path stages run from about a microsecond to a few milliseconds.
+BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+           1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in sorted(labels.items()))
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            bucketLabels = dict(labels, le=bound if isinstance(bound, str) else repr(bound))
+            yield "%s_bucket%s %d" % (name, format_labels(bucketLabels), cumulative)
+        yield "%s_sum%s %r" % (name, format_labels(labels), self.sum)
+        yield "%s_count%s %d" % (name, format_labels(labels), self.count)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield "%s%s %r" % (name, format_labels(labels), self.value)
+
+
+class Registry:
+    def __init__(self, prefix="glowsense", enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        # name -> (type, help, {label tuple: metric})
+        self.families = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def _get(self, kind, factory, name, help, labels):
+        family = self.families.get(name)
+        if family is None:
+            with self.lock:
+                family = self.families.setdefault(name, (kind, help, {}))
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            with self.lock:
+                metric = family[2].setdefault(key, factory())
+        return metric
+
+    def histogram(self, name, help, **labels):
+        return self._get("histogram", Histogram, name, help, labels)
+
+    def counter(self, name, help, **labels):
+        return self._get("counter", Counter, name, help, labels)
+
+    def collector(self, function):
+        # function() yields (name, type, help, labels, value) when scraped.
+        self.collectors.append(function)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            families = [(name, kind, help, list(metrics.items())) for name, (kind, help, metrics) in self.families.items()]
+        for name, kind, help, metrics in sorted(families):
+            fullName = "%s_%s" % (self.prefix, name)
+            lines.append("# HELP %s %s" % (fullName, help))
+            lines.append("# TYPE %s %s" % (fullName, kind))
+            for key, metric in sorted(metrics, key=lambda item: item[0]):
+                lines.extend(metric.samples(fullName, dict(key)))
+        collected = {}
+        for function in self.collectors:
+            for name, kind, help, labels, value in function():
+                collected.setdefault((name, kind, help), []).append((labels, value))
+        for (name, kind, help), samples in sorted(collected.items()):
+            fullName = "%s_%s" % (self.prefix, name)
+            lines.append("# HELP %s %s" % (fullName, help))
+            lines.append("# TYPE %s %s" % (fullName, kind))
+            for labels, value in samples:
+                lines.append("%s%s %r" % (fullName, format_labels(labels), value))
+        lines.append("# HELP %s_instrumentation_enabled Whether hot path instrumentation is on" % self.prefix)
+        lines.append("# TYPE %s_instrumentation_enabled gauge" % self.prefix)
+        lines.append("%s_instrumentation_enabled %d" % (self.prefix, 1 if self.enabled else 0))
+        return "\n".join(lines) + "\n"
+
+
+#region Endpoint
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == "/metrics":
+            body = registry.render()
+        elif self.path == "/enable":
+            registry.enabled = True
+            body = "enabled\n"
+        elif self.path == "/disable":
+            registry.enabled = False
+            body = "disabled\n"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # UNIX socket clients have no address.
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(registry, port=None, path=None, host="127.0.0.1"):
+    # Starts the endpoint(s) on daemon threads, returns the servers.
+    servers = []
+    if port is not None:
+        servers.append(ThreadingHTTPServer((host, port), MetricsHandler))
+    if path is not None:
+        if os.path.exists(path):
+            os.unlink(path)
+        servers.append(UnixHTTPServer(path, MetricsHandler))
+    for server in servers:
+        server.registry = registry
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return servers
+#endregion
@@ -0,0 +1,424 @@
+#!/usr/bin/python3
+
+# Panda UDP framing helpers. Every CAN frame in a datagram is 16 bytes: two
+# little endian header words (frame ID in the top 11 bits of the first one,
+# length and bus in the second) followed by the 8 byte payload.
+
+import asyncio
+import ctypes
+import ctypes.util
+import socket
+import struct
+import sys
+import time
+
+import dbc
+
+# NumPy view of a frame for the batch path, see frame_dtype().
+PANDA_FRAME_DTYPE = None
+
+PANDA_FRAME_SIZE = 16
+PANDA_FRAME = struct.Struct("<IIQ")
+PANDA_HEADER = struct.Struct("<II")
+
+# The Commander answers "ehllo" with a single frame on bus 15: ID 6 accepts the
+# connection, ID 7 refuses it.
+HANDSHAKE_BUS = 15
+HANDSHAKE_ACCEPT = 6
+HANDSHAKE_REFUSE = 7
+
+
+def frame_dtype():
+    # Needs numpy loaded by dbc.load_numpy().
+    global PANDA_FRAME_DTYPE
+    if PANDA_FRAME_DTYPE is None:
+        PANDA_FRAME_DTYPE = dbc.np.dtype([("header", "<u4"), ("info", "<u4"), ("data", "<u8")])
+    return PANDA_FRAME_DTYPE
+
+
+def filter_packet(bus, frame_id):
+    return struct.pack("!BBH", 0x0F, bus, frame_id)
+
+
+def pack_frame(bus, frame_id, payload, length=8):
+    return PANDA_FRAME.pack(frame_id << 21, (bus << 4) | length, payload)
+
+
+class PandaFrameParser:
+    # Parses Panda datagrams in place. Works on bytes, bytearrays and memoryviews
+    # (e.g. the receive slots of DatagramReceiver) without slicing out per-frame
+    # bytes objects: headers and payloads are unpacked straight from the buffer.
+    def __init__(self):
+        self.frames = 0
+        self.partialDatagrams = 0
+
+    def iter_frames(self, data):
+        # Yields (bus, frame ID, length, payload) with the payload as the little
+        # endian 64 bit integer the DBC decoders take.
+        view = memoryview(data)
+        usable = len(view) - len(view) % PANDA_FRAME_SIZE
+        if usable != len(view):
+            self.partialDatagrams += 1
+        self.frames += usable // PANDA_FRAME_SIZE
+        for header, info, payload in PANDA_FRAME.iter_unpack(view[:usable]):
+            yield info >> 4, header >> 21, info & 0x0F, payload
+
+    def header(self, data, offset=0):
+        header, info = PANDA_HEADER.unpack_from(data, offset)
+        return info >> 4, header >> 21, info & 0x0F
+
+    def columns(self, data):
+        # Views a whole datagram as a structured NumPy array and returns the
+        # (bus, frame ID, length, payload) columns without a per-frame Python loop.
+        count = len(data) // PANDA_FRAME_SIZE
+        self.frames += count
+        frames = dbc.np.frombuffer(data, dtype=frame_dtype(), count=count)
+        info = frames["info"]
+        return info >> 4, frames["header"] >> 21, info & 0x0F, frames["data"]
+
+    @staticmethod
+    def frames_by_id(frameIDs):
+        # Yields (frame ID, boolean row selector) in order of first appearance.
+        uniqueIDs, firstIndex = dbc.np.unique(frameIDs, return_index=True)
+        for frameID in uniqueIDs[dbc.np.argsort(firstIndex)]:
+            yield int(frameID), frameIDs == frameID
+
+
+#region Bulk receive
+MSG_TRUNC = getattr(socket, "MSG_TRUNC", 0x20)
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+SO_RXQ_OVFL = 40  # Linux: kernel reports the socket's cumulative drop count with every datagram
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IoVec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+class _CMsgHdr(ctypes.Structure):
+    _fields_ = [("cmsg_len", ctypes.c_size_t), ("cmsg_level", ctypes.c_int), ("cmsg_type", ctypes.c_int)]
+
+
+def _load_recvmmsg():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+class DatagramReceiver:
+    # Drains every queued datagram on a non-blocking socket per wakeup into a
+    # preallocated buffer of fixed size slots: one recvmmsg() call on Linux, a
+    # recvmsg_into() loop elsewhere. drain() returns memoryviews into the slots,
+    # which stay valid until the next drain().
+    def __init__(self, sock, slots=64, slot_size=2048, rcvbuf=None, use_recvmmsg=True):
+        self.sock = sock
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buffer = bytearray(slots * slot_size)
+        self.view = memoryview(self.buffer)
+        self.datagrams = 0
+        self.wakeups = 0
+        self.truncated = 0
+        self.dropped = 0
+        self.fullDrains = 0
+        self.lastDropCount = 0
+
+        sock.setblocking(False)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.trackDrops = True
+        except OSError:
+            self.trackDrops = False
+
+        self.recvmmsg = _load_recvmmsg() if use_recvmmsg else None
+        if self.recvmmsg is not None:
+            self._setup_recvmmsg()
+
+    def _setup_recvmmsg(self):
+        base = ctypes.addressof(ctypes.c_char.from_buffer(self.buffer))
+        self.controlSize = socket.CMSG_SPACE(4)
+        self.control = (ctypes.c_char * (self.controlSize * self.slots))()
+        controlBase = ctypes.addressof(self.control)
+        self.iovecs = (_IoVec * self.slots)()
+        self.messages = (_MMsgHdr * self.slots)()
+        for i in range(self.slots):
+            self.iovecs[i].iov_base = base + i * self.slot_size
+            self.iovecs[i].iov_len = self.slot_size
+            header = self.messages[i].msg_hdr
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+            if self.trackDrops:
+                header.msg_control = controlBase + i * self.controlSize
+                header.msg_controllen = self.controlSize
+
+    def _count_drops(self, dropCount):
+        if dropCount > self.lastDropCount:
+            self.dropped += dropCount - self.lastDropCount
+        self.lastDropCount = dropCount
+
+    def drain(self):
+        self.wakeups += 1
+        if self.recvmmsg is not None:
+            received = self._drain_recvmmsg()
+        else:
+            received = self._drain_recvmsg()
+        self.datagrams += len(received)
+        if len(received) == self.slots:
+            self.fullDrains += 1
+        return received
+
+    def _drain_recvmmsg(self):
+        if self.trackDrops:
+            for i in range(self.slots):
+                self.messages[i].msg_hdr.msg_controllen = self.controlSize
+        count = self.recvmmsg(self.sock.fileno(), self.messages, self.slots, MSG_DONTWAIT, None)
+        if count < 0:
+            return []
+        received = []
+        for i in range(count):
+            message = self.messages[i]
+            length = message.msg_len
+            if message.msg_hdr.msg_flags & MSG_TRUNC:
+                self.truncated += 1
+            if self.trackDrops and message.msg_hdr.msg_controllen >= ctypes.sizeof(_CMsgHdr) + 4:
+                cmsg = _CMsgHdr.from_address(message.msg_hdr.msg_control)
+                if cmsg.cmsg_level == socket.SOL_SOCKET and cmsg.cmsg_type == SO_RXQ_OVFL:
+                    self._count_drops(ctypes.c_uint32.from_address(message.msg_hdr.msg_control + ctypes.sizeof(_CMsgHdr)).value)
+            start = i * self.slot_size
+            received.append(self.view[start:start + min(length, self.slot_size)])
+        return received
+
+    def _drain_recvmsg(self):
+        received = []
+        ancillarySize = socket.CMSG_SPACE(4) if self.trackDrops else 0
+        for i in range(self.slots):
+            slot = self.view[i * self.slot_size:(i + 1) * self.slot_size]
+            try:
+                length, ancillary, flags, address = self.sock.recvmsg_into([slot], ancillarySize)
+            except (BlockingIOError, InterruptedError):
+                break
+            if flags & MSG_TRUNC:
+                self.truncated += 1
+            for level, kind, data in ancillary:
+                if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                    self._count_drops(struct.unpack("=I", data[:4])[0])
+            received.append(slot[:length])
+        return received
+
+    def stats(self):
+        return {"datagrams": self.datagrams, "wakeups": self.wakeups, "truncated": self.truncated,
+                "dropped": self.dropped, "full_drains": self.fullDrains}
+#endregion
+
+
+#region Connection
+class PandaClient(asyncio.DatagramProtocol):
+    # Owns the UDP link to the Commander: handshake, filters, heartbeats and a
+    # watchdog on frame silence, reconnecting with exponential backoff. Frames
+    # are handed to on_datagram from the event loop; on_state is told about
+    # every state change ("connecting", "connected", "refused", "invalid",
+    # "lost", "error"). With a metrics.Registry the time of every bulk drain is
+    # recorded as the "recv" stage while it is enabled.
+    def __init__(self, host, port, filters, on_datagram, on_state=None, on_heartbeat=None, local_port=0,
+                 heartbeat_interval=3.0, handshake_timeout=0.25, silence_timeout=2.0,
+                 backoff_min=0.05, backoff_max=0.5, bulk_receive=False, rcvbuf=None, metrics=None):
+        self.address = (host, port)
+        self.filters = list(filters)
+        self.on_datagram = on_datagram
+        self.on_state = on_state
+        self.on_heartbeat = on_heartbeat
+        self.local_port = local_port
+        self.heartbeat_interval = heartbeat_interval
+        self.handshake_timeout = handshake_timeout
+        self.silence_timeout = silence_timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.bulk_receive = bulk_receive
+        self.rcvbuf = rcvbuf
+        self.receiver = None
+        self.state = None
+        self.transport = None
+        self.loop = None
+        self.answer = None
+        self.lost = None
+        self.lastFrame = 0.0
+        self.stopped = False
+        self.refilter = False
+        self.parser = PandaFrameParser()
+        self.metrics = metrics
+        if metrics is not None:
+            self.recvTime = metrics.histogram("stage_seconds", "Time spent per pipeline stage", stage="recv")
+
+    #region DatagramProtocol
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.answer is not None and not self.answer.done() and len(data) >= 8:
+            header = self.parser.header(data)
+            # Frames still in flight from a previous session are not an answer.
+            if header[0] == HANDSHAKE_BUS:
+                self.answer.set_result(header)
+                return
+        if self.state == "connected":
+            self.lastFrame = self.loop.time()
+            try:
+                self.on_datagram(data)
+            except Exception as e:
+                print(e)
+                self._set_state("error")
+                self.lost.set()
+
+    def error_received(self, exc):
+        print("Socket error: %s" % exc)
+
+    def connection_lost(self, exc):
+        self.transport = None
+    #endregion
+
+    def send(self, data):
+        if self.receiver is not None:
+            try:
+                self.receiver.sock.sendto(data, self.address)
+            except OSError as e:
+                self.error_received(e)
+        elif self.transport is not None:
+            self.transport.sendto(data, self.address)
+
+    def _on_readable(self):
+        if self.metrics is not None and self.metrics.enabled:
+            began = time.perf_counter()
+            datagrams = self.receiver.drain()
+            self.recvTime.observe(time.perf_counter() - began)
+        else:
+            datagrams = self.receiver.drain()
+        for data in datagrams:
+            self.datagram_received(data, self.address)
+
+    async def open(self):
+        if not self.bulk_receive:
+            await self.loop.create_datagram_endpoint(lambda: self, local_addr=("0.0.0.0", self.local_port))
+            return
+        # Bulk mode reads the socket itself so one wakeup drains every queued datagram.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.bind(("0.0.0.0", self.local_port))
+        self.receiver = DatagramReceiver(sock, rcvbuf=self.rcvbuf)
+        self.loop.add_reader(sock.fileno(), self._on_readable)
+
+    def close(self):
+        if self.receiver is not None:
+            self.loop.remove_reader(self.receiver.sock.fileno())
+            self.receiver.sock.close()
+            self.receiver = None
+        elif self.transport is not None:
+            self.transport.close()
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            if self.on_state is not None:
+                self.on_state(state)
+
+    def set_filters(self, filters):
+        # A Commander session can only gain filters: new ones are sent right
+        # away, removing one needs a new handshake, which is done quietly (the
+        # state stays "connected" unless the handshake fails).
+        filters = [tuple(entry) for entry in filters]
+        current = [tuple(entry) for entry in self.filters]
+        self.filters = filters
+        if self.state != "connected" or self.lost is None:
+            return
+        if any(entry not in filters for entry in current):
+            self.refilter = True
+            self.lost.set()
+            return
+        for bus, frame_id in filters:
+            if (bus, frame_id) not in current:
+                self.send(filter_packet(bus, frame_id))
+
+    async def handshake(self):
+        refilter = self.refilter
+        self.refilter = False
+        if self.state not in ("refused", "invalid") and not refilter:
+            self._set_state("connecting")
+        self.answer = self.loop.create_future()
+        self.send(b"bye")
+        self.send(b"ehllo")
+        try:
+            bus, frame_id, length = await asyncio.wait_for(self.answer, self.handshake_timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.answer = None
+
+        if bus == HANDSHAKE_BUS and frame_id == HANDSHAKE_ACCEPT:
+            for bus, frame_id in self.filters:
+                self.send(filter_packet(bus, frame_id))
+            return True
+        self._set_state("refused" if bus == HANDSHAKE_BUS and frame_id == HANDSHAKE_REFUSE else "invalid")
+        return False
+
+    async def stay_connected(self):
+        # Heartbeats until the link goes quiet or processing a datagram failed.
+        self.lost = asyncio.Event()
+        self.lastFrame = self.loop.time()
+        lastHeartbeat = self.loop.time()
+        self._set_state("connected")
+        tick = min(self.heartbeat_interval, self.silence_timeout) / 4
+        while not self.stopped:
+            try:
+                await asyncio.wait_for(self.lost.wait(), tick)
+                return
+            except asyncio.TimeoutError:
+                pass
+            now = self.loop.time()
+            if now - self.lastFrame > self.silence_timeout:
+                print("No frames for %.1fs, reconnecting" % self.silence_timeout)
+                self._set_state("lost")
+                return
+            if now - lastHeartbeat >= self.heartbeat_interval:
+                lastHeartbeat = now
+                self.send(b"ehllo")
+                if self.on_heartbeat is not None:
+                    self.on_heartbeat()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        await self.open()
+        backoff = self.backoff_min
+        try:
+            while not self.stopped:
+                if await self.handshake():
+                    backoff = self.backoff_min
+                    await self.stay_connected()
+                    continue
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.backoff_max)
+        finally:
+            self.send(b"bye")
+            self.close()
+
+    def stop(self):
+        self.stopped = True
+        if self.lost is not None:
+            self.lost.set()
+#endregion
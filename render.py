@@ -0,0 +1,592 @@
+#!/usr/bin/python3
+
+# Single render thread for the LED strip. Effects are layers with a priority and
+# an LED range; every tick the active layers are composited bottom-up over the
+# base color into one frame which is pushed to the strip with exactly one show().
+#
+# Opaque effects own their range: an effect whose whole range is owned by
+# higher priority effects is preempted. It is not drawn and does not wake the
+# render thread, and when it shows again its animation either carries on as if
+# it had been playing all along ("continue", e.g. a turn signal staying in step
+# with the car) or from where it was hidden ("pause", e.g. a one-shot flash).
+# All times come from the renderer's clock; with a ManualClock and step() the
+# frames can be produced and checked one by one.
+
+import threading
+import time
+from array import array
+
+import animation
+
+
+#region Effects
+class Effect:
+    # Layers only touch pixels in [start, end); pixels they skip show the layers below.
+    def __init__(self, name, priority, start, end):
+        self.name = name
+        self.priority = priority
+        self.start = start
+        self.end = end
+        self.started = 0.0
+        self.pausedAt = None
+        # While preempted: "continue" keeps the clock running, "pause" stops it.
+        self.preempt = "continue"
+
+    def activate(self, now):
+        self.started = now
+        self.pausedAt = None
+
+    def opaque(self):
+        # Whether every pixel of the range is drawn all the time, hiding the layers below.
+        return False
+
+    def pause(self, now):
+        if self.pausedAt is None:
+            self.pausedAt = now
+
+    def resume(self, now):
+        if self.pausedAt is not None:
+            if self.preempt == "pause":
+                self.started += now - self.pausedAt
+            self.pausedAt = None
+
+    def finished(self, now):
+        return False
+
+    def next_change(self, now, renderer):
+        # Monotonic time at which the effect's output changes next, None when it
+        # is static. Effects that cannot tell are rendered every tick.
+        return now
+
+    def render(self, frame, now, renderer):
+        pass
+
+    def fill(self, frame, color, start=None, end=None):
+        start = self.start if start is None else start
+        end = self.end if end is None else end
+        frame[start:end] = [color] * (end - start)
+
+
+class Solid(Effect):
+    def __init__(self, name, priority, color, start, end):
+        Effect.__init__(self, name, priority, start, end)
+        self.color = color
+        self.pixels = [color] * (end - start)
+
+    def opaque(self):
+        return self.color is not None
+
+    def next_change(self, now, renderer):
+        return None
+
+    def render(self, frame, now, renderer):
+        frame[self.start:self.end] = self.pixels
+
+
+class KeyframeEffect(Effect):
+    # Plays an animation.Animation; the compiled segments come from the
+    # renderer's cache, so a tick is one lookup and one slice copy.
+    def __init__(self, name, priority, keyframes, start, end, loop=True):
+        Effect.__init__(self, name, priority, start, end)
+        self.animation = animation.Animation(keyframes, loop)
+        self.preempt = "continue" if loop else "pause"
+
+    def opaque(self):
+        return all(keyframe.color is not None and keyframe.start is None and keyframe.end is None
+                   for keyframe in self.animation.keyframes)
+
+    def compiled(self, renderer, start=None, end=None):
+        start = self.start if start is None else start
+        end = self.end if end is None else end
+        return renderer.animations.get(self.animation, renderer.fps, start, end)
+
+    def current(self, renderer):
+        # Compiled animation to play right now, None for nothing.
+        return self.compiled(renderer)
+
+    def finished(self, now):
+        return not self.animation.loop and now - self.started >= self.animation.duration
+
+    def next_change(self, now, renderer):
+        compiled = self.current(renderer)
+        if compiled is None:
+            return None
+        change = compiled.next_change(now - self.started)
+        if change is None:
+            return None
+        # Slightly past the tick boundary so the new segment is picked up.
+        return self.started + change + 1e-6
+
+    def render(self, frame, now, renderer):
+        self.play(frame, now, self.current(renderer))
+
+    def play(self, frame, now, compiled):
+        if compiled is None:
+            return
+        segment = compiled.segment(now - self.started)
+        if segment is not None:
+            start, end, pixels = segment
+            frame[start:end] = pixels
+
+
+class Blink(KeyframeEffect):
+    # off_color None leaves the layers below visible during the off phase.
+    def __init__(self, name, priority, on_color, off_color, on_time, off_time, start, end):
+        KeyframeEffect.__init__(self, name, priority, [
+            animation.Keyframe(on_time, on_color),
+            animation.Keyframe(off_time, off_color),
+        ], start, end)
+        self.on_color = on_color
+        self.off_color = off_color
+        self.on_time = on_time
+        self.off_time = off_time
+        self.pixels = [on_color] * (end - start)
+
+
+class BlindSpot(Blink):
+    # Solid warning, blinking while the turn signal on the same side is on.
+    def __init__(self, name, priority, color, turn_signal, start, end, blink_time=0.15):
+        Blink.__init__(self, name, priority, color, 0, blink_time, blink_time, start, end)
+        self.turn_signal = turn_signal
+
+    def next_change(self, now, renderer):
+        if renderer.is_active(self.turn_signal):
+            return Blink.next_change(self, now, renderer)
+        return None
+
+    def render(self, frame, now, renderer):
+        if renderer.is_active(self.turn_signal):
+            Blink.render(self, frame, now, renderer)
+        else:
+            frame[self.start:self.end] = self.pixels
+
+
+class Flash(Solid):
+    # One-shot effect that removes itself after `duration` seconds.
+    def __init__(self, name, priority, color, start, end, duration):
+        Solid.__init__(self, name, priority, color, start, end)
+        self.duration = duration
+        self.preempt = "pause"
+
+    def finished(self, now):
+        return now - self.started >= self.duration
+
+    def next_change(self, now, renderer):
+        return self.started + self.duration
+
+
+class Charging(KeyframeEffect):
+    # Green pulse over the share of the strip matching the state of charge:
+    # 21 steps down from 130 to 30, hold, 21 steps up from 25 to 125, short hold.
+    # One compiled animation per number of lit LEDs.
+    STEP = 0.05
+
+    def __init__(self, name, priority, color_function, soc_function, start, end):
+        def green(level):
+            return color_function(0, level, 0)
+        keyframes = animation.ramp(green, 130, 30, 21, self.STEP)
+        keyframes.append(animation.Keyframe(1.0, green(30)))
+        keyframes += animation.ramp(green, 25, 125, 21, self.STEP)
+        keyframes.append(animation.Keyframe(0.2, green(125)))
+        KeyframeEffect.__init__(self, name, priority, keyframes, start, end)
+        self.color_function = color_function
+        self.soc_function = soc_function
+
+    def opaque(self):
+        # Only the share matching the state of charge is lit.
+        return False
+
+    def current(self, renderer):
+        try:
+            soc = min(int(self.soc_function()), 100)
+        except (TypeError, ValueError):
+            return None
+        lit = int((soc / 100.0) * (self.end - self.start))
+        return self.compiled(renderer, self.end - lit, self.end)
+#endregion
+
+
+def covers(spans, start, end):
+    # Whether the (start, end) spans together cover all of [start, end).
+    for first, last in sorted(spans):
+        if first > start:
+            return False
+        start = max(start, last)
+        if start >= end:
+            return True
+    return start >= end
+
+
+class ManualClock:
+    # Stands in for time.monotonic() in tests and tools stepping through frames.
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        return self.now
+
+
+class FrameBuffer:
+    # Shadow copy of what the strip currently shows. Frames pass through a color
+    # pipeline (one 256 entry gamma and brightness table, rebuilt only when the
+    # brightness changes) on the way out, only pixels whose output differs are
+    # written to the PixelStrip, the touched span is tracked as a dirty range and
+    # show() is skipped when nothing changed since the last one. The strip's own
+    # brightness is left alone.
+    def __init__(self, strip, gamma=1.0):
+        self.strip = strip
+        self.count = strip.numPixels()
+        self.pixels = array("I", [0]) * self.count
+        self.output = array("I", [0]) * self.count
+        self.gamma = gamma
+        self.brightness = 255
+        self.lut = None
+        self.corrected = {}
+        self.dirtyStart = self.count
+        self.dirtyEnd = 0
+        self.shows = 0
+        self.skippedShows = 0
+        self.lutBuilds = 0
+        self.build_lut()
+
+    def build_lut(self):
+        scale = self.brightness / 255.0
+        self.lut = bytes(int(round(255 * ((value / 255.0) ** self.gamma) * scale)) for value in range(256))
+        self.corrected = {}
+        self.lutBuilds += 1
+
+    def correct(self, color):
+        # Packed WRGB color as it is sent to the strip. Effects use a handful of
+        # colors, so the results are memoized until the table changes.
+        output = self.corrected.get(color)
+        if output is None:
+            lut = self.lut
+            output = (lut[(color >> 24) & 0xFF] << 24) | (lut[(color >> 16) & 0xFF] << 16) | \
+                     (lut[(color >> 8) & 0xFF] << 8) | lut[color & 0xFF]
+            if len(self.corrected) < 4096:
+                self.corrected[color] = output
+        return output
+
+    def _write(self, index, color):
+        output = self.correct(color)
+        if self.output[index] != output:
+            self.output[index] = output
+            self.strip.setPixelColor(index, output)
+            return True
+        return False
+
+    def set_pixel(self, index, color):
+        self.pixels[index] = color
+        if self._write(index, color):
+            self._mark(index, index + 1)
+
+    def fill(self, color, start=0, end=None):
+        end = self.count if end is None else end
+        for index in range(start, end):
+            self.set_pixel(index, color)
+
+    def update(self, frame):
+        frame = array("I", frame)
+        if frame == self.pixels:
+            return
+        pixels = self.pixels
+        first = last = None
+        for index in range(self.count):
+            color = frame[index]
+            if pixels[index] != color and self._write(index, color):
+                if first is None:
+                    first = index
+                last = index
+        self.pixels = frame
+        if first is not None:
+            self._mark(first, last + 1)
+
+    def set_brightness(self, brightness):
+        brightness = min(max(int(brightness), 0), 255)
+        if brightness != self.brightness:
+            self.brightness = brightness
+            self.build_lut()
+            self.refresh()
+
+    def refresh(self):
+        # Sends every pixel through the current table again.
+        first = last = None
+        for index in range(self.count):
+            if self._write(index, self.pixels[index]):
+                if first is None:
+                    first = index
+                last = index
+        if first is not None:
+            self._mark(first, last + 1)
+
+    def _mark(self, start, end):
+        self.dirtyStart = min(self.dirtyStart, start)
+        self.dirtyEnd = max(self.dirtyEnd, end)
+
+    def dirty(self):
+        return self.dirtyStart < self.dirtyEnd
+
+    def show(self):
+        if not self.dirty():
+            self.skippedShows += 1
+            return False
+        self.strip.show()
+        self.shows += 1
+        self.dirtyStart = self.count
+        self.dirtyEnd = 0
+        return True
+
+    def stats(self):
+        return {"shows": self.shows, "skipped_shows": self.skippedShows, "lut_builds": self.lutBuilds}
+
+
+class Renderer:
+    # Brightness changes smaller than `hysteresis` (0-255) are ignored, larger
+    # ones fade over `fade_time` seconds for a full 0-255 swing.
+    # The render thread only ticks as fast as the active effects change: while
+    # the frame is static it sleeps up to `max_sleep` seconds (None: until
+    # something changes) and any activation, deactivation or brightness change
+    # wakes it for an immediate frame, though never sooner than one frame
+    # interval after the last one. Tickers (rules.RuleTable) run before every
+    # frame and can ask for one with next_due().
+    # With a metrics.Registry the compose and show() times are recorded while it is enabled.
+    def __init__(self, strip, base_color, fps=50, gamma=1.0, fade_time=0.5, hysteresis=0, metrics=None,
+                 clock=time.monotonic):
+        self.strip = strip
+        self.clock = clock
+        self.framebuffer = FrameBuffer(strip, gamma)
+        self.base_color = base_color
+        self.fps = fps
+        self.interval = 1.0 / fps
+        self.animations = animation.AnimationCache()
+        self.effects = {}
+        self.active = {}
+        self.layers = ()
+        self.preempted = ()
+        self.brightness = None
+        self.fadeLevel = None
+        self.fadeStep = 255.0 * self.interval / fade_time if fade_time > 0 else 255.0
+        self.hysteresis = hysteresis
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.wake = threading.Event()
+        self.max_sleep = 1.0
+        self.ticks = 0
+        self.tickers = []
+        self.thread = None
+        self.flashCount = 0
+        # Effect name -> times it was switched on (ad-hoc effects by class).
+        self.activations = {}
+        self.metrics = metrics
+        if metrics is not None:
+            self.renderTime = metrics.histogram("stage_seconds", "Time spent per pipeline stage", stage="render")
+            self.showTime = metrics.histogram("stage_seconds", "Time spent per pipeline stage", stage="show")
+
+    def add(self, effect):
+        self.effects[effect.name] = effect
+
+    def add_ticker(self, ticker):
+        # ticker.tick(now) on the render thread before every frame,
+        # ticker.next_due(now) when it needs a frame next (None: never).
+        self.tickers.append(ticker)
+
+    def remove_ticker(self, ticker):
+        self.tickers.remove(ticker)
+
+    def request_tick(self):
+        self.wake.set()
+
+    def tick(self, now):
+        for ticker in list(self.tickers):
+            ticker.tick(now)
+
+    def is_active(self, name):
+        return name in self.active
+
+    def set_active(self, name, state):
+        if state:
+            self.activate(name)
+        else:
+            self.deactivate(name)
+
+    def activate(self, name, effect=None):
+        with self.lock:
+            if name in self.active:
+                return
+            key = name if effect is None else effect.__class__.__name__.lower()
+            effect = effect or self.effects.get(name)
+            if effect is None:
+                # Left over from rules that were just reloaded.
+                return
+            effect.activate(self.clock())
+            self.active[name] = effect
+            self.activations[key] = self.activations.get(key, 0) + 1
+            self._update_layers()
+        self.wake.set()
+
+    def deactivate(self, name):
+        with self.lock:
+            if self.active.pop(name, None) is None:
+                return
+            self._update_layers()
+        self.wake.set()
+
+    def clear(self):
+        with self.lock:
+            self.active.clear()
+            self._update_layers()
+        self.wake.set()
+
+    def flash(self, color, start, end, duration=0.3):
+        self.flashCount += 1
+        name = "flash%d" % self.flashCount
+        self.activate(name, Flash(name, 1000, color, start, end, duration))
+
+    def set_brightness(self, brightness, fade=True):
+        if self.brightness is not None and abs(brightness - self.brightness) < self.hysteresis:
+            return
+        self.brightness = brightness
+        if not fade:
+            self.fadeLevel = float(brightness)
+            self.framebuffer.set_brightness(brightness)
+        self.wake.set()
+
+    def _fade(self):
+        # Moves the framebuffer brightness one step towards the target per tick.
+        if self.fadeLevel is None:
+            self.fadeLevel = float(self.framebuffer.brightness)
+        if self.fadeLevel < self.brightness:
+            self.fadeLevel = min(self.fadeLevel + self.fadeStep, self.brightness)
+        else:
+            self.fadeLevel = max(self.fadeLevel - self.fadeStep, self.brightness)
+        self.framebuffer.set_brightness(int(round(self.fadeLevel)))
+
+    def _update_layers(self):
+        # Called with the lock held; the render thread only reads the tuple reference.
+        # Walks the active effects from the top down, handing each opaque one its
+        # range; effects inside ranges already handed out are preempted.
+        now = self.clock()
+        ordered = sorted(self.active.values(), key=lambda effect: (effect.priority, effect.name))
+        layers = []
+        preempted = []
+        owned = []
+        for effect in reversed(ordered):
+            if covers(owned, effect.start, effect.end):
+                effect.pause(now)
+                preempted.append(effect)
+                continue
+            effect.resume(now)
+            layers.append(effect)
+            if effect.opaque():
+                owned.append((effect.start, effect.end))
+        layers.reverse()
+        self.layers = tuple(layers)
+        self.preempted = tuple(preempted)
+
+    def owner(self, index):
+        # Name of the topmost visible effect covering LED `index`, None for the base color.
+        for effect in reversed(self.layers):
+            if effect.start <= index < effect.end:
+                return effect.name
+        return None
+
+    def compose(self, now):
+        frame = [self.base_color] * self.strip.numPixels()
+        expired = []
+        for effect in self.layers:
+            if effect.finished(now):
+                expired.append(effect)
+                continue
+            effect.render(frame, now, self)
+        if expired:
+            with self.lock:
+                for effect in expired:
+                    self.active.pop(effect.name, None)
+                self._update_layers()
+        return frame
+
+    def render_frame(self, now):
+        timed = self.metrics is not None and self.metrics.enabled
+        if timed:
+            began = time.perf_counter()
+        self.framebuffer.update(self.compose(now))
+        if self.brightness is not None and self.fadeLevel != self.brightness:
+            self._fade()
+        if not timed:
+            return self.framebuffer.show()
+        composed = time.perf_counter()
+        self.renderTime.observe(composed - began)
+        shown = self.framebuffer.show()
+        if shown:
+            self.showTime.observe(time.perf_counter() - composed)
+        return shown
+
+    def next_wake(self, now):
+        # When the frame can change next without outside events, None if static.
+        if self.brightness is not None and self.fadeLevel != self.brightness:
+            return now
+        due = None
+        for effect in self.layers:
+            change = effect.next_change(now, self)
+            if change is not None and (due is None or change < due):
+                due = change
+        for ticker in self.tickers:
+            change = ticker.next_due(now)
+            if change is not None and (due is None or change < due):
+                due = change
+        return due
+
+    def step(self):
+        # Renders one frame without the render thread; a ManualClock is then moved
+        # on by one frame interval. Returns whether show() was called.
+        now = self.clock()
+        self.tick(now)
+        shown = self.render_frame(now)
+        self.ticks += 1
+        if isinstance(self.clock, ManualClock):
+            self.clock.advance(self.interval)
+        return shown
+
+    def run(self):
+        nextTick = time.monotonic()
+        while not self.stop_event.is_set():
+            now = self.clock()
+            began = time.monotonic()
+            # Activations by the tickers are in this frame; changes arriving
+            # meanwhile are still pending in their next_due().
+            self.tick(now)
+            self.wake.clear()
+            self.render_frame(now)
+            self.ticks += 1
+            due = self.next_wake(now)
+            if due is None and self.max_sleep is not None:
+                due = now + self.max_sleep
+            if due is None:
+                self.wake.wait()
+            else:
+                nextTick = max(nextTick + self.interval, due)
+                delay = nextTick - time.monotonic()
+                if delay < 0:
+                    nextTick = time.monotonic()
+                    delay = 0
+                self.wake.wait(delay)
+            if self.wake.is_set():
+                delay = began + self.interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                nextTick = time.monotonic()
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="render", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
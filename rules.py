@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+
+# Declarative signal -> effect rules (rules.json).
+#
+# The file names LED regions (inside the zones of zones.json), the effects
+# drawn in them and rules turning an effect on while conditions on decoded
+# signals hold. At startup every signal gets an integer index and every
+# condition is compiled into a predicate on the signal's raw value (value table
+# names and physical values are converted with the DBC once). Once per render
+# frame only the rules depending on signals whose raw value changed are
+# evaluated, with the newest value of each.
+#
+# Where effects overlap the higher "priority" wins. "on_preempt" ("continue" or
+# "pause") says how an effect's animation carries on after higher priority
+# effects hid it completely (see render.py).
+#
+#   "rules": [{"effect": "autopilot", "when": {"Autopilot State": {"in": ["ACTIVE_NOMINAL"]}}}]
+#
+# Conditions: "in" / "not_in" (list), "equals", "min" / "max" (physical,
+# inclusive). All conditions of a rule have to hold; an effect with several
+# rules is on while any of them holds.
+#
+# The optional "signals" section sets per signal "debounce" (seconds a new
+# value has to stay before the rules see it) and "hold" (seconds the rules
+# keep seeing a value at least) for noisy signals:
+#
+#   "signals": {"Left Turn Signal Status": {"hold": 0.3}}
+#
+# The optional "idle" section names when the car counts as parked and locked
+# and the frames still listened to then.
+# The optional "flight_recorder" section lists conditions ("dump_on") that
+# dump the flight recorder (flight.py) "after" seconds after they start to hold.
+#
+# RuleTable.fields are the signals the loaded rules and effects read; the CAN
+# filters are derived from them, so a rule on a new signal only needs the
+# signal in signalsToDecode.
+
+import json
+import math
+import time
+
+import render
+from state import Mailbox
+from strips import Color
+
+
+def load_rules(path):
+    with open(path, "r") as rulesFile:
+        return json.load(rulesFile)
+
+
+def region(config, name, zones):
+    # Regions are [zone, start, end) with Python slice semantics inside the
+    # zone: negative counts from the end of the zone, null is the end. The
+    # shorter [start, end) counts on all LEDs. A zone name is a region too.
+    # Returns (start, end) on all LEDs; zones: zones.ZoneMap.
+    if name not in config["regions"]:
+        if name in zones.zones:
+            return zones.range(name)
+        raise KeyError("Unknown LED region %s" % name)
+    settings = config["regions"][name]
+    if len(settings) == 2:
+        zoneStart, zoneEnd = 0, zones.count
+        start, end = settings
+    else:
+        zoneStart, zoneEnd = zones.range(settings[0])
+        start, end = settings[1:]
+    start, end = slice(start, end).indices(zoneEnd - zoneStart)[:2]
+    return zoneStart + start, zoneStart + max(start, end)
+
+
+def color(value, colors):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        if value not in colors:
+            raise KeyError("Unknown color %s" % value)
+        return colors[value]
+    return Color(*value)
+
+
+def build_effect(name, settings, config, zones, colors, value_function):
+    start, end = region(config, settings["region"], zones)
+    priority = settings["priority"]
+    kind = settings["type"]
+    if kind == "solid":
+        effect = render.Solid(name, priority, color(settings["color"], colors), start, end)
+    elif kind == "blink":
+        effect = render.Blink(name, priority, color(settings["on"], colors), color(settings.get("off"), colors),
+                              settings["on_time"], settings["off_time"], start, end)
+    elif kind == "blindspot":
+        effect = render.BlindSpot(name, priority, color(settings["color"], colors), settings["turn_signal"], start, end,
+                                  settings.get("blink_time", 0.15))
+    elif kind == "charging":
+        level = settings["level"]
+        effect = render.Charging(name, priority, Color, lambda: value_function(level), start, end)
+    else:
+        raise ValueError("Effect %s has unknown type %s" % (name, kind))
+    if "on_preempt" in settings:
+        if settings["on_preempt"] not in ("continue", "pause"):
+            raise ValueError("Effect %s: on_preempt has to be continue or pause" % name)
+        effect.preempt = settings["on_preempt"]
+    return effect
+
+
+def build_effects(config, zones, colors, value_function):
+    return [build_effect(name, settings, config, zones, colors, value_function)
+            for name, settings in config["effects"].items()]
+
+
+def compile_predicate(signal, condition):
+    # Returns a function of the raw value (None when the signal was not seen or
+    # its multiplexer did not select it).
+    if "in" in condition or "not_in" in condition:
+        values = frozenset(signal.raw_value(value) for value in condition.get("in", condition.get("not_in")))
+        if "in" in condition:
+            return values.__contains__
+        return lambda raw: raw is not None and raw not in values
+    if "equals" in condition:
+        expected = signal.raw_value(condition["equals"])
+        return lambda raw: raw == expected
+    if "min" in condition or "max" in condition:
+        # Physical bounds -> raw bounds; a negative factor swaps them.
+        bounds = [condition.get("min"), condition.get("max")]
+        raws = [None if bound is None else (bound - signal.offset) / signal.factor for bound in bounds]
+        if signal.factor < 0:
+            raws.reverse()
+        low = -math.inf if raws[0] is None else math.ceil(raws[0] - 1e-9)
+        high = math.inf if raws[1] is None else math.floor(raws[1] + 1e-9)
+        return lambda raw: raw is not None and low <= raw <= high
+    raise ValueError("Condition on %s needs in, not_in, equals, min or max" % signal.name)
+
+
+class Condition:
+    # All of `when` ({signal: condition}) holding, on a state.VehicleState.
+    def __init__(self, when, db, signals, state):
+        self.conditions = []
+        for name, condition in when.items():
+            if name not in state.index:
+                raise KeyError("Condition on %s which is not decoded" % name)
+            frame_id, signalName = signals[name]
+            self.conditions.append((state.index[name], compile_predicate(db.signal(frame_id, signalName), condition)))
+        self.conditions = tuple(self.conditions)
+        self.fields = frozenset(field for field, predicate in self.conditions)
+
+    def evaluate(self, values):
+        for field, predicate in self.conditions:
+            if not predicate(values[field]):
+                return False
+        return True
+
+
+class RuleTable:
+    # state: state.VehicleState holding the decoded signals. Its changes go
+    # through a Mailbox and once per render frame the rules depending on the
+    # changed fields are re-evaluated. With a metrics.Registry the evaluation
+    # time is recorded while it is enabled.
+    def __init__(self, config, db, signals, state, renderer, zones, colors, metrics=None):
+        self.renderer = renderer
+        self.state = state
+        self.metrics = metrics
+        if metrics is not None:
+            self.rulesTime = metrics.histogram("stage_seconds", "Time spent per pipeline stage", stage="rules")
+        # Field index -> rule numbers depending on it.
+        self.dispatch = [[] for name in state.names]
+        # Field indices read by the rules and effects.
+        self.fields = set()
+
+        # Handed to the renderer by the caller (see start()), so a table that
+        # fails to build leaves the loaded effects alone.
+        self.effects = {}
+        for name, settings in config["effects"].items():
+            self.effects[name] = build_effect(name, settings, config, zones, colors, state.value)
+            if "level" in settings:
+                if settings["level"] not in state.index:
+                    raise KeyError("Effect %s uses %s which is not decoded" % (name, settings["level"]))
+                self.fields.add(state.index[settings["level"]])
+
+        self.rules = []
+        self.effectRules = {}
+        for rule in config["rules"]:
+            effect = rule["effect"]
+            if effect not in self.effects:
+                raise KeyError("Rule for unknown effect %s" % effect)
+            condition = Condition(rule["when"], db, signals, state)
+            number = len(self.rules)
+            self.rules.append((effect, condition))
+            self.effectRules.setdefault(effect, []).append(number)
+            for field in condition.fields:
+                self.dispatch[field].append(number)
+            self.fields.update(condition.fields)
+        self.dispatch = [tuple(numbers) for numbers in self.dispatch]
+        self.fields = frozenset(self.fields)
+
+        debounce = {}
+        hold = {}
+        for name, settings in config.get("signals", {}).items():
+            if name not in state.index:
+                raise KeyError("Settings for %s which is not decoded" % name)
+            debounce[state.index[name]] = settings.get("debounce", 0.0)
+            hold[state.index[name]] = settings.get("hold", 0.0)
+        self.mailbox = Mailbox(state, debounce, hold, renderer.request_tick, renderer.clock, self.fields)
+
+    def start(self):
+        # Starts following the state, once the renderer has the effects.
+        self.mailbox.reset()
+        self.state.on_change(self.mailbox.publish)
+        self.state.on_reset(self.mailbox.reset)
+        self.renderer.add_ticker(self)
+
+    def close(self):
+        # Stops following the state, e.g. when the rules were reloaded.
+        self.state.changeListeners.remove(self.mailbox.publish)
+        self.state.resetListeners.remove(self.mailbox.reset)
+        self.renderer.remove_ticker(self)
+
+    def refresh(self):
+        # Sets every effect from the current values (after building or reloading).
+        self.mailbox.take_all()
+        values = self.mailbox.values
+        for effect in self.effectRules:
+            self.renderer.set_active(effect, self.evaluate(effect, values))
+
+    def tick(self, now):
+        # Called by the renderer before every frame.
+        timed = self.metrics is not None and self.metrics.enabled
+        if timed:
+            began = time.perf_counter()
+        pending = set()
+        for field in self.mailbox.take(now):
+            pending.update(self.dispatch[field])
+        if pending:
+            values = self.mailbox.values
+            for effect in {self.rules[number][0] for number in pending}:
+                self.renderer.set_active(effect, self.evaluate(effect, values))
+            if timed:
+                self.rulesTime.observe(time.perf_counter() - began)
+
+    def next_due(self, now):
+        return self.mailbox.next_due(now)
+
+    def evaluate(self, effect, values):
+        for number in self.effectRules[effect]:
+            if self.rules[number][1].evaluate(values):
+                return True
+        return False
@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+# Stand-in for the Commander's Panda UDP server, for testing GlowSense without
+# the car and for load testing the decoder and renderer.
+#
+# It implements the handshake ("ehllo" answered with bus 15 / ID 6, or ID 7
+# with --refuse, "bye" ends the session), honors filter packets and streams
+# either a synthetic drive scenario or a capture file recorded with
+# glowsense.py --record. Rates, frames per datagram, bursts, packet loss and
+# periodic outages (car going to sleep) are configurable.
+#
+#   python simulator.py --port 1339
+#   sudo python glowsense.py --host 127.0.0.1 --port 1339
+
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import capture
+import dbc
+import panda
+
+DBC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Model3CAN.dbc")
+
+# Frame ID -> frames per second.
+DEFAULT_RATES = {
+    0x3F5: 10,
+    0x399: 2,
+    0x33A: 1,
+    0x204: 10,
+    0x273: 10,
+    0x118: 100,
+}
+
+SESSION_TIMEOUT = 10.0
+SCENARIO_LENGTH = 20.0
+
+
+def scenario(t, charging=False, parked=False):
+    # Synthetic drive on a 20 s loop: autopilot engages, left turn with a car in
+    # the blind spot, a hands-on nag, a forward collision warning and a right turn.
+    # parked: in P and locked, nothing happening.
+    t = t % SCENARIO_LENGTH
+    if parked:
+        t = SCENARIO_LENGTH - 0.5
+    def between(start, end):
+        return start <= t < end
+    return {
+        0x3F5: {
+            "VCFRONT_indicatorLeftRequest": "TURN_SIGNAL_ACTIVE_HIGH" if between(4, 7) else "TURN_SIGNAL_OFF",
+            "VCFRONT_indicatorRightRequest": "TURN_SIGNAL_ACTIVE_HIGH" if between(15, 17) else "TURN_SIGNAL_OFF",
+        },
+        0x399: {
+            "DAS_autopilotState": "ACTIVE_NOMINAL" if between(2, 14) else "AVAILABLE",
+            "DAS_blindSpotRearLeft": "WARNING_LEVEL_1" if between(5, 8) else "NO_WARNING",
+            "DAS_blindSpotRearRight": "NO_WARNING",
+            "DAS_autopilotHandsOnState": "LC_HANDS_ON_REQD_VISUAL" if between(10, 12) else "LC_HANDS_ON_NOT_REQD",
+            "DAS_forwardCollisionWarning": "FORWARD_COLLISION_WARNING" if between(13, 13.5) else "NONE",
+            "DAS_statusCounter": int(t * 2) % 16,
+        },
+        0x33A: {
+            "UI_SOC": 80,
+        },
+        0x204: {
+            "PCS_chgPwmEnableLine": 1 if charging else 0,
+        },
+        0x273: {
+            "UI_displayBrightnessLevel": 50.0,
+            "UI_globalUnlockOn": 0 if parked else 1,
+        },
+        0x118: {
+            "DI_gear": "DI_GEAR_P" if charging or parked else "DI_GEAR_D",
+            "DI_systemStatusCounter": int(t * 100) % 16,
+        },
+    }
+
+
+class Session:
+    def __init__(self, address, now):
+        self.address = address
+        self.filters = set()
+        self.lastSeen = now
+
+    def wants(self, bus, frame_id):
+        return not self.filters or (bus, frame_id) in self.filters
+
+
+class CommanderSimulator(asyncio.DatagramProtocol):
+    def __init__(self, args, db):
+        self.args = args
+        self.db = db
+        self.sessions = {}
+        self.transport = None
+        self.sleeping = False
+        self.frames = 0
+        self.datagrams = 0
+        self.lost = 0
+
+    #region DatagramProtocol
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        now = time.monotonic()
+        if self.sleeping:
+            return
+        if data == b"ehllo":
+            session = self.sessions.get(addr)
+            if session is None:
+                answer = panda.HANDSHAKE_REFUSE if self.args.refuse else panda.HANDSHAKE_ACCEPT
+                self.transport.sendto(panda.pack_frame(panda.HANDSHAKE_BUS, answer, 0, 0), addr)
+                if self.args.refuse:
+                    return
+                print("Client %s:%d connected" % addr)
+                session = self.sessions[addr] = Session(addr, now)
+            session.lastSeen = now
+        elif data == b"bye":
+            if self.sessions.pop(addr, None) is not None:
+                print("Client %s:%d said bye" % addr)
+        elif len(data) == 4 and data[0] == 0x0F:
+            session = self.sessions.get(addr)
+            if session is not None:
+                session.filters.add((data[1], int.from_bytes(data[2:4], "big")))
+                session.lastSeen = now
+    #endregion
+
+    def send(self, frames):
+        # frames: list of (bus, frame ID, raw 16 byte frame). Splits them into
+        # datagrams per session honoring filters, frames per datagram and loss.
+        for session in list(self.sessions.values()):
+            selected = [frame for bus, frame_id, frame in frames if session.wants(bus, frame_id)]
+            step = self.args.frames_per_datagram
+            for start in range(0, len(selected), step):
+                if self.args.loss and random.random() < self.args.loss:
+                    self.lost += 1
+                    continue
+                self.transport.sendto(b"".join(selected[start:start + step]), session.address)
+                self.datagrams += 1
+                self.frames += len(selected[start:start + step])
+
+    def expire_sessions(self, now):
+        for address, session in list(self.sessions.items()):
+            if now - session.lastSeen > SESSION_TIMEOUT:
+                print("Client %s:%d timed out" % address)
+                del self.sessions[address]
+
+    def update_outage(self, now, began):
+        if not self.args.outage_every:
+            return
+        phase = (now - began) % (self.args.outage_every + self.args.outage_length)
+        sleeping = phase >= self.args.outage_every
+        if sleeping != self.sleeping:
+            self.sleeping = sleeping
+            print("Car " + ("asleep" if sleeping else "awake"))
+            if sleeping:
+                self.sessions.clear()
+
+    async def run_synthetic(self):
+        began = time.monotonic()
+        rates = dict(DEFAULT_RATES)
+        rates.update(self.args.rate)
+        periods = {frame_id: 1.0 / (rate * self.args.rate_scale) for frame_id, rate in rates.items() if rate > 0}
+        due = {frame_id: began for frame_id in periods}
+        pending = []
+        nextBurst = began
+        nextStats = began + self.args.stats_interval
+        while True:
+            now = time.monotonic()
+            self.update_outage(now, began)
+            self.expire_sessions(now)
+            values = None
+            for frame_id, period in periods.items():
+                while due[frame_id] <= now:
+                    due[frame_id] += period
+                    if self.sleeping or not self.sessions:
+                        continue
+                    if values is None:
+                        values = scenario(now - began, self.args.charging, self.args.parked)
+                    payload = self.db.message(frame_id).encode(values.get(frame_id, {}))
+                    pending.append((0, frame_id, panda.pack_frame(0, frame_id, payload)))
+            if pending and now >= nextBurst:
+                self.send(pending)
+                pending = []
+                nextBurst = now + self.args.burst_interval
+            if now >= nextStats:
+                self.print_stats(now - began)
+                nextStats += self.args.stats_interval
+            nextDue = min(due.values())
+            if pending:
+                nextDue = min(nextDue, nextBurst)
+            await asyncio.sleep(max(0.0, min(nextDue, nextStats) - time.monotonic()))
+
+    async def run_replay(self):
+        reader = capture.CaptureReader(self.args.replay)
+        parser = panda.PandaFrameParser()
+        began = time.monotonic()
+        while True:
+            while not self.sessions:
+                await asyncio.sleep(0.1)
+            first = None
+            loopStart = time.monotonic()
+            for timestamp, data in reader.datagrams():
+                now = time.monotonic()
+                self.update_outage(now, began)
+                self.expire_sessions(now)
+                if first is None:
+                    first = timestamp
+                if self.args.speed > 0:
+                    delay = (timestamp - first) / 1e9 / self.args.speed - (now - loopStart)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif self.datagrams % 64 == 0:
+                    await asyncio.sleep(0)
+                if self.sleeping:
+                    continue
+                frames = []
+                for offset, (bus, frame_id, length, payload) in enumerate(parser.iter_frames(data)):
+                    frames.append((bus, frame_id, data[offset * 16:offset * 16 + 16]))
+                self.send(frames)
+            self.print_stats(time.monotonic() - began)
+            if not self.args.loop:
+                break
+        reader.close()
+
+    def print_stats(self, elapsed):
+        print("%.0fs: %d clients, %d frames (%.0f/s), %d datagrams, %d lost" % (
+            elapsed, len(self.sessions), self.frames, self.frames / max(elapsed, 1e-9), self.datagrams, self.lost))
+
+
+def parse_rate(text):
+    frame_id, rate = text.split("=")
+    return int(frame_id, 0), float(rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Commander / Panda UDP simulator for GlowSense")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=1338, help="UDP port to listen on")
+    parser.add_argument("--refuse", action="store_true", help="refuse every handshake (answer ID 7)")
+    parser.add_argument("--rate", type=parse_rate, action="append", default=[], metavar="ID=HZ",
+                        help="frames per second for a frame ID, e.g. 0x399=50 (0 disables it)")
+    parser.add_argument("--rate-scale", type=float, default=1.0, help="multiply every rate, for load tests")
+    parser.add_argument("--frames-per-datagram", type=int, default=64, help="maximum frames packed into one datagram")
+    parser.add_argument("--burst-interval", type=float, default=0.0,
+                        help="hold frames and send them in one burst every N seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of dropping a datagram")
+    parser.add_argument("--outage-every", type=float, default=0.0,
+                        help="go silent (car asleep) after every N seconds of traffic")
+    parser.add_argument("--outage-length", type=float, default=5.0, help="length of each outage in seconds")
+    parser.add_argument("--charging", action="store_true", help="synthetic scenario: parked and charging")
+    parser.add_argument("--parked", action="store_true", help="synthetic scenario: parked and locked")
+    parser.add_argument("--replay", metavar="FILE", help="stream a capture file instead of the synthetic scenario")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 as fast as possible")
+    parser.add_argument("--loop", action="store_true", help="restart the replay when it ends")
+    parser.add_argument("--stats-interval", type=float, default=5.0, help="seconds between statistics lines")
+    args = parser.parse_args()
+    args.rate = dict(args.rate)
+
+    async def serve():
+        simulator = CommanderSimulator(args, dbc.load_dbc(DBC_FILE))
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: simulator, local_addr=(args.host, args.port))
+        print("Simulating a Commander on %s:%d" % (args.host, args.port))
+        try:
+            if args.replay:
+                await simulator.run_replay()
+            else:
+                await simulator.run_synthetic()
+        finally:
+            transport.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
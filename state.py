@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+
+# Decoded vehicle state.
+#
+# Every decoded signal is a field with an integer index. Values are kept as raw
+# integers (enum codes for signals with a value table), physical values and
+# value names are only produced when asked for. The receive side is the only
+# writer: an update that changes something builds a new values tuple and swaps
+# it in with a single assignment, so readers on other threads (the renderer)
+# always see the fields of one frame together without taking a lock.
+# Per field the state keeps the sequence number and monotonic time of its last
+# change, and listeners can subscribe to fields or to every change.
+# A Mailbox hands the changes to a consumer that looks once per tick.
+
+import math
+import threading
+import time
+from array import array
+
+
+class Snapshot:
+    # Consistent view of all fields at one sequence number.
+    __slots__ = ("state", "sequence", "values")
+
+    def __init__(self, state, sequence, values):
+        self.state = state
+        self.sequence = sequence
+        self.values = values
+
+    def raw(self, name):
+        return self.values[self.state.index[name]]
+
+    def value(self, name):
+        index = self.state.index[name]
+        return self.state.physical(index, self.values[index])
+
+    def as_dict(self):
+        return {name: self.state.physical(index, value)
+                for index, (name, value) in enumerate(zip(self.state.names, self.values))}
+
+
+class VehicleState:
+    __slots__ = ("names", "index", "signals", "frameFields", "fieldFrames", "current", "fieldSequence",
+                 "fieldTime", "listeners", "changeListeners", "resetListeners")
+
+    def __init__(self, decoders):
+        # decoders: {frame ID: dbc.CompiledDecoder}; one field per decoded signal.
+        self.names = []
+        self.signals = []
+        self.frameFields = {}
+        # Field index -> frame ID carrying it.
+        self.fieldFrames = []
+        for frame_id, decoder in decoders.items():
+            fields = []
+            for name, signal in zip(decoder.names, decoder.signals):
+                fields.append(len(self.names))
+                self.names.append(name)
+                self.signals.append(signal)
+                self.fieldFrames.append(frame_id)
+            self.frameFields[frame_id] = tuple(fields)
+        self.names = tuple(self.names)
+        self.signals = tuple(self.signals)
+        self.fieldFrames = tuple(self.fieldFrames)
+        self.index = {name: number for number, name in enumerate(self.names)}
+        # (sequence, values); replaced as a whole, never modified in place.
+        self.current = (0, (None,) * len(self.names))
+        self.fieldSequence = array("Q", [0]) * len(self.names)
+        self.fieldTime = array("d", [0.0]) * len(self.names)
+        self.listeners = [[] for name in self.names]
+        self.changeListeners = []
+        self.resetListeners = []
+
+    #region Writing (receive thread)
+    def update(self, frame_id, raws, now=None):
+        # raws in the order of the frame's decoder (CompiledDecoder.decode_raw()).
+        sequence, values = self.current
+        changed = None
+        for field, value in zip(self.frameFields[frame_id], raws):
+            if values[field] != value:
+                if changed is None:
+                    changed = []
+                changed.append((field, value))
+        if changed is None:
+            return ()
+        self._apply(sequence, values, changed, now)
+        return changed
+
+    def set(self, name, value, now=None):
+        # Sets one field from a physical value or value name, mostly for tests and tools.
+        field = self.index[name]
+        raw = None if value is None else self.signals[field].raw_value(value)
+        sequence, values = self.current
+        if values[field] != raw:
+            self._apply(sequence, values, [(field, raw)], now)
+
+    def forget(self, frame_id, keep=(), now=None):
+        # Clears the fields of a frame that is no longer received (listeners see
+        # None), except the field indices in `keep`.
+        sequence, values = self.current
+        changed = [(field, None) for field in self.frameFields[frame_id] if field not in keep and values[field] is not None]
+        if changed:
+            self._apply(sequence, values, changed, now)
+
+    def _apply(self, sequence, values, changed, now):
+        now = time.monotonic() if now is None else now
+        sequence += 1
+        values = list(values)
+        for field, value in changed:
+            values[field] = value
+            self.fieldSequence[field] = sequence
+            self.fieldTime[field] = now
+        self.current = (sequence, tuple(values))
+        for field, value in changed:
+            for function in self.listeners[field]:
+                function(value)
+        for function in self.changeListeners:
+            function(changed)
+
+    def reset(self, keep=()):
+        # Forgets all values (e.g. after reconnecting) except the field indices
+        # in `keep`. Only on_reset() listeners are told, field and change
+        # listeners are not.
+        values = self.current[1]
+        self.current = (self.current[0] + 1, tuple(values[field] if field in keep else None
+                                                   for field in range(len(self.names))))
+        for function in self.resetListeners:
+            function()
+    #endregion
+
+    #region Reading
+    def snapshot(self):
+        sequence, values = self.current
+        return Snapshot(self, sequence, values)
+
+    def raw(self, name):
+        return self.current[1][self.index[name]]
+
+    def value(self, name):
+        # Physical value or value table name, None when not received yet.
+        index = self.index[name]
+        return self.physical(index, self.current[1][index])
+
+    def physical(self, index, raw):
+        if raw is None:
+            return None
+        signal = self.signals[index]
+        name = signal.values.get(raw)
+        if name is not None:
+            return name
+        value = raw
+        if signal.factor != 1:
+            value = value * signal.factor
+        if signal.offset != 0:
+            value = value + signal.offset
+        return value
+
+    def code(self, name, valueName):
+        # Enum code of a value table name, for comparing raw values.
+        return self.signals[self.index[name]].raw_value(valueName)
+
+    def age(self, name, now=None):
+        # Seconds since the field last changed, None when it never did.
+        index = self.index[name]
+        if not self.fieldSequence[index]:
+            return None
+        return (time.monotonic() if now is None else now) - self.fieldTime[index]
+
+    def sequence(self, name=None):
+        if name is None:
+            return self.current[0]
+        return self.fieldSequence[self.index[name]]
+    #endregion
+
+    #region Notifications
+    def subscribe(self, name, function):
+        # function(raw value) after the field changed.
+        self.listeners[self.index[name]].append(function)
+
+    def on_change(self, function):
+        # function([(field index, raw value), ...]) after every update that changed something.
+        self.changeListeners.append(function)
+
+    def on_reset(self, function):
+        # function() after reset().
+        self.resetListeners.append(function)
+
+    def frames(self, fields):
+        # Frame IDs carrying the given field indices.
+        return sorted({self.fieldFrames[field] for field in fields})
+
+    def subscribed(self):
+        # Field indices with subscribe() listeners.
+        return [field for field, functions in enumerate(self.listeners) if functions]
+    #endregion
+
+
+class Mailbox:
+    # Latest-value mailbox between the receive thread and a consumer that
+    # looks once per tick (the rules, once per render frame). Changes only
+    # overwrite the newest value of a field, so a field changing ten times
+    # between two ticks costs the consumer one evaluation. Per field
+    # `debounce` is how long a new value has to stay before it is taken and
+    # `hold` how long a taken value is kept at least; values flapping back
+    # within that time are never seen. Both default to 0 (take at the next tick).
+    # With `fields` only changes of those field indices are passed on.
+    def __init__(self, state, debounce=None, hold=None, wake=None, clock=time.monotonic, fields=None):
+        count = len(state.names)
+        self.state = state
+        self.wanted = [fields is None or field in fields for field in range(count)]
+        self.lock = threading.Lock()
+        self.reset()
+        self.debounce = array("d", [0.0]) * count
+        self.hold = array("d", [0.0]) * count
+        for field, seconds in (debounce or {}).items():
+            self.debounce[field] = seconds
+        for field, seconds in (hold or {}).items():
+            self.hold[field] = seconds
+        self.wake = wake
+        self.clock = clock
+
+    def reset(self):
+        # Starts over from the state's current values, e.g. after VehicleState.reset().
+        count = len(self.state.names)
+        with self.lock:
+            # Values as the consumer sees them.
+            self.values = list(self.state.current[1])
+            self.latest = list(self.values)
+            self.changedAt = array("d", [0.0]) * count
+            self.takenAt = array("d", [-math.inf]) * count
+            self.pending = set()
+
+    def publish(self, fields):
+        # VehicleState.on_change() listener (receive thread).
+        wanted = [(field, value) for field, value in fields if self.wanted[field]]
+        if not wanted:
+            return
+        now = self.clock()
+        with self.lock:
+            wasEmpty = not self.pending
+            for field, value in wanted:
+                self.latest[field] = value
+                self.changedAt[field] = now
+                self.pending.add(field)
+        if wasEmpty and self.wake is not None:
+            self.wake()
+
+    def take(self, now):
+        # Consumer side: updates values and returns the fields whose value changed.
+        taken = []
+        with self.lock:
+            for field in list(self.pending):
+                value = self.latest[field]
+                if value == self.values[field]:
+                    self.pending.discard(field)
+                elif now >= self.changedAt[field] + self.debounce[field] and now >= self.takenAt[field] + self.hold[field]:
+                    self.values[field] = value
+                    self.takenAt[field] = now
+                    self.pending.discard(field)
+                    taken.append(field)
+        return taken
+
+    def take_all(self):
+        # Takes every newest value regardless of debounce and hold (after a reload).
+        with self.lock:
+            self.values = list(self.latest)
+            self.pending.clear()
+
+    def next_due(self, now):
+        # When a held back value can be taken, None when nothing is pending.
+        due = None
+        with self.lock:
+            for field in self.pending:
+                ready = max(self.changedAt[field] + self.debounce[field], self.takenAt[field] + self.hold[field], now)
+                if due is None or ready < due:
+                    due = ready
+        return due
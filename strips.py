@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+
+# LED strip backends. They all offer the PixelStrip methods the renderer uses
+# (begin, numPixels, setPixelColor, setBrightness, show), so GlowSense and the
+# benchmarks can run without a Raspberry Pi. rpi_ws281x is only imported when
+# the real strip is opened. With two channels (zones.json) ChannelStrip puts
+# them behind one strip and only shows the channels that changed.
+
+import time
+from array import array
+from collections import deque
+
+BACKENDS = ("ws281x", "recording", "null")
+# Shows kept by the "recording" backend: 12 s at 50 fps.
+RECORDING_KEEP = 600
+
+
+def Color(red, green, blue, white=0):
+    # Same packing as rpi_ws281x.Color.
+    return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+class NullStrip:
+    # Accepts everything and only counts show() calls.
+    def __init__(self, num):
+        self.count = num
+        self.brightness = 255
+        self.shows = 0
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return self.count
+
+    def setPixelColor(self, n, color):
+        pass
+
+    def getPixelColor(self, n):
+        return 0
+
+    def setBrightness(self, brightness):
+        self.brightness = brightness
+
+    def getBrightness(self):
+        return self.brightness
+
+    def show(self):
+        self.shows += 1
+
+
+class RecordingStrip(NullStrip):
+    # Keeps the pixels in memory and records every show() as
+    # (clock time, brightness, copy of the pixels). `keep` limits how many
+    # shows are remembered, None keeps all of them. Pass the renderer's clock
+    # (e.g. a render.ManualClock) to get the times frames were rendered for.
+    def __init__(self, num, keep=None, clock=time.monotonic):
+        NullStrip.__init__(self, num)
+        self.pixels = array("I", [0]) * num
+        self.frames = deque(maxlen=keep)
+        self.clock = clock
+
+    def setPixelColor(self, n, color):
+        self.pixels[n] = color
+
+    def getPixelColor(self, n):
+        return self.pixels[n]
+
+    def show(self):
+        self.shows += 1
+        self.frames.append((self.clock(), self.brightness, array("I", self.pixels)))
+
+
+class ChannelStrip:
+    # One strip per rpi_ws281x channel, seen as one row of pixels (channel 0
+    # first). show() only goes to channels with pixels set since their last
+    # show(); channelShows counts them per channel.
+    def __init__(self, channels):
+        self.channels = list(channels)
+        self.offsets = []
+        self.channelOf = array("B")
+        self.count = 0
+        for number, strip in enumerate(self.channels):
+            self.offsets.append(self.count)
+            self.channelOf.extend([number] * strip.numPixels())
+            self.count += strip.numPixels()
+        self.dirty = [False] * len(self.channels)
+        self.shows = 0
+        self.channelShows = [0] * len(self.channels)
+
+    def begin(self):
+        for strip in self.channels:
+            strip.begin()
+
+    def numPixels(self):
+        return self.count
+
+    def setPixelColor(self, n, color):
+        number = self.channelOf[n]
+        self.channels[number].setPixelColor(n - self.offsets[number], color)
+        self.dirty[number] = True
+
+    def getPixelColor(self, n):
+        number = self.channelOf[n]
+        return self.channels[number].getPixelColor(n - self.offsets[number])
+
+    def setBrightness(self, brightness):
+        for number, strip in enumerate(self.channels):
+            strip.setBrightness(brightness)
+            self.dirty[number] = True
+
+    def getBrightness(self):
+        return self.channels[0].getBrightness()
+
+    def show(self):
+        self.shows += 1
+        for number, strip in enumerate(self.channels):
+            if self.dirty[number]:
+                self.dirty[number] = False
+                strip.show()
+                self.channelShows[number] += 1
+
+
+class Ws281xChannels:
+    # Both PWM channels on one rpi_ws281x instance. PixelStrip sets up only one
+    # channel and a second PixelStrip would take over the PWM of the first.
+    # The hardware sends both channels with every render, so channel() strips
+    # share one render per round of show() calls.
+    def __init__(self, channels, freq_hz=800000, dma=10, invert=False, brightness=255):
+        import atexit
+        import _rpi_ws281x as ws
+        self.ws = ws
+        self.leds = ws.new_ws2811_t()
+        self.handles = []
+        self.counts = []
+        for number in range(2):
+            pin, count = channels[number] if number < len(channels) else (0, 0)
+            handle = ws.ws2811_channel_get(self.leds, number)
+            ws.ws2811_channel_t_count_set(handle, count)
+            ws.ws2811_channel_t_gpionum_set(handle, pin)
+            ws.ws2811_channel_t_invert_set(handle, 1 if invert and count else 0)
+            ws.ws2811_channel_t_brightness_set(handle, brightness if count else 0)
+            ws.ws2811_channel_t_strip_type_set(handle, ws.WS2811_STRIP_GRB)
+            self.handles.append(handle)
+            self.counts.append(count)
+        ws.ws2811_t_freq_set(self.leds, freq_hz)
+        ws.ws2811_t_dmanum_set(self.leds, dma)
+        self.started = False
+        self.changed = False
+        atexit.register(self.close)
+
+    def begin(self):
+        if self.started:
+            return
+        result = self.ws.ws2811_init(self.leds)
+        if result != self.ws.WS2811_SUCCESS:
+            raise RuntimeError("ws2811_init failed with code %d (%s)" % (result, self.ws.ws2811_get_return_t_str(result)))
+        self.started = True
+
+    def render(self):
+        if not self.changed:
+            return
+        self.changed = False
+        result = self.ws.ws2811_render(self.leds)
+        if result != self.ws.WS2811_SUCCESS:
+            raise RuntimeError("ws2811_render failed with code %d (%s)" % (result, self.ws.ws2811_get_return_t_str(result)))
+
+    def channel(self, number):
+        return Ws281xChannel(self, number)
+
+    def close(self):
+        if self.leds is not None:
+            if self.started:
+                self.ws.ws2811_fini(self.leds)
+            self.ws.delete_ws2811_t(self.leds)
+            self.leds = None
+
+
+class Ws281xChannel:
+    # PixelStrip-like view of one channel of Ws281xChannels.
+    def __init__(self, device, number):
+        self.device = device
+        self.ws = device.ws
+        self.handle = device.handles[number]
+        self.count = device.counts[number]
+
+    def begin(self):
+        self.device.begin()
+
+    def numPixels(self):
+        return self.count
+
+    def setPixelColor(self, n, color):
+        self.ws.ws2811_led_set(self.handle, n, color)
+        self.device.changed = True
+
+    def getPixelColor(self, n):
+        return self.ws.ws2811_led_get(self.handle, n)
+
+    def setBrightness(self, brightness):
+        self.ws.ws2811_channel_t_brightness_set(self.handle, brightness)
+        self.device.changed = True
+
+    def getBrightness(self):
+        return self.ws.ws2811_channel_t_brightness_get(self.handle)
+
+    def show(self):
+        self.device.render()
+
+
+def open_channels(backend, channels, freq_hz=800000, dma=10, invert=False, brightness=255):
+    # channels: [(pin, count)] by channel number (zones.ZoneMap.channels).
+    if len(channels) == 1:
+        pin, count = channels[0]
+        return open_strip(backend, count, pin, freq_hz, dma, invert, brightness, 0)
+    if backend == "ws281x":
+        device = Ws281xChannels(channels, freq_hz, dma, invert, brightness)
+        return ChannelStrip([device.channel(number) for number in range(len(channels))])
+    return ChannelStrip([open_strip(backend, count) for pin, count in channels])
+
+
+def open_strip(backend, count, pin=18, freq_hz=800000, dma=10, invert=False, brightness=255, channel=0):
+    if backend == "ws281x":
+        from rpi_ws281x import PixelStrip
+        return PixelStrip(count, pin, freq_hz, dma, invert, brightness, channel)
+    if backend == "recording":
+        return RecordingStrip(count, keep=RECORDING_KEEP)
+    if backend == "null":
+        return NullStrip(count)
+    raise ValueError("Unknown strip backend %s (one of %s)" % (backend, ", ".join(BACKENDS)))
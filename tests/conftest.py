@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glowsense
+import render
+import rules
+import strips
+
+
+@pytest.fixture
+def lights(tmp_path):
+    # glowsense with rules.json on a RecordingStrip, rendered by hand with a ManualClock.
+    glowsense.load_defaults()
+    # The rules' flight recorder triggers would dump into the checkout.
+    glowsense.flightRecorder.directory = str(tmp_path / "flight")
+    if glowsense.ruleTable is not None:
+        glowsense.ruleTable.close()
+        glowsense.ruleTable = None
+    glowsense.payloadCache.reset()
+    glowsense.vehicle.reset()
+    clock = render.ManualClock(100.0)
+    glowsense.strip = strips.RecordingStrip(glowsense.LED_COUNT, keep=50, clock=clock)
+    glowsense.renderer = render.Renderer(glowsense.strip, glowsense.COLOR_DEFAULT, glowsense.RENDER_FPS, clock=clock)
+    glowsense.apply_rules(rules.load_rules(glowsense.RULES_FILE))
+    yield glowsense.renderer
+    glowsense.flightRecorder.close()
+    glowsense.ruleTable.close()
+    glowsense.ruleTable = None
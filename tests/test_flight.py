@@ -0,0 +1,46 @@
+import glob
+import os
+import time
+
+import capture
+import flight
+import panda
+
+
+def frame_ids(reader):
+    return [record[2] for record in reader.records()]
+
+
+def frame_ids_of(recorder):
+    times, data = recorder._frames((recorder.count, recorder.times, bytes(recorder.frames)))
+    return [panda.PANDA_HEADER.unpack_from(data, number * panda.PANDA_FRAME_SIZE)[0] >> 21 for number in range(len(times))]
+
+
+def test_dump_keeps_the_last_seconds_in_order(tmp_path):
+    recorder = flight.FlightRecorder(str(tmp_path), seconds=1.5, capacity=5, changes=3)
+    second = 1000000000
+    recorder.record(b"".join(panda.pack_frame(0, frameID, frameID) for frameID in range(1, 4)), 1 * second)
+    # Wraps around: frames 1 and 2 are overwritten.
+    recorder.record(b"".join(panda.pack_frame(0, frameID, frameID) for frameID in range(4, 8)), 3 * second)
+    assert frame_ids_of(recorder) == [3, 4, 5, 6, 7]
+    path = recorder.dump("test")
+    recorder.writer.join()
+    reader = capture.CaptureReader(path)
+    try:
+        # Frame 3 came 2 s before the newest frame.
+        assert frame_ids(reader) == [4, 5, 6, 7]
+    finally:
+        reader.close()
+
+
+def test_delayed_trigger_dumps_without_more_frames(tmp_path):
+    recorder = flight.FlightRecorder(str(tmp_path))
+    recorder.record(panda.pack_frame(0, 0x3F5, 1))
+    recorder.trigger("later", 0.05)
+    recorder.trigger("ignored", 0.05)
+    deadline = time.monotonic() + 5.0
+    while recorder.writer is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    recorder.writer.join()
+    assert recorder.pending is None
+    assert [os.path.basename(path).split("-")[-1] for path in glob.glob(str(tmp_path / "*.cap"))] == ["later.cap"]
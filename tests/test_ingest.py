@@ -0,0 +1,47 @@
+import pytest
+
+import dbc
+import glowsense
+import panda
+
+
+@pytest.fixture
+def batch(lights, monkeypatch):
+    if dbc.load_numpy() is None:
+        pytest.skip("numpy is not installed")
+    monkeypatch.setattr(glowsense, "BATCH_DECODE", True)
+    monkeypatch.setattr(glowsense.metricsRegistry, "enabled", True)
+    return lights
+
+
+def frames_total(frameID):
+    counter = glowsense.frameCounters.get(frameID)
+    return 0 if counter is None else counter.value
+
+
+def test_batch_decode_counts_and_prints_frames(batch, monkeypatch, capsys):
+    data = b"".join(panda.pack_frame(0, frameID, payload)
+                    for frameID, payload in [(0x3F5, 1), (0x399, 2), (0x3F5, 3), (0x123, 4)])
+    before = {frameID: frames_total(frameID) for frameID in (0x3F5, 0x399, 0x123)}
+    monkeypatch.setattr(glowsense, "doPrint", True)
+    glowsense.process_datagram(data)
+    assert {frameID: frames_total(frameID) - count for frameID, count in before.items()} == {0x3F5: 2, 0x399: 1, 0x123: 1}
+    printed = capsys.readouterr().out.splitlines()
+    assert [line.split()[2] for line in printed] == ["3F5#00000001", "399#00000010", "3F5#00000011", "123#00000100"]
+
+
+def unknown_total(frameID):
+    counter = glowsense.unknownCounters.get(frameID)
+    return 0 if counter is None else counter.value
+
+
+@pytest.mark.parametrize("batchDecode", [False, True])
+def test_unknown_frames_are_counted_once(lights, monkeypatch, batchDecode):
+    if batchDecode and dbc.load_numpy() is None:
+        pytest.skip("numpy is not installed")
+    monkeypatch.setattr(glowsense, "BATCH_DECODE", batchDecode)
+    data = b"".join(panda.pack_frame(0, frameID, number)
+                    for number, frameID in enumerate([0x3F5, 0x399, 0x123, 0x3F5, 0x204]))
+    before = unknown_total(0x123)
+    glowsense.process_datagram(data)
+    assert unknown_total(0x123) - before == 1
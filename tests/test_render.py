@@ -0,0 +1,83 @@
+import pytest
+
+import glowsense
+import render
+import strips
+from strips import Color
+
+RED = Color(255, 0, 0)
+GREEN = Color(0, 255, 0)
+BLUE = Color(0, 0, 255)
+
+
+def test_priorities(lights):
+    vehicle = glowsense.vehicle
+    last = glowsense.LED_COUNT - 1
+    # In the left turn region, left of the left blind spot region.
+    turnOnly = glowsense.LED_COUNT - 10
+
+    vehicle.set("Left Turn Signal Status", "TURN_SIGNAL_ACTIVE_HIGH")
+    lights.step()
+    assert lights.owner(last) == "left_turn"
+    assert lights.strip.pixels[last] == glowsense.COLORS["GREEN"]
+
+    vehicle.set("Blindspot Rear Left Status", "WARNING_LEVEL_1")
+    lights.step()
+    assert lights.owner(last) == "left_blindspot"
+    assert lights.owner(turnOnly) == "left_turn"
+
+    vehicle.set("Autopilot Hands-On Status", "LC_HANDS_ON_REQD_VISUAL")
+    lights.step()
+    assert lights.owner(last) == "hands_on"
+    assert lights.owner(turnOnly) == "hands_on"
+    assert [effect.name for effect in lights.preempted] == ["left_blindspot", "left_turn"]
+
+    vehicle.set("Forward Collision Warning", "FORWARD_COLLISION_WARNING")
+    lights.step()
+    assert lights.owner(0) == lights.owner(last) == "forward_collision"
+    assert lights.strip.pixels[last] == glowsense.COLORS["RED"]
+
+    vehicle.set("Forward Collision Warning", None)
+    vehicle.set("Autopilot Hands-On Status", None)
+    lights.step()
+    assert lights.owner(last) == "left_blindspot"
+    assert lights.owner(turnOnly) == "left_turn"
+
+
+def steps(renderer, seconds):
+    for number in range(int(round(seconds / renderer.interval))):
+        renderer.step()
+
+
+def test_hidden_effects_continue_or_pause():
+    clock = render.ManualClock()
+    strip = strips.RecordingStrip(10, keep=10, clock=clock)
+    renderer = render.Renderer(strip, 0, 50, clock=clock)
+    # Blinks 0.1 s on, 0.1 s off from when they were activated.
+    renderer.add(render.Blink("continue", 30, GREEN, None, 0.1, 0.1, 0, 5))
+    renderer.add(render.Blink("pause", 30, BLUE, None, 0.1, 0.1, 5, 10))
+    renderer.effects["pause"].preempt = "pause"
+    renderer.add(render.Solid("cover", 60, RED, 0, 10))
+    renderer.activate("continue")
+    renderer.activate("pause")
+    steps(renderer, 0.04)
+
+    renderer.activate("cover")
+    steps(renderer, 0.1)
+    assert [effect.name for effect in renderer.preempted] == ["pause", "continue"]
+    assert list(strip.pixels) == [RED] * 10
+
+    renderer.deactivate("cover")
+    renderer.step()
+    # 0.14 s since activation: the continued blink is off, the paused one
+    # only played 0.04 s of it and is still on.
+    assert list(strip.pixels) == [0] * 5 + [BLUE] * 5
+    assert renderer.effects["pause"].started == pytest.approx(renderer.effects["continue"].started + 0.1)
+
+
+def test_recording_backend_is_bounded():
+    strip = strips.open_strip("recording", 4)
+    for number in range(strips.RECORDING_KEEP + 10):
+        strip.show()
+    assert strip.shows == strips.RECORDING_KEEP + 10
+    assert len(strip.frames) == strips.RECORDING_KEEP
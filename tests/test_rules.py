@@ -0,0 +1,154 @@
+import random
+
+import glowsense
+import panda
+import rules
+
+
+def test_effect_comes_back_after_reconnect(lights):
+    vehicle = glowsense.vehicle
+    vehicle.set("Autopilot State", "ACTIVE_NOMINAL")
+    lights.step()
+    assert lights.is_active("autopilot")
+
+    glowsense.on_connection_state("lost")
+    glowsense.on_connection_state("connected")
+    lights.step()
+    assert not lights.is_active("autopilot")
+
+    # The same frame as before the connection was lost.
+    vehicle.set("Autopilot State", "ACTIVE_NOMINAL")
+    lights.step()
+    assert lights.is_active("autopilot")
+
+
+def test_rules_stage_times_rule_evaluation(lights):
+    rulesTime = glowsense.metricsRegistry.histogram("stage_seconds", glowsense.STAGE_HELP, stage="rules")
+    count = rulesTime.count
+    glowsense.metricsRegistry.enabled = True
+    try:
+        glowsense.vehicle.set("Autopilot State", "ACTIVE_NOMINAL")
+        lights.step()
+        # Nothing changed, nothing evaluated.
+        lights.step()
+    finally:
+        glowsense.metricsRegistry.enabled = False
+    assert rulesTime.count == count + 1
+
+
+def test_reload_swaps_effects_and_table(lights, monkeypatch, tmp_path):
+    vehicle = glowsense.vehicle
+    vehicle.set("Autopilot State", "ACTIVE_NOMINAL")
+    lights.step()
+    listeners = len(vehicle.changeListeners), len(vehicle.resetListeners), len(lights.tickers)
+    glowsense.reload_rules()
+    assert lights.effects is glowsense.ruleTable.effects
+    assert (len(vehicle.changeListeners), len(vehicle.resetListeners), len(lights.tickers)) == listeners
+    lights.step()
+    assert lights.is_active("autopilot")
+
+    # A broken file keeps what was loaded.
+    broken = tmp_path / "rules.json"
+    broken.write_text("{")
+    monkeypatch.setattr(glowsense, "RULES_FILE", str(broken))
+    effects = lights.effects
+    glowsense.reload_rules()
+    assert lights.effects is effects
+    assert lights.is_active("autopilot")
+
+
+def test_activate_unknown_effect_is_ignored(lights):
+    lights.activate("gone")
+    lights.step()
+    assert not lights.is_active("gone")
+
+
+TURNING = ["TURN_SIGNAL_ACTIVE_HIGH", "TURN_SIGNAL_ACTIVE_LOW"]
+HANDS_ON = ["LC_HANDS_ON_REQD_VISUAL", "LC_HANDS_ON_REQD_CHIME_1", "LC_HANDS_ON_REQD_CHIME_2",
+            "LC_HANDS_ON_REQD_ESCALATED_CHIME_1", "LC_HANDS_ON_REQD_ESCALATED_CHIME_2"]
+
+
+class Cascade:
+    # The if/elif frame dispatch glowsense.py had before rules.json, on decoded values.
+    def __init__(self, brightness):
+        self.results = {}
+        self.active = set()
+        self.brightness = brightness
+
+    def set_active(self, name, state):
+        if state:
+            self.active.add(name)
+        else:
+            self.active.discard(name)
+
+    def dispatch(self, frameID, decoder, payload):
+        results = self.results
+        results.update(zip(decoder.names, decoder.decode(payload)))
+        if frameID == 0x3F5:
+            self.set_active("left_turn", results["Left Turn Signal Status"] in TURNING)
+            self.set_active("right_turn", results["Right Turn Signal Status"] in TURNING)
+        elif frameID == 0x399:
+            self.set_active("autopilot", results["Autopilot State"] in ["ACTIVE_NOMINAL", "ACTIVE_RESTRICTED", "ACTIVE_NAV", "FSD?"])
+            self.set_active("left_blindspot", results["Blindspot Rear Left Status"] in ["WARNING_LEVEL_1", "WARNING_LEVEL_2"])
+            self.set_active("right_blindspot", results["Blindspot Rear Right Status"] in ["WARNING_LEVEL_1", "WARNING_LEVEL_2"])
+            self.set_active("hands_on", results["Autopilot Hands-On Status"] in HANDS_ON)
+            self.set_active("forward_collision", results["Forward Collision Warning"] in ["FORWARD_COLLISION_WARNING"])
+        elif frameID == 0x204:
+            self.set_active("charging", results["Charge Status"] == 1)
+        elif frameID == 0x273:
+            brightness = results["Display Brightness"]
+            if brightness != "SNA":
+                brightness = 5 if brightness < 10 else brightness
+                self.brightness = int(min(brightness, 100) / 100 * 255)
+
+
+def test_rule_table_matches_cascade_on_random_traffic(lights, monkeypatch):
+    # Without the turn signal holds the rules switch on every frame like the cascade did.
+    config = rules.load_rules(glowsense.RULES_FILE)
+    del config["signals"]
+    glowsense.apply_rules(config)
+    monkeypatch.setattr(glowsense, "idleCondition", None)
+    db = glowsense.db
+    cascade = Cascade(lights.brightness)
+    payloads = {}
+    generator = random.Random(1)
+    frameIDs = sorted(glowsense.decoders)
+    for number in range(5000):
+        frameID = generator.choice(frameIDs)
+        decoder = glowsense.decoders[frameID]
+        if number % 50 == 0:
+            payload = generator.getrandbits(64)
+        else:
+            # Mostly named values, so the effects actually switch.
+            values = {}
+            for signal in decoder.signals:
+                if signal.values and generator.random() < 0.8:
+                    values[signal.name] = generator.choice(list(signal.values.values()))
+                else:
+                    values[signal.name] = signal.offset + signal.factor * generator.randrange(1 << min(signal.length, 10))
+            payload = db.message(frameID).encode(values)
+        glowsense.process_datagram(panda.pack_frame(0, frameID, payload))
+        if payloads.get(frameID) != payload:
+            payloads[frameID] = payload
+            cascade.dispatch(frameID, decoder, payload)
+        lights.step()
+        assert set(lights.active) == cascade.active, number
+        assert lights.brightness == cascade.brightness, number
+    assert cascade.active
+
+
+def test_reconnect_while_parked_stays_idle(lights, monkeypatch, capsys):
+    monkeypatch.setattr(glowsense, "idleMode", False)
+    vehicle = glowsense.vehicle
+    vehicle.set("Gear Status", "DI_GEAR_P")
+    vehicle.set("Charge Status", 0)
+    vehicle.set("Lock Status", 0)
+    assert glowsense.idleMode
+
+    glowsense.on_connection_state("lost")
+    glowsense.on_connection_state("connected")
+    # Only the idle frames come in after reconnecting.
+    vehicle.set("Lock Status", 0)
+    vehicle.set("Charge Status", 0)
+    assert glowsense.idleMode
+    assert "Idle mode off" not in capsys.readouterr().out
@@ -0,0 +1,49 @@
+import os
+import random
+import subprocess
+import sys
+
+import dbc
+import glowsense
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_does_no_work():
+    script = ("import sys, glowsense\n"
+              "print(glowsense.db is None, glowsense.vehicle is None, glowsense.zoneMap is None, 'numpy' in sys.modules)")
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert output.split() == ["True", "True", "True", "False"]
+
+
+def test_signal_cache_round_trip(tmp_path):
+    cachePath = str(tmp_path / "signals.cache")
+    frameIDs = {frame_id for frame_id, signalName in glowsense.signalsToDecode.values()}
+    parsed, cached = dbc.load_dbc_cached(glowsense.DBC_FILE, frameIDs, cachePath)
+    assert not cached
+    assert sorted(parsed.messages) == sorted(frameIDs)
+    loaded, cached = dbc.load_dbc_cached(glowsense.DBC_FILE, frameIDs, cachePath)
+    assert cached
+
+    # Both decode the same.
+    parsedDecoders = dbc.compile_decoders(parsed, glowsense.signalsToDecode)
+    loadedDecoders = dbc.compile_decoders(loaded, glowsense.signalsToDecode)
+    generator = random.Random(1)
+    for number in range(200):
+        frameID = generator.choice(sorted(frameIDs))
+        payload = generator.getrandbits(64)
+        assert loadedDecoders[frameID].decode(payload) == parsedDecoders[frameID].decode(payload)
+
+    # Other frames: parsed again.
+    other, cached = dbc.load_dbc_cached(glowsense.DBC_FILE, set(sorted(frameIDs)[1:]), cachePath)
+    assert not cached
+
+
+def test_broken_signal_cache_is_rewritten(tmp_path):
+    cache = tmp_path / "signals.cache"
+    cache.write_bytes(b"not a pickle")
+    frameIDs = {0x3F5}
+    db, cached = dbc.load_dbc_cached(glowsense.DBC_FILE, frameIDs, str(cache))
+    assert not cached and sorted(db.messages) == [0x3F5]
+    db, cached = dbc.load_dbc_cached(glowsense.DBC_FILE, frameIDs, str(cache))
+    assert cached
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+# LED zones (zones.json): which strip is where in the car.
+#
+# "channels" lists the rpi_ws281x channels in channel order (0: PWM0, e.g.
+# GPIO 18; 1: PWM1, e.g. GPIO 13) with their pin and LED count. "zones" names
+# an LED range on a channel, with Python slice semantics like the regions in
+# rules.json:
+#
+#   "zones": {"dash": {"channel": 0, "leds": [0, null]},
+#             "left_door": {"channel": 1, "leds": [0, 40]}}
+#
+# The renderer sees the channels one after the other as one row of pixels
+# (channel 0 first), the regions in rules.json are placed inside zones. So the
+# effects only name zones and regions and the same rules.json works for
+# installations with other LED counts; only zones.json changes.
+
+import json
+
+
+def load_zones(path):
+    with open(path, "r") as zonesFile:
+        return ZoneMap(json.load(zonesFile))
+
+
+class ZoneMap:
+    def __init__(self, config):
+        # [(pin, count)] by channel number.
+        self.channels = []
+        self.offsets = []
+        self.count = 0
+        for settings in config["channels"]:
+            self.channels.append((settings["pin"], settings["count"]))
+            self.offsets.append(self.count)
+            self.count += settings["count"]
+        if not self.channels or len(self.channels) > 2:
+            raise ValueError("zones.json needs one or two channels")
+        # Zone name -> (channel, start, end) with start and end counted on all LEDs.
+        self.zones = {}
+        for name, settings in config["zones"].items():
+            channel = settings["channel"]
+            if not 0 <= channel < len(self.channels):
+                raise ValueError("Zone %s is on unknown channel %d" % (name, channel))
+            start, end = settings.get("leds", [0, None])
+            start, end = slice(start, end).indices(self.channels[channel][1])[:2]
+            offset = self.offsets[channel]
+            self.zones[name] = (channel, offset + start, offset + max(start, end))
+
+    def range(self, name):
+        if name not in self.zones:
+            raise KeyError("Unknown LED zone %s" % name)
+        return self.zones[name][1:]